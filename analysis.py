@@ -4,8 +4,6 @@ import time
 import numpy as np
 from tqdm import tqdm
 
-from tifffile import imread
-
 import torch
 
 from lsm.utils.logger import Logger
@@ -20,10 +18,17 @@ from lsm.utils.distributed_util import (
     get_world_size,
 )
 
-from lsm.evaluation.stitch_metrics import StitchMetrics
+from lsm.distributed.gt_proxy import find_gt_proxy
+from lsm.evaluation.eval_runner import eval_tasks, metric_dicts, run_evaluation
 from lsm.evaluation.stitching_stats import StitchingAnalysis
 
 
+def chunk_path(exp_dir: str, chunk: int):
+    # stitched labels, as written by distributed_segment.py (zarr or tiff)
+    path = os.path.join(exp_dir, f"chunk_{chunk}.zarr")
+    return path if os.path.exists(path) else os.path.join(exp_dir, f"chunk_{chunk}.tiff")
+
+
 def main_function(args):
     init_env(args)
     rank = get_rank()
@@ -43,32 +48,53 @@ def main_function(args):
 
     log.info(f"Analysis log directory: {exp_dir}")
 
-    # load data
-    data_dir = args.data.data_dir
+    # stitched volumes (and gt proxies) of every model, per chunk size
     chunks = args.analysis.stitching.chunk_sizes
-    gt_vol = imread(os.path.join(exp_dir, "gt_proxy.tiff"))
-    stitched_vols = [
-        imread(os.path.join(exp_dir, f"chunk_{csize}.tiff")) for csize in chunks
-    ]
+    models = args.analysis.get("models", None)
+    model_dirs = (
+        {model: os.path.join(exp_dir, f"{model}_seg") for model in models}
+        if models
+        else {"": exp_dir}
+    )
+
+    volumes, gt_paths = {}, {}
+    for model, model_dir in model_dirs.items():
+        gt_path = find_gt_proxy(
+            model_dir,
+            cache_dir=args.analysis.get("gt_cache_dir", None),
+            key=args.analysis.get("gt_proxy_key", None),
+        )
+        if gt_path is None:
+            raise FileNotFoundError(f"No ground truth proxy found for {model_dir}")
+        gt_paths[model] = gt_path
+        volumes[model] = {csize: chunk_path(model_dir, csize) for csize in chunks}
 
     # plot iou + nuclei count
     if args.analysis.do_stitching:
-        # compute stitching metrics
-        for metric in args.analysis.stitching.metrics:
-            print(f"Computing {metric} for stitching...")
-            stitching_metrics = StitchMetrics(
-                gt_proxy=gt_vol,
-                stitched_vols=stitched_vols,
-                metric=metric,
-                chunk_sizes=chunks,
-            )
-            metric_dict = stitching_metrics.compute_metric()
+        # models x chunk sizes x metrics, in a process pool over memory-mapped
+        # inputs; results are cached by their inputs, so only missing ones run
+        tasks = eval_tasks(
+            volumes,
+            gt_paths,
+            metrics=args.analysis.stitching.metrics,
+            seam_width=args.analysis.stitching.get("seam_width", 2),
+        )
+        results = run_evaluation(
+            tasks,
+            cache_path=os.path.join(
+                exp_dir, args.analysis.stitching.get("results_cache", "stitching_metrics.parquet")
+            ),
+            workers=args.analysis.stitching.get("workers", 4),
+        )
+
+        for (model, metric), metric_dict in metric_dicts(results).items():
+            print(f"Stitching {metric} {f'({model})' if model else ''}: {metric_dict}")
             # create and save plots
             stitching_stats = StitchingAnalysis(
                 metric_dict=metric_dict,
                 metric_name=metric,
                 var_name="Chunk Size",
-                save_path=exp_dir,
+                save_path=model_dirs[model],
                 resolution=args.analysis.resolution,
             )
             all_stats, kruskal_result = stitching_stats.all_analysis()
@@ -4,15 +4,25 @@ import time
 import numpy as np
 from tqdm import tqdm
 
-from tifffile import imwrite
-
 import dask
+import dask.array as da
 from dask.diagnostics import ProgressBar
 
 from lsm.dataio import get_data
+from lsm.dataio.object_index import ObjectIndex, index_path
 from lsm.utils.logger import Logger
-from lsm.distributed import get_model
+from lsm.distributed import get_model, get_segment_config, get_map_names
+from lsm.distributed.gt_proxy import (
+    GTProxyCache,
+    get_gt_proxy,
+    roi_params,
+    write_gt_proxy_key,
+)
+from lsm.distributed.object_stats import write_object_table, write_density_map
+from lsm.distributed.prob_maps import write_maps
+from lsm.distributed.relabel import relabel_sequential, relabel_table
 from lsm.utils.console_log import log
+from lsm.utils.io_util import cache_volume, write_volume
 from lsm.utils.train_utils import count_trainable_parameters
 from lsm.utils.load_config import create_args_parser, load_config, backup
 from lsm.utils.distributed_util import (
@@ -43,10 +53,33 @@ def main_function(args):
 
     log.info(f"Segmentation directory: {exp_dir}")
 
+    # the density map is written with ome_zarr, fail before segmenting without it
+    if args.segmentation.get("density_cell", None) is not None:
+        try:
+            import ome_zarr  # noqa: F401
+        except ImportError:
+            raise ImportError("density_cell requires ome-zarr (pip install ome-zarr)")
+
     # lazy load data as a dask array
     dataset = get_data(args)
 
-    gt_vol = next(iter(dataset))[-1]["orig_vol"]
+    img_vol = next(iter(dataset))[-1]["orig_vol"]
+
+    # fetch the roi once into a local store, shared by every model and chunk size
+    read_cache = args.segmentation.get("read_cache", None)
+    if read_cache is not None:
+        print(f"Caching input volume: {read_cache}")
+        img_vol = cache_volume(
+            img_vol, os.path.join(exp_dir, read_cache), source=roi_params(args)
+        )
+
+    # fan-out: every chunk size is segmented with all models in a single pass,
+    # so each block is read (and normalized) once and fed to every model
+    fan_out = args.segmentation.get("fan_out", False)
+    runs = {}
+
+    # ground truth proxies are cached by a hash of the data, roi, model and thresholds
+    gt_cache = GTProxyCache(args.model.get("gt_cache_dir", None))
 
     # run distributed segmentation
     for model in tqdm(args.segmentation.models):
@@ -58,150 +91,135 @@ def main_function(args):
         print(f"Running stitching with {model}...")
         # load model, as a segmentation function
         segment_func = get_model(model=model)
-        if model == "cellpose":
-            img_vol = next(iter(dataset))[-1]
-            cfg_dict = {
-                "image": img_vol["orig_vol"],
-                "debug": args.model.debug,
-                "channels": args.model.channels,
-                "boundary": args.model.boundary,
-                "diameter": args.model.diameter,
-                "use_anisotropy": args.model.use_anisotropy,
-                "iou_depth": args.model.stitching.iou_depth,
-                "iou_threshold": args.model.stitching.iou_threshold,
-            }
-
-        elif model in ["anystar", "anystar-gaussian", "anystar-spherical"]:
-            img_vol = next(iter(dataset))[-1]
-
-            cfg_dict = {
-                "image": img_vol["orig_vol"],
-                "scale": args.model.scale,
-                "debug": args.model.debug,
-                "boundary": args.model.boundary,
-                "diameter": args.model.diameter,
-                "use_anisotropy": args.model.use_anisotropy,
-                "iou_depth": args.model.stitching.iou_depth,
-                "iou_threshold": args.model.stitching.iou_threshold,
-            }
-
-            # separate check for weights and hyperparameters
-            if model == "anystar":
-                cfg_dict["model_folder"] = args.model.anystar.model_folder
-                cfg_dict["model_name"] = args.model.anystar.model_name
-                cfg_dict["weight_name"] = args.model.anystar.weight_name
-                cfg_dict["prob_thresh"] = args.model.anystar.prob_thresh
-                cfg_dict["nms_thresh"] = args.model.anystar.nms_thresh
-            elif model == "anystar-gaussian":
-                cfg_dict["model_folder"] = args.model.anystar_gaussian.model_folder
-                cfg_dict["model_name"] = args.model.anystar_gaussian.model_name
-                cfg_dict["weight_name"] = args.model.anystar_gaussian.weight_name
-                cfg_dict["prob_thresh"] = args.model.anystar_gaussian.prob_thresh
-                cfg_dict["nms_thresh"] = args.model.anystar_gaussian.nms_thresh
-            elif model == "anystar-spherical":
-                cfg_dict["model_folder"] = args.model.anystar_spherical.model_folder
-                cfg_dict["model_name"] = args.model.anystar_spherical.model_name
-                cfg_dict["weight_name"] = args.model.anystar_spherical.weight_name
-                cfg_dict["prob_thresh"] = args.model.anystar_spherical.prob_thresh
-                cfg_dict["nms_thresh"] = args.model.anystar_spherical.nms_thresh
-            else:
-                raise NotImplementedError(
-                    f"Anystar model type: {model} not implemented. Try one of [anystar, anystar-gaussian, anystar-spherical]"
-                )
-
-        else:
-            raise NotImplementedError
+        cfg_dict = get_segment_config(args, model=model, image=img_vol)
+        map_names = (
+            get_map_names(model, cfg_dict) if args.model.get("save_prob_map", False) else None
+        )
 
         if args.model.save_gt_proxy:
-            print(f"Saving ground truth proxy for stitching analysis (model: {model})")
-            impath = os.path.join(save_dir, f"gt_proxy.tiff")
+            # whole-roi prediction, shared across runs and experiments by key
             try:
-                if model == "cellpose":
-                    from cellpose import models
-
-                    model = models.Cellpose(gpu=True, model_type="nuclei")
-                    gt_proxy, _, _, _ = model.eval(
-                        gt_vol,
-                        channels=args.model.channels,
-                        z_axis=0,
-                        channel_axis=3,
-                        diameter=args.model.diameter[1],
-                        do_3D=True,
-                        anisotropy=args.model.use_anisotropy,
-                        augment=True,
-                        tile=True,
-                    )
-                    imwrite(impath, gt_proxy)
-                elif model in ["anystar", "anystar-gaussian", "anystar-spherical"]:
-                    from stardist.models import StarDist3D
-
-                    # normalize voxel
-                    x = gt_vol.compute()  # convert to numpy array
-                    upper = np.percentile(x, 99.9)
-                    x = np.clip(x, 0, upper)
-                    x = (x - x.min()) / (x.max() - x.min())
-                    x = x[..., 0]
-
-                    model = StarDist3D()
-                    model.trainable = False
-                    model.keras_model.trainable = False
-
-                    # choose appropriate model weights
-                    if model == "anystar":
-                        model.name = args.model.anystar.model_name
-                        model.basedir = args.model.anystar.model_folder
-                        model.load_weights(args.model.anystar.weight_name)
-                        gt_proxy, _ = model.predict_instances(
-                            x,
-                            prob_thresh=args.model.anystar.prob_thresh,
-                            nms_thresh=args.model.anystar.nms_thresh,
-                            n_tiles=None,
-                            scale=args.model.scale,
-                        )
-                        imwrite(impath, gt_proxy)
-                    elif model == "anystar-gaussian":
-                        model.name = args.model.anystar_gaussian.model_name
-                        model.basedir = args.model.anystar_gaussian.model_folder
-                        model.load_weights(args.model.anystar_gaussian.weight_name)
-                        gt_proxy, _ = model.predict_instances(
-                            x,
-                            prob_thresh=args.model.anystar_gaussian.prob_thresh,
-                            nms_thresh=args.model.anystar_gaussian.nms_thresh,
-                            n_tiles=None,
-                            scale=args.model.scale,
-                        )
-                        model.load_weights(args.model.anystar_gaussian.weight_name)
-                        imwrite(impath, gt_proxy)
-                    elif model == "anystar-spherical":
-                        model.name = args.model.anystar_spherical.model_name
-                        model.basedir = args.model.anystar_spherical.model_folder
-                        model.load_weights(args.model.anystar_spherical.weight_name)
-                        gt_proxy, _ = model.predict_instances(
-                            x,
-                            prob_thresh=args.model.anystar_spherical.prob_thresh,
-                            nms_thresh=args.model.anystar_spherical.nms_thresh,
-                            n_tiles=None,
-                            scale=args.model.scale,
-                        )
-                        model.load_weights(args.model.anystar_spherical.weight_name)
-                        imwrite(impath, gt_proxy)
-
-            except:
+                key = get_gt_proxy(args, model, img_vol, gt_cache)
+            except MemoryError:
                 raise MemoryError(
                     f"Voxel chunk size is large. Consider reducing shape from {args.segmentation.voxel_shape}"
                 )
+            write_gt_proxy_key(save_dir, key)
 
-        for chunk in tqdm(args.segmentation.chunk_sizes):
-            print(f"Running segmentation for chunk size: {chunk}")
-            cfg_dict["chunk"] = chunk
-            seg_vol = segment_func(**cfg_dict)
+        # per-object table (centroid, bounding box, voxel count), accumulated
+        # while blocks are labeled
+        object_stats = args.segmentation.get("object_stats", False)
+        cfg_dict["object_stats"] = object_stats
 
-            with ProgressBar():
-                with dask.config.set(scheduler="synchronous"):
-                    seg_vol = seg_vol.compute()
+        # coarse object density (count + mean volume per cell), binned from the same table
+        density_cell = args.segmentation.get("density_cell", None)
+        cfg_dict["density_cell"] = density_cell
 
-                    fpath = os.path.join(save_dir, f"chunk_{chunk}.tiff")
-                    imwrite(fpath, seg_vol)
+        # probability and flow/distance maps, as chunked float16 zarr
+        cfg_dict["return_maps"] = args.model.get("save_prob_map", False)
+
+        runs[model] = (segment_func, cfg_dict, save_dir, map_names)
+        if not fan_out:
+            for chunk in tqdm(args.segmentation.chunk_sizes):
+                segment_chunk_size(args, {model: runs[model]}, chunk)
+
+    if fan_out:
+        for chunk in tqdm(args.segmentation.chunk_sizes):
+            segment_chunk_size(args, runs, chunk)
+
+
+def segment_chunk_size(args, runs, chunk):
+    """
+    segment (and write) every model's labels at a chunk size, in a single
+    dask pass, where `runs` maps models to their
+    (segment_func, cfg_dict, save_dir, map_names)
+    """
+    print(f"Running segmentation for chunk size: {chunk} ({', '.join(runs)})")
+    zarr_chunks = tuple(args.segmentation.get("zarr_chunks", [64, 64, 64]))
+
+    graphs, stores = {}, []
+    for model, (segment_func, cfg_dict, save_dir, map_names) in runs.items():
+        cfg_dict["chunk"] = chunk
+        seg_vol = segment_func(**cfg_dict)
+        outputs = seg_vol if isinstance(seg_vol, tuple) else (seg_vol,)
+
+        if cfg_dict["return_maps"]:
+            # blended network outputs are stored during the same inference pass
+            fpath = os.path.join(save_dir, f"chunk_{chunk}_maps.zarr")
+            maps = write_maps(
+                outputs[-1],
+                fpath,
+                chunks=zarr_chunks,
+                channel_names=map_names,
+            )
+            outputs = outputs[:-1]
+            stores.append(maps)
+
+        graphs[model] = outputs
+
+    with ProgressBar():
+        with dask.config.set(scheduler="synchronous"):
+            # labels, tables, density and output maps of all models share a single pass
+            computed = dask.compute(*[o for outputs in graphs.values() for o in outputs], *stores)
+
+    start = 0
+    for model, outputs in graphs.items():
+        save_dir = runs[model][2]
+        write_outputs(args, save_dir, chunk, computed[start : start + len(outputs)])
+        start += len(outputs)
+
+
+def write_outputs(args, save_dir, chunk, outputs):
+    """write a model's (computed) labels, object table and density map at a chunk size"""
+    seg_vol = outputs[0]
+
+    # per-object table (centroid, bounding box, voxel count), accumulated
+    # while blocks are labeled
+    object_stats = args.segmentation.get("object_stats", False)
+
+    # coarse object density (count + mean volume per cell), binned from the same table
+    density_cell = args.segmentation.get("density_cell", None)
+
+    # label volumes are written as tiff (default) or chunked zarr
+    output_format = args.segmentation.get("output_format", "tiff")
+    zarr_chunks = tuple(args.segmentation.get("zarr_chunks", [64, 64, 64]))
+
+    # compact stitched label ids to 1..N in the smallest unsigned dtype, lazily
+    # block by block as the labels are written (no full-size temporaries)
+    if args.segmentation.get("relabel_sequential", False):
+        ids = outputs[1]["label"].values if object_stats else None
+        seg_vol = da.from_array(seg_vol, chunks=zarr_chunks)
+        seg_vol, ids = relabel_sequential(seg_vol, ids=ids)
+        if object_stats:
+            outputs = (seg_vol, relabel_table(outputs[1], ids), *outputs[2:])
+        print(f"Relabeled {len(ids)} objects as {seg_vol.dtype}")
+
+    if object_stats:
+        object_table = outputs[1]
+        fpath = os.path.join(save_dir, f"chunk_{chunk}.parquet")
+        write_object_table(object_table, fpath)
+
+    fpath = os.path.join(save_dir, f"chunk_{chunk}.{output_format}")
+    write_volume(fpath, seg_vol, chunks=zarr_chunks)
+
+    # spatial index for object crops/box queries on the zarr output
+    if object_stats and output_format == "zarr":
+        object_index = ObjectIndex.from_object_table(
+            object_table, shape=seg_vol.shape, cell_shape=zarr_chunks
+        )
+        object_index.save(index_path(fpath))
+
+    # written last, so labels and object tables are on disk if it fails
+    if density_cell is not None:
+        counts, mean_volume = outputs[-1]
+        fpath = os.path.join(save_dir, f"chunk_{chunk}_density.ome.zarr")
+        write_density_map(
+            fpath,
+            counts,
+            mean_volume,
+            cell_size=density_cell,
+            voxel_size=args.segmentation.get("voxel_size", [1.0, 1.0, 1.0]),
+        )
 
 
 if __name__ == "__main__":
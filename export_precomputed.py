@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+
+from lsm.utils.console_log import log
+from lsm.utils.load_config import create_args_parser, load_config
+from lsm.visualize.mesh import mesh_labels
+from lsm.visualize.precomputed import export_precomputed
+
+
+def main_function(args):
+    exp_dir = args.training.exp_dir
+    out_root = os.path.join(exp_dir, "precomputed")
+
+    for fname in args.export.inputs:
+        source = os.path.join(exp_dir, fname)
+        # eg: cellpose_seg/chunk_64.tiff -> precomputed/cellpose_seg/chunk_64
+        out_dir = os.path.join(out_root, os.path.splitext(fname)[0])
+
+        print(f"Exporting {source} to {out_dir}...")
+        info, n_chunks = export_precomputed(
+            source=source,
+            out_dir=out_dir,
+            resolution=args.export.resolution,
+            chunk_size=args.export.chunk_size,
+            num_scales=args.export.num_scales,
+            factor=args.export.factor,
+            block_size=args.export.block_size,
+            workers=args.export.workers,
+        )
+        log.info(f"Wrote {n_chunks} chunks over {len(info['scales'])} scales")
+
+        if args.export.mesh:
+            print(f"Meshing {source}...")
+            mesh_stats = mesh_labels(
+                source=source,
+                out_dir=os.path.join(out_dir, "mesh"),
+                resolution=args.export.resolution,
+                block_shape=args.export.mesh_block_shape,
+                simplify=args.export.simplify,
+                workers=args.export.workers,
+            )
+            log.info(
+                f"Wrote {mesh_stats['meshes']} meshes ({mesh_stats['meshes_per_second']:.1f} meshes/s)"
+            )
+
+            # point the segmentation to its meshes
+            info["mesh"] = "mesh"
+            with open(os.path.join(out_dir, "info"), "w") as f:
+                json.dump(info, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = create_args_parser()
+    parser.add_argument("--ddp", action="store_true", help="Distributed processing")
+    args, unknown = parser.parse_known_args()
+    config = load_config(args, unknown)
+    main_function(config)
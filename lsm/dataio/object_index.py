@@ -0,0 +1,183 @@
+"""
+spatial index over segmented objects (grid of cells aligned with the label
+volume's storage chunks), so object crops and box queries only read the
+chunks they intersect, instead of scanning the volume
+"""
+import os
+import numpy as np
+import pandas as pd
+from typing import Optional, Tuple, List
+
+from lsm.utils.io_util import open_volume
+from lsm.distributed.object_stats import AXES, block_moments, merge_object_table
+
+
+def index_path(volume_path: str):
+    """sidecar path of a label volume's index, eg: chunk_64.zarr -> chunk_64.index.npz"""
+    return os.path.splitext(volume_path.rstrip("/"))[0] + ".index.npz"
+
+
+class ObjectIndex:
+    def __init__(
+        self,
+        table: pd.DataFrame,
+        shape: Tuple[int],
+        cell_shape: Tuple[int],
+        volume=None,
+    ):
+        # keep objects sorted by label, for binary search lookups
+        self.table = table.sort_values("label").reset_index(drop=True)
+        self.shape = tuple(int(s) for s in shape)
+        self.cell_shape = tuple(int(c) for c in cell_shape)
+        self.volume = volume
+
+        self.labels = self.table["label"].values
+        self.bbox_min = self.table[[f"bbox_min_{ax}" for ax in AXES]].values
+        self.bbox_max = self.table[[f"bbox_max_{ax}" for ax in AXES]].values
+        self.grid_shape = tuple(
+            int(np.ceil(s / c)) for s, c in zip(self.shape, self.cell_shape)
+        )
+        self.cell_ptr, self.cell_objects = self._build_grid()
+
+    def _build_grid(self):
+        """csr-style map from every grid cell to the objects whose bbox touches it"""
+        c0 = self.bbox_min // self.cell_shape
+        c1 = (self.bbox_max - 1) // self.cell_shape
+        span = c1 - c0 + 1
+
+        cells, objects = [], []
+        rows = np.arange(len(self.table))
+        # objects rarely span more than a couple of cells along any axis
+        for offset in np.ndindex(*span.max(axis=0, initial=1)):
+            valid = np.all(np.asarray(offset) < span, axis=1)
+            cells.append(
+                np.ravel_multi_index(tuple((c0[valid] + offset).T), self.grid_shape)
+            )
+            objects.append(rows[valid])
+        cells, objects = np.concatenate(cells), np.concatenate(objects)
+
+        order = np.argsort(cells, kind="stable")
+        cell_ptr = np.zeros(int(np.prod(self.grid_shape)) + 1, dtype=np.int64)
+        np.add.at(cell_ptr, cells + 1, 1)
+        return np.cumsum(cell_ptr), objects[order]
+
+    @classmethod
+    def from_object_table(
+        cls,
+        table,
+        shape: Tuple[int],
+        cell_shape: Optional[Tuple[int]] = (64, 64, 64),
+        volume=None,
+    ):
+        if isinstance(table, str):
+            table = pd.read_parquet(table)
+        return cls(table, shape=shape, cell_shape=cell_shape, volume=volume)
+
+    @classmethod
+    def from_volume(cls, volume, cell_shape: Optional[Tuple[int]] = None):
+        """build an index by scanning a (chunked) label volume once, chunk by chunk"""
+        if isinstance(volume, str):
+            volume = open_volume(volume)
+        if cell_shape is None:
+            cell_shape = getattr(volume, "chunks", None) or (64, 64, 64)
+            # dask chunks are given per block, use the (regular) leading ones
+            cell_shape = tuple(c[0] if isinstance(c, tuple) else c for c in cell_shape)
+
+        moments = []
+        for index in np.ndindex(
+            *[int(np.ceil(s / c)) for s, c in zip(volume.shape, cell_shape)]
+        ):
+            origin = np.multiply(index, cell_shape)
+            block = volume[tuple(slice(o, o + c) for o, c in zip(origin, cell_shape))]
+            moments.append(block_moments(block, origin))
+
+        table = merge_object_table(moments)
+        return cls(table, shape=volume.shape, cell_shape=cell_shape, volume=volume)
+
+    def save(self, path: str):
+        np.savez(
+            path,
+            shape=self.shape,
+            cell_shape=self.cell_shape,
+            columns=np.asarray(list(self.table.columns), dtype=str),
+            **{f"col_{col}": self.table[col].values for col in self.table.columns},
+        )
+
+    @classmethod
+    def load(cls, path: str, volume=None):
+        data = np.load(path, allow_pickle=False)
+        table = pd.DataFrame({col: data[f"col_{col}"] for col in data["columns"]})
+        return cls(table, shape=data["shape"], cell_shape=data["cell_shape"], volume=volume)
+
+    @classmethod
+    def open(cls, volume_path: str):
+        """open a label volume along with its sidecar index"""
+        return cls.load(index_path(volume_path), volume=open_volume(volume_path))
+
+    def __len__(self):
+        return len(self.table)
+
+    def _rows(self, labels):
+        labels = np.atleast_1d(labels)
+        rows = np.searchsorted(self.labels, labels)
+        rows = np.minimum(rows, len(self.labels) - 1)
+        if len(self.labels) == 0 or np.any(self.labels[rows] != labels):
+            raise KeyError(f"unknown label(s): {labels[self.labels[rows] != labels]}")
+        return rows
+
+    def object(self, label: int):
+        """table row (centroid, bbox, voxel count) of a single object"""
+        return self.table.iloc[self._rows(label)[0]]
+
+    def bbox(self, label: int, padding: Optional[int] = 0):
+        """(start, stop) slices of an object's bounding box"""
+        row = self._rows(label)[0]
+        return tuple(
+            slice(max(int(lo) - padding, 0), min(int(hi) + padding, s))
+            for lo, hi, s in zip(self.bbox_min[row], self.bbox_max[row], self.shape)
+        )
+
+    def objects_in_box(self, box: List[Tuple[int]], by: Optional[str] = "bbox"):
+        """objects whose bounding box intersects (by="bbox"), or whose centroid
+        lies in (by="centroid") a (start, stop) box"""
+        lo = np.asarray([start for start, _ in box])
+        hi = np.asarray([stop for _, stop in box])
+
+        # candidate objects from the grid cells covering the box
+        c0 = np.maximum(lo // self.cell_shape, 0)
+        c1 = np.minimum((hi - 1) // self.cell_shape, np.subtract(self.grid_shape, 1))
+        cells = [
+            np.ravel_multi_index(tuple(c0 + offset), self.grid_shape)
+            for offset in np.ndindex(*np.maximum(c1 - c0 + 1, 0))
+        ]
+        rows = np.unique(
+            np.concatenate(
+                [self.cell_objects[self.cell_ptr[c] : self.cell_ptr[c + 1]] for c in cells]
+                + [np.zeros(0, dtype=np.int64)]
+            )
+        )
+
+        if by == "bbox":
+            inside = np.all(
+                (self.bbox_min[rows] < hi) & (self.bbox_max[rows] > lo), axis=1
+            )
+        elif by == "centroid":
+            centroids = self.table[[f"centroid_{ax}" for ax in AXES]].values[rows]
+            inside = np.all((centroids >= lo) & (centroids < hi), axis=1)
+        else:
+            raise NotImplementedError(f"{by} not implemented, choose one of [bbox, centroid]")
+
+        return self.table.iloc[rows[inside]]
+
+    def crop(self, label: int, padding: Optional[int] = 0, mask: Optional[bool] = True):
+        """read an object's crop, touching only the storage chunks of its bbox"""
+        if self.volume is None:
+            raise ValueError("no label volume attached to this index")
+
+        crop = np.asarray(self.volume[self.bbox(label, padding=padding)])
+        return (crop == label) if mask else crop
+
+    def crops_in_box(self, box: List[Tuple[int]], padding: Optional[int] = 0):
+        """crops of all objects intersecting a (start, stop) box"""
+        labels = self.objects_in_box(box)["label"].values
+        return {int(label): self.crop(label, padding=padding) for label in labels}
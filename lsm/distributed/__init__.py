@@ -11,3 +11,66 @@ def get_model(model):
         )
 
     return segment
+
+
+def get_segment_config(args, model, image):
+    """build the keyword arguments of a model's segmentation function from a config"""
+    if model == "cellpose":
+        cfg_dict = {
+            "image": image,
+            "debug": args.model.debug,
+            "channels": args.model.channels,
+            "boundary": args.model.boundary,
+            "diameter": args.model.diameter,
+            "use_anisotropy": args.model.use_anisotropy,
+            "iou_depth": args.model.stitching.iou_depth,
+            "iou_threshold": args.model.stitching.iou_threshold,
+        }
+
+    elif model in ["anystar", "anystar-gaussian", "anystar-spherical"]:
+        cfg_dict = {
+            "image": image,
+            "scale": args.model.scale,
+            "debug": args.model.debug,
+            "boundary": args.model.boundary,
+            "diameter": args.model.diameter,
+            "use_anisotropy": args.model.use_anisotropy,
+            "iou_depth": args.model.stitching.iou_depth,
+            "iou_threshold": args.model.stitching.iou_threshold,
+        }
+
+        # separate check for weights and hyperparameters
+        model_args = args.model[model.replace("-", "_")]
+        cfg_dict["model_folder"] = model_args.model_folder
+        cfg_dict["model_name"] = model_args.model_name
+        cfg_dict["weight_name"] = model_args.weight_name
+        cfg_dict["prob_thresh"] = model_args.prob_thresh
+        cfg_dict["nms_thresh"] = model_args.nms_thresh
+
+        # link independently labeled chunks by iou, or extract instances from blended maps
+        cfg_dict["stitching"] = args.model.stitching.get("mode", "iou")
+
+    else:
+        raise NotImplementedError(
+            f"{model} not implemented, choose one of [cellpose, anystar, anystar-gaussian, anystar-spherical]"
+        )
+
+    return cfg_dict
+
+
+def get_map_names(model, cfg_dict):
+    """channel names of a model's output (probability, flow/distance) maps"""
+    if model == "cellpose":
+        from .segment_cellpose import CELLPOSE_MAPS
+
+        return CELLPOSE_MAPS
+    elif model in ["anystar", "anystar-gaussian", "anystar-spherical"]:
+        from .segment_steerable import stardist_map_names
+
+        return stardist_map_names(
+            cfg_dict["model_name"], cfg_dict["model_folder"], cfg_dict["weight_name"]
+        )
+    else:
+        raise NotImplementedError(
+            f"{model} not implemented, choose one of [cellpose, anystar, anystar-gaussian, anystar-spherical]"
+        )
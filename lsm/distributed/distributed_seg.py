@@ -7,16 +7,301 @@
 segment detected regions using a chunked dask array
 """
 import dask
+import operator
+import functools
 import numpy as np
+from tqdm import tqdm
 import dask.array as da
+from typing import Optional, List, Callable
 from sklearn import metrics as sk_metrics
 from dask_image.ndmeasure._utils import _label
 
+from lsm.distributed.object_stats import (
+    block_moments,
+    density_map,
+    merge_object_table,
+)
+from lsm.distributed.prob_maps import blend_blocks
+
 
 # TODO: add typing
 
 
-def link_labels(block_labeled, total, depth, iou_threshold=1):
+def segment_blocks(
+    image: dask.array,
+    segment_chunk: Callable,
+    chunk_kwargs: dict,
+    diameter: List[float],
+    chunk: Optional[int] = None,
+    boundary: Optional[str] = "reflect",
+    iou_depth: Optional[int] = 2,
+    iou_threshold: Optional[float] = 0.7,
+    debug: Optional[bool] = False,
+    object_stats: Optional[bool] = False,
+    density_cell: Optional[List[int]] = None,
+    map_channels: Optional[int] = None,
+    preprocess: Optional[Callable] = None,
+    desc: Optional[str] = "lazy computing chunks...",
+):
+    """
+    segment an image chunk by chunk (with overlaps), and stitch the labeled
+    chunks by linking labels across chunk faces.
+    `segment_chunk(chunk=..., index=..., **chunk_kwargs)` returns a labeled
+    chunk and its number of labels.
+    returns the (lazy) labels, followed by the debug volume if `debug`,
+    a (delayed) per-object table if `object_stats`, (delayed) per-cell
+    object counts and mean volumes, over cells of `density_cell` voxels, and
+    the (lazy) blended network output maps, if `map_channels` is set.
+    in that case, `segment_chunk` is also called with `return_maps=True`, and
+    returns the chunk's (z, y, x, map_channels) maps as a third output.
+    `preprocess(chunk)` (eg: normalization) runs as a pure task per block, so
+    graphs of models sharing it (and the image) share its results, and blocks
+    are read and preprocessed once when computed together
+    """
+    # density maps are binned from the per-object moments
+    accumulate_moments = object_stats or density_cell is not None
+
+    image, depth, core_chunks, core_origins = overlap_blocks(
+        image, diameter, chunk=chunk, boundary=boundary
+    )
+    block_iter = iter_blocks(image)
+
+    labeled_blocks = np.empty(image.numblocks[:-1], dtype=object)
+    # initialize empty "grid" for chunks
+    if debug:
+        unlabeled_blocks = np.empty(image.numblocks[:-1], dtype=object)
+    moments = []
+
+    # network outputs of every overlapped block, and their global origins
+    return_maps = map_channels is not None
+    if return_maps:
+        map_blocks = np.empty(image.numblocks[:-1], dtype=object)
+        map_origins = np.empty(image.numblocks[:-1], dtype=object)
+        map_shapes = np.empty(image.numblocks[:-1], dtype=object)
+
+    total = None
+    for index, input_block in tqdm(block_iter, desc=desc):
+        chunk_input = as_delayed(input_block)
+        if preprocess is not None:
+            chunk_input = dask.delayed(preprocess, pure=True)(chunk_input)
+
+        if return_maps:
+            labeled_block, n, maps = dask.delayed(segment_chunk, nout=3)(
+                chunk=chunk_input,
+                index=index,
+                return_maps=True,
+                **chunk_kwargs,
+            )
+            map_blocks[index[:-1]] = maps
+            map_origins[index[:-1]] = block_origin(
+                index[:-1], depth, core_chunks, core_origins, boundary
+            )
+            map_shapes[index[:-1]] = input_block.shape[:-1]
+        else:
+            labeled_block, n = dask.delayed(segment_chunk, nout=2)(
+                chunk=chunk_input,
+                index=index,
+                **chunk_kwargs,
+            )
+
+        shape = input_block.shape[:-1]
+        labeled_block = da.from_delayed(labeled_block, shape=shape, dtype=np.int32)
+
+        n = dask.delayed(np.int32)(n)
+        n = da.from_delayed(n, shape=(), dtype=np.int32)
+
+        total = n if total is None else total + n
+
+        block_label_offset = da.where(labeled_block > 0, total, np.int32(0))
+        labeled_block += block_label_offset
+
+        labeled_blocks[index[:-1]] = labeled_block
+        total += n
+
+        if accumulate_moments:
+            # accumulate moments over the block's core, ie: without overlaps
+            # (which are only padded at the volume border for boundary="none")
+            core = _core_slices(index[:-1], depth, core_chunks, boundary)
+            origin = tuple(o[i] for o, i in zip(core_origins, index[:-1]))
+            moments.append(
+                dask.delayed(block_moments)(as_delayed(labeled_block), origin, core)
+            )
+
+        if debug:
+            # do the same thing, but assign the same label to *every* chunk
+            # here, we change the image to be 4D, to account for a newly
+            # introduced color channel
+            unlabeled_block = labeled_block
+            colored_chunk = unlabeled_block.copy()
+            nz_mask = (unlabeled_block != 0).astype(
+                np.int32
+            )  # find non-zero pixel locations
+            colored_chunk = np.zeros(
+                unlabeled_block.shape + (3,), dtype=np.int32
+            )  # add a color channel
+            color = np.random.randint(0, 256, size=(3,))
+            colored_chunk[nz_mask] = color
+            unlabeled_blocks[index[:-1]] = colored_chunk
+
+    # put all blocks together
+    block_labeled = da.block(labeled_blocks.tolist())
+
+    if debug:
+        block_unlabeled = da.block(unlabeled_blocks.tolist())
+
+    depth = da.overlap.coerce_depth(len(depth), depth)
+    new_labeling = None
+
+    if np.prod(block_labeled.numblocks) > 1:
+        iou_depth = da.overlap.coerce_depth(len(depth), iou_depth)
+
+        if any(iou_depth[ax] > depth[ax] for ax in depth.keys()):
+            raise Exception
+
+        trim_depth = {k: depth[k] - iou_depth[k] for k in depth.keys()}
+        block_labeled = da.overlap.trim_internal(
+            block_labeled, trim_depth, boundary=boundary
+        )
+
+        # trim excess, due to reflections
+        if debug:
+            block_unlabeled = da.overlap.trim_internal(
+                block_unlabeled, trim_depth, boundary=boundary
+            )
+
+        block_labeled, new_labeling = link_labels(
+            block_labeled,
+            total,
+            iou_depth,
+            iou_threshold=iou_threshold,
+            return_labeling=True,
+        )
+
+        block_labeled = da.overlap.trim_internal(
+            block_labeled, iou_depth, boundary=boundary
+        )
+
+    else:
+        block_labeled = da.overlap.trim_internal(
+            block_labeled, depth, boundary=boundary
+        )
+        if debug:
+            block_unlabeled = da.overlap.trim_internal(
+                block_unlabeled, depth, boundary=boundary
+            )
+
+    outputs = (block_labeled,)
+    if debug:
+        outputs += (block_unlabeled,)
+    if accumulate_moments:
+        # merged through the same relabeling table as the blocks themselves
+        if new_labeling is not None:
+            new_labeling = as_delayed(new_labeling)
+        table = dask.delayed(merge_object_table)(moments, new_labeling)
+    if object_stats:
+        outputs += (table,)
+    if density_cell is not None:
+        shape = tuple(sum(c) for c in core_chunks)
+        outputs += (dask.delayed(density_map, nout=2)(table, shape, density_cell),)
+    if return_maps:
+        # overlaps are cross-faded, instead of trimmed, so maps have no seams
+        outputs += (
+            blend_blocks(
+                map_blocks,
+                map_origins,
+                map_shapes,
+                core_chunks,
+                tuple(depth.values()),
+                map_channels,
+            ),
+        )
+
+    return outputs[0] if len(outputs) == 1 else outputs
+
+
+def overlap_blocks(
+    image: dask.array,
+    diameter: List[float],
+    chunk: Optional[int] = None,
+    boundary: Optional[str] = "reflect",
+):
+    """
+    rechunk a (z, y, x, c) image into blocks of `chunk` voxels, and overlap
+    them by the object diameter.
+    returns the overlapped image, the overlap depth, and the chunks and chunk
+    origins of the (non-overlapped) blocks
+    """
+    image = da.asarray(image)
+
+    # for re-chunking/stitching analyses
+    if chunk is None:
+        image = image.rechunk({-1: -1})
+    else:
+        image = image.rechunk({0: chunk, 1: chunk, 2: chunk, 3: -1})
+
+    # define depth for stitching voxel blocks
+    depth = tuple(np.ceil(diameter).astype(np.int64))
+
+    # overlaps can't be deeper than chunks, so dask would merge small (trailing)
+    # chunks; do it up front, to keep track of the chunks being segmented
+    image = image.rechunk(
+        tuple(
+            da.overlap.ensure_minimum_chunksize(d, c)
+            for d, c in zip(depth, image.chunks[:-1])
+        )
+        + (image.chunks[-1],)
+    )
+
+    # chunk origins (before overlapping), for global object coordinates
+    core_chunks = image.chunks[:-1]
+    core_origins = [np.cumsum((0,) + c[:-1]) for c in core_chunks]
+
+    # no chunking along channel direction
+    image = da.overlap.overlap(image, depth + (0,), boundary)
+
+    return image, depth, core_chunks, core_origins
+
+
+def iter_blocks(image: dask.array):
+    """(block index, block) pairs of a chunked dask array"""
+    return zip(
+        np.ndindex(*image.numblocks),
+        map(
+            functools.partial(operator.getitem, image),
+            da.core.slices_from_chunks(image.chunks),
+        ),
+    )
+
+
+def block_origin(index, depth, chunks, origins, boundary):
+    """global origin of an overlapped block (negative, if padded beyond the volume)"""
+    core = _core_slices(index, depth, chunks, boundary)
+    return tuple(o[i] - c.start for o, i, c in zip(origins, index, core))
+
+
+def as_delayed(block: dask.array):
+    """
+    a (small) dask array as a delayed that refers to its key, so tasks using
+    it share its result, rather than each computing its own embedded copy
+    """
+    if any(n > 1 for n in block.numblocks):
+        block = block.rechunk(block.shape)
+    return block.to_delayed(optimize_graph=False).ravel()[0]
+
+
+def _core_slices(index, depth, chunks, boundary):
+    """slices of an overlapped block, that select its original chunk"""
+    return tuple(
+        slice(lo, lo + c[i])
+        for lo, c, i in zip(
+            [0 if (boundary == "none" and i == 0) else d for d, i in zip(depth, index)],
+            chunks,
+            index,
+        )
+    )
+
+
+def link_labels(block_labeled, total, depth, iou_threshold=1, return_labeling=False):
     """
     build a label connectivity graph that groups labels across blocks,
     use this graph to find connected components, and then relabel each
@@ -24,11 +309,14 @@ def link_labels(block_labeled, total, depth, iou_threshold=1):
     """
     label_groups = label_adjacency_graph(block_labeled, total, depth, iou_threshold)
     new_labeling = _label.connected_components_delayed(label_groups)
-    return _label.relabel_blocks(block_labeled, new_labeling)
+    relabeled = _label.relabel_blocks(block_labeled, new_labeling)
+    if return_labeling:
+        return relabeled, new_labeling
+    return relabeled
 
 
 def label_adjacency_graph(labels, nlabels, depth, iou_threshold):
-    all_mappings = [da.empty((2, 0), dtype=np.int32, chunks=1)]
+    all_mappings = [np.empty((2, 0), dtype=np.int32)]
 
     slices_and_axes = get_slices_and_axes(labels.chunks, labels.shape, depth)
     for face_slice, axis in slices_and_axes:
@@ -36,16 +324,16 @@ def label_adjacency_graph(labels, nlabels, depth, iou_threshold):
         mapped = _across_block_iou_delayed(face, axis, iou_threshold)
         all_mappings.append(mapped)
 
-    i, j = da.concatenate(all_mappings, axis=1)
-    result = _label._to_csr_matrix(i, j, nlabels + 1)
+    # mappings stay delayed, so every face is computed once
+    mappings = dask.delayed(np.concatenate)(all_mappings, axis=1)
+    result = _label._to_csr_matrix(mappings[0], mappings[1], as_delayed(nlabels) + 1)
     return result
 
 
 def _across_block_iou_delayed(face, axis, iou_threshold):
     """Delayed version of :func:`_across_block_label_grouping`."""
     _across_block_label_grouping_ = dask.delayed(_across_block_label_iou)
-    grouped = _across_block_label_grouping_(face, axis, iou_threshold)
-    return da.from_delayed(grouped, shape=(2, np.nan), dtype=np.int32)
+    return _across_block_label_grouping_(as_delayed(face), axis, iou_threshold)
 
 
 def _across_block_label_iou(face, axis, iou_threshold):
@@ -0,0 +1,189 @@
+"""
+content-addressed cache of ground truth proxy volumes (whole-roi model
+predictions, for stitching analyses), keyed by a hash of everything the
+prediction depends on: data url, scale, roi, model, weights and thresholds
+"""
+import os
+import json
+import numpy as np
+from typing import Optional
+
+from lsm.utils.io_util import open_volume, params_key, write_volume
+
+
+DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "lsm", "gt_proxy")
+
+
+def _weights_stamp(path: str):
+    # weights are identified by path, size and modification time (cheaper than hashing them)
+    if not os.path.exists(path):
+        return {"path": path}
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def roi_params(args):
+    """the data (url, scale) and roi a volume is read from"""
+    return {
+        "url": args.data.get("url", None),
+        "data_dir": args.data.get("data_dir", None),
+        "scale": args.data.get("scale", 0),
+        "vol_lims": list(args.segmentation.vol_lims),
+        "voxel_shape": list(args.segmentation.voxel_shape),
+    }
+
+
+def gt_proxy_params(args, model: str):
+    """everything a model's ground truth proxy prediction depends on"""
+    params = {
+        **roi_params(args),
+        "model": model,
+        "diameter": list(args.model.diameter),
+        "use_anisotropy": args.model.use_anisotropy,
+    }
+
+    if model == "cellpose":
+        params["model_type"] = "nuclei"
+        params["channels"] = [list(c) for c in args.model.channels]
+    elif model in ["anystar", "anystar-gaussian", "anystar-spherical"]:
+        model_args = args.model[model.replace("-", "_")]
+        params["weights"] = _weights_stamp(
+            os.path.join(model_args.model_folder, model_args.model_name, model_args.weight_name)
+        )
+        params["prob_thresh"] = model_args.prob_thresh
+        params["nms_thresh"] = model_args.nms_thresh
+        params["model_scale"] = list(args.model.scale)
+    else:
+        raise NotImplementedError(
+            f"{model} not implemented, choose one of [cellpose, anystar, anystar-gaussian, anystar-spherical]"
+        )
+
+    return params
+
+
+def gt_proxy_key(params: dict):
+    """stable hash of ground truth proxy parameters"""
+    return params_key(params)
+
+
+class GTProxyCache:
+    """directory of `<key>.tiff` ground truth proxies, with their parameters in `<key>.json`"""
+
+    def __init__(self, cache_dir: Optional[str] = None):
+        self.cache_dir = os.path.expanduser(cache_dir or DEFAULT_CACHE_DIR)
+
+    def path(self, key: str):
+        return os.path.join(self.cache_dir, f"{key}.tiff")
+
+    def __contains__(self, key: str):
+        return os.path.exists(self.path(key))
+
+    def get(self, key: str):
+        """(memory-mapped) ground truth proxy of a key"""
+        if key not in self:
+            raise KeyError(f"no ground truth proxy for key {key} in {self.cache_dir}")
+        return open_volume(self.path(key))
+
+    def params(self, key: str):
+        with open(os.path.join(self.cache_dir, f"{key}.json")) as f:
+            return json.load(f)
+
+    def put(self, key: str, vol: np.ndarray, params: dict):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # write the volume under a temporary name, so interrupted runs don't leave a valid key
+        tmp_path = os.path.join(self.cache_dir, f"{key}.tmp.tiff")
+        write_volume(tmp_path, vol)
+        with open(os.path.join(self.cache_dir, f"{key}.json"), "w") as f:
+            json.dump(params, f, indent=2, sort_keys=True, default=str)
+        os.replace(tmp_path, self.path(key))
+
+
+def predict_gt_proxy(args, model: str, vol):
+    """predict a ground truth proxy over a whole roi (ie: without chunking)"""
+    anisotropy = (
+        args.model.diameter[0] / args.model.diameter[1]
+        if args.model.use_anisotropy
+        else None
+    )
+    vol = np.asarray(vol)
+
+    if model == "cellpose":
+        from lsm.distributed.model_cache import load_cellpose
+
+        gt_proxy, _, _, _ = load_cellpose("nuclei").eval(
+            vol,
+            channels=args.model.channels,
+            z_axis=0,
+            channel_axis=3,
+            diameter=args.model.diameter[1],
+            do_3D=True,
+            anisotropy=anisotropy,
+            augment=True,
+            tile=True,
+        )
+    elif model in ["anystar", "anystar-gaussian", "anystar-spherical"]:
+        from lsm.distributed.model_cache import load_stardist
+        from lsm.distributed.segment_steerable import _normalize_chunk
+
+        model_args = args.model[model.replace("-", "_")]
+        stardist = load_stardist(
+            model_args.model_name, model_args.model_folder, model_args.weight_name
+        )
+        gt_proxy, _ = stardist.predict_instances(
+            _normalize_chunk(vol),
+            prob_thresh=model_args.prob_thresh,
+            nms_thresh=model_args.nms_thresh,
+            n_tiles=None,
+            scale=args.model.scale,
+        )
+    else:
+        raise NotImplementedError(
+            f"{model} not implemented, choose one of [cellpose, anystar, anystar-gaussian, anystar-spherical]"
+        )
+
+    return gt_proxy
+
+
+def get_gt_proxy(args, model: str, vol, cache: GTProxyCache):
+    """key of a model's ground truth proxy, which is only predicted if it isn't cached yet"""
+    params = gt_proxy_params(args, model)
+    key = gt_proxy_key(params)
+
+    if key in cache:
+        print(f"Reusing cached ground truth proxy {key} (model: {model})")
+    else:
+        print(f"Saving ground truth proxy {key} for stitching analysis (model: {model})")
+        cache.put(key, predict_gt_proxy(args, model, vol), params)
+
+    return key
+
+
+def write_gt_proxy_key(save_dir: str, key: str):
+    """record the ground truth proxy key of an experiment, for analyses"""
+    with open(os.path.join(save_dir, "gt_proxy.key"), "w") as f:
+        f.write(key)
+
+
+def read_gt_proxy_key(save_dir: str):
+    path = os.path.join(save_dir, "gt_proxy.key")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def find_gt_proxy(
+    save_dir: str, cache_dir: Optional[str] = None, key: Optional[str] = None
+):
+    """
+    path of an experiment's ground truth proxy: looked up by `key` (or the key
+    recorded in `save_dir`) in the cache, falling back to a legacy
+    `gt_proxy.tiff` in `save_dir`. returns None if there is none
+    """
+    cache = GTProxyCache(cache_dir)
+    key = key or read_gt_proxy_key(save_dir)
+    if key is not None and key in cache:
+        return cache.path(key)
+
+    legacy_path = os.path.join(save_dir, "gt_proxy.tiff")
+    return legacy_path if os.path.exists(legacy_path) else None
@@ -0,0 +1,46 @@
+"""
+keep segmentation models warm across chunks, runs and server jobs
+"""
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def load_cellpose(model_type: str = "nuclei", gpu: bool = True):
+    """load a cellpose model once per process and reuse it for every chunk"""
+    from cellpose import models
+
+    return models.Cellpose(gpu=gpu, model_type=model_type)
+
+
+@functools.lru_cache(maxsize=None)
+def load_stardist(model_name: str, model_folder: str, weight_name: str):
+    """load a (frozen) stardist-based model once per process, keyed by its weights"""
+    from stardist.models import StarDist3D
+
+    model = StarDist3D(None, name=model_name, basedir=model_folder)
+    model.load_weights(name=weight_name)
+    model.trainable = False
+    model.keras_model.trainable = False
+
+    return model
+
+
+def warm_models(cfg_dicts: dict):
+    """load every configured model up front, so the first job doesn't pay for it"""
+    for model, cfg_dict in cfg_dicts.items():
+        if model == "cellpose":
+            load_cellpose(cfg_dict.get("model_type", "nuclei"))
+        elif model in ["anystar", "anystar-gaussian", "anystar-spherical"]:
+            load_stardist(
+                cfg_dict["model_name"], cfg_dict["model_folder"], cfg_dict["weight_name"]
+            )
+        else:
+            raise NotImplementedError(
+                f"{model} not implemented, choose one of [cellpose, anystar, anystar-gaussian, anystar-spherical]"
+            )
+
+
+def clear_models():
+    """drop all cached models (eg: to free GPU memory)"""
+    load_cellpose.cache_clear()
+    load_stardist.cache_clear()
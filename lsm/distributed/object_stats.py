@@ -0,0 +1,132 @@
+"""
+per-object statistics (voxel count, centroid, bounding box), accumulated
+as moments while blocks are labeled, and merged through the final relabeling
+"""
+import numpy as np
+import pandas as pd
+from typing import Optional, List, Tuple
+
+AXES = ["z", "y", "x"]
+MOMENT_COLUMNS = (
+    ["label", "count"]
+    + [f"sum_{ax}" for ax in AXES]
+    + [f"min_{ax}" for ax in AXES]
+    + [f"max_{ax}" for ax in AXES]
+)
+
+
+def block_moments(
+    block: np.ndarray,
+    origin: Tuple[int],
+    core: Optional[Tuple[slice]] = None,
+):
+    """count, coordinate sums and bounds of every label in (the core of) a block,
+    in global coordinates given the core's `origin`"""
+    block = np.asarray(block)
+    if core is not None:
+        block = block[core]
+
+    coords = np.stack(np.nonzero(block), axis=1)
+    if len(coords) == 0:
+        return pd.DataFrame({col: [] for col in MOMENT_COLUMNS}, dtype=np.int64)
+
+    labels = block[tuple(coords.T)]
+    order = np.argsort(labels, kind="stable")
+    labels, coords = labels[order], coords[order] + np.asarray(origin)
+
+    # segment boundaries of the sorted labels
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    counts = np.diff(np.r_[starts, len(labels)])
+    sums = np.add.reduceat(coords, starts, axis=0)
+    mins = np.minimum.reduceat(coords, starts, axis=0)
+    maxs = np.maximum.reduceat(coords, starts, axis=0)
+
+    return pd.DataFrame(
+        np.column_stack([labels[starts], counts, sums, mins, maxs]).astype(np.int64),
+        columns=MOMENT_COLUMNS,
+    )
+
+
+def merge_moments(moments: List[pd.DataFrame], labeling: Optional[np.ndarray] = None):
+    """merge per-block moments, after mapping block labels through `labeling`
+    (the `new_labeling[old] = new` table used to relabel the blocks)"""
+    moments = pd.concat(moments, ignore_index=True)
+    if labeling is not None:
+        moments["label"] = np.asarray(labeling)[moments["label"].values]
+    moments = moments[moments["label"] != 0]
+
+    aggregations = {"count": "sum"}
+    aggregations.update({f"sum_{ax}": "sum" for ax in AXES})
+    aggregations.update({f"min_{ax}": "min" for ax in AXES})
+    aggregations.update({f"max_{ax}": "max" for ax in AXES})
+
+    return moments.groupby("label", sort=True).agg(aggregations).reset_index()
+
+
+def object_table(moments: pd.DataFrame):
+    """per-object table of voxel count, centroid and (half-open) bounding box"""
+    table = pd.DataFrame(
+        {"label": moments["label"].values, "voxel_count": moments["count"].values}
+    )
+    for ax in AXES:
+        table[f"centroid_{ax}"] = moments[f"sum_{ax}"].values / moments["count"].values
+    for ax in AXES:
+        table[f"bbox_min_{ax}"] = moments[f"min_{ax}"].values
+    for ax in AXES:
+        table[f"bbox_max_{ax}"] = moments[f"max_{ax}"].values + 1
+
+    return table
+
+
+def merge_object_table(moments: List[pd.DataFrame], labeling: Optional[np.ndarray] = None):
+    return object_table(merge_moments(moments, labeling=labeling))
+
+
+def write_object_table(table: pd.DataFrame, path: str):
+    """write an object table as parquet (requires pyarrow)"""
+    table.to_parquet(path, index=False)
+
+
+def density_map(table: pd.DataFrame, shape: Tuple[int], cell_size: Tuple[int]):
+    """object (centroid) counts and mean object volume, per coarse (z, y, x) cell"""
+    grid = tuple(int(np.ceil(s / c)) for s, c in zip(shape, cell_size))
+    centroids = table[[f"centroid_{ax}" for ax in AXES]].values
+    cells = np.floor(centroids / np.asarray(cell_size)).astype(np.int64)
+    cells = np.clip(cells, 0, np.subtract(grid, 1))
+    flat = np.ravel_multi_index(tuple(cells.T), grid)
+
+    n_cells = int(np.prod(grid))
+    counts = np.bincount(flat, minlength=n_cells)
+    volume = np.bincount(flat, weights=table["voxel_count"].values, minlength=n_cells)
+    mean_volume = volume / np.maximum(counts, 1)
+
+    return (
+        counts.reshape(grid).astype(np.float32),
+        mean_volume.reshape(grid).astype(np.float32),
+    )
+
+
+def write_density_map(
+    path: str,
+    counts: np.ndarray,
+    mean_volume: np.ndarray,
+    cell_size: Tuple[int],
+    voxel_size: Optional[List[float]] = [1.0, 1.0, 1.0],
+):
+    """write a density map as a single scale, 2 channel (count, mean volume) ome-zarr image"""
+    import zarr
+    from ome_zarr.io import parse_url
+    from ome_zarr.writer import write_image
+
+    root = zarr.group(store=parse_url(path, mode="w").store)
+    scale = [1.0] + [float(c * v) for c, v in zip(cell_size, voxel_size)]
+    write_image(
+        image=np.stack([counts, mean_volume]),
+        group=root,
+        scaler=None,
+        axes="czyx",
+        coordinate_transformations=[[{"type": "scale", "scale": scale}]],
+    )
+    root.attrs["omero"] = {
+        "channels": [{"label": "count"}, {"label": "mean_volume"}],
+    }
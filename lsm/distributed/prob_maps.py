@@ -0,0 +1,146 @@
+"""
+stitch per-block network outputs (probability, flow/distance maps) into a
+global chunked map, by blending block overlaps with a smooth weight window
+"""
+import itertools
+import numpy as np
+from typing import List, Optional, Tuple
+
+import dask
+import dask.array as da
+from scipy import ndimage
+
+
+def resize_map(maps: np.ndarray, shape: Tuple[int]):
+    """resize (z, y, x, c) maps predicted on a subsampled grid back to a chunk's (z, y, x) shape"""
+    if maps.shape[:-1] == tuple(shape):
+        return maps
+    factors = [s / m for s, m in zip(shape, maps.shape[:-1])] + [1]
+    return ndimage.zoom(maps, factors, order=1, grid_mode=True, mode="nearest")
+
+
+def blend_weights(shape: Tuple[int], depth: Tuple[int]):
+    """
+    separable weight window of an overlapped block, ramping linearly across
+    the 2 * depth band around every block face. the ramps of adjacent blocks
+    sum to 1, so their overlaps cross-fade
+    """
+    weights = np.ones(shape, dtype=np.float32)
+    for ax, (n, d) in enumerate(zip(shape, depth)):
+        if d == 0:
+            continue
+        k = np.arange(n)
+        ramp = (np.minimum(k, n - 1 - k) + 0.5) / (2 * d)
+        ramp = np.clip(ramp, 1e-3, 1).astype(np.float32)
+        weights *= ramp.reshape([-1 if i == ax else 1 for i in range(len(shape))])
+    return weights
+
+
+def _blend_chunk(box, depth, origins, *blocks):
+    """weighted average of every overlapped block's maps, over a single output chunk"""
+    shape = tuple(b - a for a, b in box)
+    total, norm = None, np.zeros(shape, dtype=np.float32)
+
+    for origin, block in zip(origins, blocks):
+        block = np.asarray(block, dtype=np.float32)
+        weights = blend_weights(block.shape[:-1], depth)
+
+        # intersection of the block with the chunk, in chunk and block coordinates
+        lo = [max(a, o) for (a, _), o in zip(box, origin)]
+        hi = [min(b, o + n) for (_, b), o, n in zip(box, origin, block.shape)]
+        dst = tuple(slice(l - a, h - a) for l, h, (a, _) in zip(lo, hi, box))
+        src = tuple(slice(l - o, h - o) for l, h, o in zip(lo, hi, origin))
+
+        if total is None:
+            total = np.zeros(shape + block.shape[-1:], dtype=np.float32)
+        total[dst] += block[src] * weights[src][..., None]
+        norm[dst] += weights[src]
+
+    return total / np.maximum(norm, 1e-6)[..., None]
+
+
+def axis_extents(origins: np.ndarray, shapes: np.ndarray):
+    """
+    (start, stop) of the blocks of a grid along every axis. blocks are
+    separable (their extent along an axis only depends on their index along
+    it) and ordered, so both are increasing
+    """
+    extents = []
+    for ax, n in enumerate(origins.shape):
+        index = tuple(slice(None) if a == ax else 0 for a in range(origins.ndim))
+        lo = np.array([o[ax] for o in origins[index]])
+        hi = lo + np.array([s[ax] for s in shapes[index]])
+        extents.append((lo, hi))
+    return extents
+
+
+def overlapping(extents, box):
+    """grid indices of the blocks (of given `axis_extents`) that overlap a box"""
+    ranges = [
+        range(np.searchsorted(hi, a, side="right"), np.searchsorted(lo, b, side="left"))
+        for (lo, hi), (a, b) in zip(extents, box)
+    ]
+    return list(itertools.product(*ranges))
+
+
+def blend_blocks(
+    blocks: np.ndarray,
+    origins: np.ndarray,
+    shapes: np.ndarray,
+    chunks: Tuple[Tuple[int]],
+    depth: Tuple[int],
+    channels: int,
+):
+    """
+    blend a grid of (delayed) overlapped block maps into a (lazy) global map,
+    chunked like the original (non-overlapped) blocks.
+    `origins` and `shapes` hold the global (z, y, x) origin and the shape of
+    every overlapped block (origins are negative for blocks padded beyond the volume)
+    """
+    grid = blocks.shape
+    starts = [np.cumsum((0,) + c) for c in chunks]
+    extents = axis_extents(origins, shapes)
+    out = np.empty(grid, dtype=object)
+
+    for index in np.ndindex(*grid):
+        box = [(s[i], s[i + 1]) for s, i in zip(starts, index)]
+
+        # blocks can reach past their neighbours, when chunks are smaller than the depth
+        neighbours = overlapping(extents, box)
+
+        chunk = dask.delayed(_blend_chunk)(
+            box,
+            depth,
+            [origins[n] for n in neighbours],
+            *[blocks[n] for n in neighbours],
+        )
+        shape = tuple(b - a for a, b in box) + (channels,)
+        out[index] = da.from_delayed(chunk, shape=shape, dtype=np.float32)
+
+    # blocks are (z, y, x, c), so nest them once more, along the channel axis
+    def nest(blocks):
+        return [nest(b) for b in blocks] if isinstance(blocks, list) else [blocks]
+
+    return da.block(nest(out.tolist()))
+
+
+def write_maps(
+    maps: da.Array,
+    path: str,
+    chunks: Tuple[int] = (64, 64, 64),
+    channel_names: Optional[List[str]] = None,
+):
+    """
+    (lazily) store blended (z, y, x, c) maps as a chunked float16 zarr;
+    returns the delayed store, to compute alongside the labels
+    """
+    import zarr
+
+    maps = maps.astype(np.float16).rechunk(tuple(chunks) + (-1,))
+    store = zarr.open(
+        path, mode="w", shape=maps.shape, chunks=maps.chunksize, dtype=np.float16
+    )
+    if channel_names is not None:
+        store.attrs["channels"] = list(channel_names)
+
+    return da.store(maps, store, lock=False, compute=False)
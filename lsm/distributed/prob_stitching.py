@@ -0,0 +1,221 @@
+"""
+probability-space stitching: blend per-block network outputs (probability and
+distance maps) into a global map, and extract instances region by region from
+the blended map, instead of linking independently segmented blocks by IoU
+"""
+import time
+import numpy as np
+from tqdm import tqdm
+from typing import Callable, List, Optional
+
+import dask
+import dask.array as da
+
+from lsm.distributed.distributed_seg import (
+    as_delayed,
+    block_origin,
+    iter_blocks,
+    overlap_blocks,
+)
+from lsm.distributed.object_stats import (
+    block_moments,
+    density_map,
+    merge_object_table,
+)
+from lsm.distributed.prob_maps import axis_extents, blend_blocks, overlapping
+
+
+def predict_blocks(
+    image: dask.array,
+    predict_chunk: Callable,
+    chunk_kwargs: dict,
+    diameter: List[float],
+    map_channels: int,
+    chunk: Optional[int] = None,
+    boundary: Optional[str] = "reflect",
+    desc: Optional[str] = "lazy predicting chunks...",
+):
+    """
+    run a network over overlapped chunks, and blend their (z, y, x, c) output
+    maps into a (lazy) global map, chunked like the (non-overlapped) chunks.
+    `predict_chunk(chunk=..., index=..., **chunk_kwargs)` returns a chunk's maps
+    """
+    image, depth, core_chunks, core_origins = overlap_blocks(
+        image, diameter, chunk=chunk, boundary=boundary
+    )
+
+    grid = image.numblocks[:-1]
+    blocks = np.empty(grid, dtype=object)
+    origins = np.empty(grid, dtype=object)
+    shapes = np.empty(grid, dtype=object)
+
+    for index, input_block in tqdm(iter_blocks(image), desc=desc):
+        blocks[index[:-1]] = dask.delayed(predict_chunk)(
+            chunk=as_delayed(input_block), index=index, **chunk_kwargs
+        )
+        origins[index[:-1]] = block_origin(
+            index[:-1], depth, core_chunks, core_origins, boundary
+        )
+        shapes[index[:-1]] = input_block.shape[:-1]
+
+    return blend_blocks(blocks, origins, shapes, core_chunks, depth, map_channels)
+
+
+def _label_offsets(counts):
+    # label offset of every region: the number of instances of the regions before it
+    return np.concatenate([[0], np.cumsum(counts, dtype=np.int64)[:-1]])
+
+
+def _paste_chunk(box, origins, offsets, regions, *blocks):
+    """
+    labels of a single output chunk, from the (halo-extended) labels of every
+    region that reaches it (`regions` index into the label `offsets`). the
+    chunk's own region comes first, and the others only fill in its background
+    """
+    labels = np.zeros(tuple(b - a for a, b in box), dtype=np.int32)
+
+    for origin, region_id, block in zip(origins, regions, blocks):
+        offset = offsets[region_id]
+        lo = [max(a, o) for (a, _), o in zip(box, origin)]
+        hi = [min(b, o + n) for (_, b), o, n in zip(box, origin, block.shape)]
+        dst = tuple(slice(l - a, h - a) for l, h, (a, _) in zip(lo, hi, box))
+        src = tuple(slice(l - o, h - o) for l, h, o in zip(lo, hi, origin))
+
+        region = block[src]
+        fill = (labels[dst] == 0) & (region > 0)
+        labels[dst][fill] = region[fill] + offset
+
+    return labels
+
+
+def stitch_prob_maps(
+    maps: dask.array,
+    extract_instances: Callable,
+    extract_kwargs: dict,
+    halo: List[int],
+    object_stats: Optional[bool] = False,
+    density_cell: Optional[List[int]] = None,
+    desc: Optional[str] = "lazy extracting instances...",
+):
+    """
+    extract instances from blended (z, y, x, c) maps, chunk by chunk.
+    every chunk is extended by a small `halo`, and
+    `extract_instances(maps=..., core=..., **extract_kwargs)` returns the
+    labels of the instances centred in its `core` slices (rendered over the
+    whole region) and their number, so every instance is extracted (and
+    rendered whole) by exactly one region, and pasted into its neighbours.
+    returns the (lazy) labels, followed by a (delayed) per-object table if
+    `object_stats`, and (delayed) per-cell object counts and mean volumes
+    """
+    shape = maps.shape[:-1]
+    grid = maps.numblocks[:-1]
+    starts = [np.cumsum((0,) + c) for c in maps.chunks[:-1]]
+
+    regions = np.empty(grid, dtype=object)
+    origins = np.empty(grid, dtype=object)
+    shapes = np.empty(grid, dtype=object)
+    counts = []
+
+    for index in tqdm(np.ndindex(*grid), desc=desc):
+        box = [(s[i], s[i + 1]) for s, i in zip(starts, index)]
+        lo = [max(a - h, 0) for (a, _), h in zip(box, halo)]
+        hi = [min(b + h, n) for (_, b), h, n in zip(box, halo, shape)]
+
+        region = maps[tuple(slice(l, h) for l, h in zip(lo, hi))]
+        core = tuple(slice(a - l, b - l) for (a, b), l in zip(box, lo))
+        labels, n = dask.delayed(extract_instances, nout=2)(
+            maps=as_delayed(region), core=core, **extract_kwargs
+        )
+
+        regions[index] = labels
+        origins[index] = tuple(lo)
+        shapes[index] = tuple(h - l for l, h in zip(lo, hi))
+        counts.append(n)
+
+    # label offsets only depend on the (small) instance counts, summed in a single task
+    offsets = dask.delayed(_label_offsets)(counts)
+    # regions are separable and ordered along every axis, like overlapped blocks
+    extents = axis_extents(origins, shapes)
+
+    chunks = np.empty(grid, dtype=object)
+    moments = []
+    for index in np.ndindex(*grid):
+        box = [(s[i], s[i + 1]) for s, i in zip(starts, index)]
+
+        # own region first, then every other region that reaches the chunk
+        others = [other for other in overlapping(extents, box) if other != index]
+        neighbours = [index] + others
+
+        chunk = dask.delayed(_paste_chunk)(
+            box,
+            [origins[n] for n in neighbours],
+            offsets,
+            [np.ravel_multi_index(n, grid) for n in neighbours],
+            *[regions[n] for n in neighbours],
+        )
+        if object_stats or density_cell is not None:
+            origin = tuple(a for a, _ in box)
+            moments.append(dask.delayed(block_moments)(chunk, origin))
+
+        chunk_shape = tuple(b - a for a, b in box)
+        chunks[index] = da.from_delayed(chunk, shape=chunk_shape, dtype=np.int32)
+
+    outputs = (da.block(chunks.tolist()),)
+    if object_stats or density_cell is not None:
+        # chunks carry global labels already, so there is no relabeling table
+        table = dask.delayed(merge_object_table)(moments)
+    if object_stats:
+        outputs += (table,)
+    if density_cell is not None:
+        outputs += (dask.delayed(density_map, nout=2)(table, shape, density_cell),)
+
+    return outputs[0] if len(outputs) == 1 else outputs
+
+
+def benchmark_stitching(segment: Callable, cfg_dict: dict, chunks: List[int]):
+    """time iou-linked and probability-space stitching of the same volume, per chunk size"""
+    results = []
+    for chunk in chunks:
+        for mode in ["iou", "prob"]:
+            tic = time.time()
+            with dask.config.set(scheduler="synchronous"):
+                labels = segment(**cfg_dict, chunk=chunk, stitching=mode).compute()
+            toc = time.time() - tic
+
+            num_labels = len(np.unique(labels)) - 1
+            print(f"chunk: {chunk}, stitching: {mode}, {toc:.2f}s, {num_labels} labels")
+            results.append(
+                {"chunk": chunk, "stitching": mode, "time": toc, "num_labels": num_labels}
+            )
+
+    return results
+
+
+if __name__ == "__main__":
+    from ome_zarr.io import parse_url
+    from ome_zarr.reader import Reader
+
+    from lsm.distributed.segment_steerable import segment
+
+    url = "https://dandiarchive.s3.amazonaws.com/zarr/0bda7c93-58b3-4b94-9a83-453e1c370c24/"
+    reader = Reader(parse_url(url))
+    dask_data = list(reader())[0].data
+    vol_scale = np.transpose(dask_data[0][0], (1, 2, 3, 0))  # (c, z, y, x) -> (z, y, x, c)
+
+    chunk_size = 128
+    voxel = vol_scale[
+        1000 : 1000 + chunk_size, 650 : 650 + chunk_size, 3500 : 3500 + chunk_size
+    ]
+
+    benchmark_stitching(
+        segment,
+        cfg_dict={
+            "image": voxel,
+            "model_folder": "models",
+            "model_name": "anystar-mix",
+            "weight_name": "weights_best.h5",
+            "diameter": (7.5 * 4, 7.5, 7.5),
+            "iou_depth": 7,
+        },
+        chunks=[32, 64, 128],
+    )
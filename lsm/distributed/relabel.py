@@ -0,0 +1,106 @@
+"""
+compact the sparse label ids left by stitching to 1..N, and store them in
+the smallest unsigned dtype that fits N
+"""
+import os
+import numpy as np
+import pandas as pd
+from typing import Optional, Tuple
+
+import dask
+import dask.array as da
+
+from lsm.utils.io_util import open_volume
+
+
+def smallest_uint_dtype(max_label: int):
+    for dtype in [np.uint8, np.uint16, np.uint32, np.uint64]:
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f"{max_label} labels don't fit into 64 bits")
+
+
+def label_ids(labels):
+    """sorted, non-zero label ids, with a unique pass per block for dask arrays"""
+    if isinstance(labels, da.Array):
+        block_ids = [dask.delayed(np.unique)(b) for b in labels.to_delayed().ravel()]
+        ids = dask.delayed(lambda ids: np.unique(np.concatenate(ids)))(block_ids)
+        ids = ids.compute()
+    else:
+        ids = np.unique(labels)
+    return ids[ids != 0]
+
+
+def _relabel_block(block: np.ndarray, ids: np.ndarray, out_dtype: np.dtype):
+    # position of every label among the sorted ids, shifted to start at 1
+    pos = np.searchsorted(ids, block)
+    fg = block != 0
+    # labels missing from ids would silently take a neighbour's position
+    found = ids[np.minimum(pos, len(ids) - 1)] == block if len(ids) > 0 else ~fg
+    if np.any(fg & ~found):
+        missing = np.unique(block[fg & ~found])
+        raise ValueError(f"labels {missing[:10].tolist()} are missing from the label ids")
+
+    relabeled = (pos + 1).astype(out_dtype)
+    relabeled[~fg] = 0
+    return relabeled
+
+
+def relabel_sequential(labels, ids: Optional[np.ndarray] = None):
+    """
+    relabel a (numpy or dask) label volume to 1..N, in the order of `ids`
+    (eg: the labels of an object table); ids are computed if not given.
+    dask volumes are relabeled lazily, block by block.
+    returns the relabeled volume and the sorted ids, where `ids[i - 1]` is
+    the original id of new label i
+    """
+    ids = label_ids(labels) if ids is None else np.sort(np.asarray(ids))
+    dtype = smallest_uint_dtype(len(ids))
+
+    if isinstance(labels, da.Array):
+        relabeled = labels.map_blocks(_relabel_block, ids=ids, out_dtype=dtype, dtype=dtype, meta=np.array((), dtype=dtype))
+    else:
+        relabeled = _relabel_block(np.asarray(labels), ids=ids, out_dtype=dtype)
+
+    return relabeled, ids
+
+
+def relabel_table(table: pd.DataFrame, ids: np.ndarray):
+    """map an object table's labels to the new, sequential ones"""
+    table = table.copy()
+    table["label"] = np.searchsorted(ids, table["label"].values) + 1
+    return table
+
+
+def relabel_volume(
+    source: str,
+    dest: str,
+    chunks: Optional[Tuple[int]] = (64, 64, 64),
+    table_path: Optional[str] = None,
+):
+    """
+    stream a stitched label volume (zarr/tiff) into a sequentially relabeled,
+    shrunk dtype zarr, chunk by chunk. label ids come from the volume's object
+    table if given (saving a pass over the volume), and the relabeled table is
+    written next to `dest` (the source volume and table are left untouched)
+    """
+    if os.path.abspath(source) == os.path.abspath(dest):
+        raise ValueError(f"can't relabel {source} in place, choose another destination")
+
+    vol = open_volume(source)
+    labels = da.from_array(vol, chunks=chunks)
+
+    table = None
+    ids = None
+    if table_path is not None:
+        table = pd.read_parquet(table_path)
+        ids = table["label"].values
+
+    relabeled, ids = relabel_sequential(labels, ids=ids)
+    da.to_zarr(relabeled.rechunk(chunks), dest, overwrite=True)
+
+    if table is not None:
+        dest_table = os.path.splitext(dest.rstrip("/"))[0] + ".parquet"
+        relabel_table(table, ids).to_parquet(dest_table, index=False)
+
+    return len(ids), relabeled.dtype
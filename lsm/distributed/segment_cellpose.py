@@ -1,6 +1,4 @@
 import os
-import operator
-import functools
 import numpy as np
 from tqdm import tqdm
 from typing import Optional, Tuple, List
@@ -9,10 +7,14 @@ import dask
 import dask.array as da
 from dask.diagnostics import ProgressBar
 
-from cellpose import models
-
 from lsm.processing.normalize import normalize_image
-from lsm.distributed.distributed_seg import link_labels
+from lsm.distributed.model_cache import load_cellpose
+from lsm.distributed.distributed_seg import segment_blocks
+from lsm.distributed.prob_maps import resize_map
+
+
+# channels of cellpose's output maps
+CELLPOSE_MAPS = ["prob", "flow_z", "flow_y", "flow_x"]
 
 
 def segment(
@@ -26,135 +28,37 @@ def segment(
     use_anisotropy: Optional[bool] = True,
     iou_depth: Optional[int] = 2,
     iou_threshold: Optional[float] = 0.7,
+    object_stats: Optional[bool] = False,
+    density_cell: Optional[List[int]] = None,
+    return_maps: Optional[bool] = False,
+    flow_cache: Optional[str] = None,
 ):
 
     diameter_yx = diameter[1]
     anisotropy = diameter[0] / diameter[1] if use_anisotropy else None
 
-    image = da.asarray(image)
-
-    # for re-chunking/stitching analyses
-    if chunk is None:
-        image = image.rechunk({-1: -1})
-    else:
-        image = image.rechunk({0: chunk, 1: chunk, 2: chunk, 3: -1})
-
-    # define depth for stitching voxel blocks
-    depth = tuple(np.ceil(diameter).astype(np.int64))
-
-    # boundary condition options for chunked dask arrays
-    boundary = boundary
-
-    # no chunking along channel direction
-    image = da.overlap.overlap(image, depth + (0,), boundary)
-
-    block_iter = zip(
-        np.ndindex(*image.numblocks),
-        map(
-            functools.partial(operator.getitem, image),
-            da.core.slices_from_chunks(image.chunks),
-        ),
+    return segment_blocks(
+        image=image,
+        segment_chunk=segment_cellpose_chunk,
+        chunk_kwargs={
+            "channels": channels,
+            "model_type": model_type,
+            "diameter_yx": diameter_yx,
+            "anisotropy": anisotropy,
+            "flow_cache": flow_cache,
+        },
+        diameter=diameter,
+        chunk=chunk,
+        boundary=boundary,
+        iou_depth=iou_depth,
+        iou_threshold=iou_threshold,
+        debug=debug,
+        object_stats=object_stats,
+        density_cell=density_cell,
+        map_channels=len(CELLPOSE_MAPS) if return_maps else None,
+        desc="lazy computing chunks using cellpose...",
     )
 
-    labeled_blocks = np.empty(image.numblocks[:-1], dtype=object)
-    # initialize empty "grid" for chunks
-    if debug:
-        unlabeled_blocks = np.empty(image.numblocks[:-1], dtype=object)
-
-    total = None
-    for index, input_block in tqdm(
-        block_iter, desc="lazy computing chunks using cellpose..."
-    ):
-
-        labeled_block, n = dask.delayed(segment_cellpose_chunk, nout=2)(
-            chunk=input_block,
-            index=index,
-            channels=channels,
-            model_type=model_type,
-            diameter_yx=diameter_yx,
-            anisotropy=anisotropy,
-        )
-
-        shape = input_block.shape[:-1]
-        labeled_block = da.from_delayed(labeled_block, shape=shape, dtype=np.int32)
-
-        n = dask.delayed(np.int32)(n)
-        n = da.from_delayed(n, shape=(), dtype=np.int32)
-
-        total = n if total is None else total + n
-
-        block_label_offset = da.where(labeled_block > 0, total, np.int32(0))
-        labeled_block += block_label_offset
-
-        labeled_blocks[index[:-1]] = labeled_block
-        total += n
-        # print(f"labeled shape: {labeled_block.shape}")
-
-        if debug:
-            # do the same thing, but assign the same label to *every* chunk
-            # here, we change the image to be 4D, to account for a newly
-            # introduced color channel
-            unlabeled_block = labeled_block
-            colored_chunk = unlabeled_block.copy()
-            nz_mask = (unlabeled_block != 0).astype(
-                np.int32
-            )  # find non-zero pixel locations
-            colored_chunk = np.zeros(
-                unlabeled_block.shape + (3,), dtype=np.int32
-            )  # add a color channel
-            color = np.random.randint(0, 256, size=(3,))
-            colored_chunk[nz_mask] = color
-            # unlabeled_block[nz_indices + (slice(None),)] = random_colors
-            # print(f"colored chunk: {colored_chunk.shape}")
-            unlabeled_blocks[index[:-1]] = colored_chunk
-
-    # put all blocks together
-    block_labeled = da.block(labeled_blocks.tolist())
-
-    if debug:
-        block_unlabeled = da.block(unlabeled_blocks.tolist())
-
-    depth = da.overlap.coerce_depth(len(depth), depth)
-
-    if np.prod(block_labeled.numblocks) > 1:
-        iou_depth = da.overlap.coerce_depth(len(depth), iou_depth)
-
-        if any(iou_depth[ax] > depth[ax] for ax in depth.keys()):
-            raise Exception
-
-        trim_depth = {k: depth[k] - iou_depth[k] for k in depth.keys()}
-        block_labeled = da.overlap.trim_internal(
-            block_labeled, trim_depth, boundary=boundary
-        )
-
-        # trim excess, due to reflections
-        if debug:
-            block_unlabeled = da.overlap.trim_internal(
-                block_unlabeled, trim_depth, boundary=boundary
-            )
-
-        block_labeled = link_labels(
-            block_labeled, total, iou_depth, iou_threshold=iou_threshold
-        )
-
-        block_labeled = da.overlap.trim_internal(
-            block_labeled, iou_depth, boundary=boundary
-        )
-
-    else:
-        block_labeled = da.overlap.trim_internal(
-            block_labeled, depth, boundary=boundary
-        )
-        if debug:
-            block_unlabeled = da.overlap.trim_internal(
-                block_unlabeled, depth, boundary=boundary
-            )
-
-    if debug:
-        return block_labeled, block_unlabeled
-
-    return block_labeled
-
 
 def segment_cellpose_chunk(
     chunk: dask.array,
@@ -163,12 +67,15 @@ def segment_cellpose_chunk(
     model_type: Optional[str] = "nuclei",
     diameter_yx: Optional[float] = 7.5,
     anisotropy: Optional[float] = 4,
+    return_maps: Optional[bool] = False,
+    flow_cache: Optional[str] = None,
 ):
     np.random.seed(index)
 
-    model = models.Cellpose(gpu=True, model_type=model_type)
+    # cached per process, so only the first chunk pays for loading weights
+    model = load_cellpose(model_type)
 
-    seg, _, _, _ = model.eval(
+    seg, flows, _, _ = model.eval(
         chunk,
         channels=channels,
         z_axis=0,
@@ -180,9 +87,113 @@ def segment_cellpose_chunk(
         tile=True,
     )
 
+    if flow_cache is not None:
+        # same number of dynamics iterations as model.eval (for resampled 3d inputs)
+        niter = int(200 * diameter_yx / model.diam_mean)
+        save_flows(flow_cache, index, flows, niter)
+
+    if return_maps:
+        return seg.astype(np.int32), seg.max(), cellpose_maps(flows, chunk.shape[:-1])
+
     return seg.astype(np.int32), seg.max()
 
 
+def _flow_path(flow_cache: str, index: Tuple[int]):
+    return os.path.join(flow_cache, "block_" + "_".join(str(i) for i in index[:3]) + ".npz")
+
+
+def save_flows(flow_cache: str, index: Tuple[int], flows: List[np.ndarray], niter: int):
+    """persist a block's 3d flows and cell probability (logits), to recompute masks later"""
+    os.makedirs(flow_cache, exist_ok=True)
+    np.savez_compressed(
+        _flow_path(flow_cache, index),
+        dP=flows[1].astype(np.float32),
+        cellprob=flows[2].astype(np.float32),
+        niter=niter,
+    )
+
+
+def postprocess_cellpose_chunk(
+    chunk: dask.array,
+    index: Optional[int],
+    flow_cache: str,
+    flow_threshold: Optional[float] = 0.4,
+    cellprob_threshold: Optional[float] = 0.0,
+    min_size: Optional[int] = 15,
+):
+    """recompute a block's masks from its cached flows, without running the network"""
+    from cellpose import dynamics
+
+    cached = np.load(_flow_path(flow_cache, index))
+    seg, _ = dynamics.resize_and_compute_masks(
+        cached["dP"],
+        cached["cellprob"],
+        niter=int(cached["niter"]),
+        cellprob_threshold=cellprob_threshold,
+        flow_threshold=flow_threshold,
+        interp=True,
+        do_3D=True,
+        min_size=min_size,
+        resize=None,
+    )
+
+    return seg.astype(np.int32), seg.max()
+
+
+def postprocess(
+    image: dask.array,
+    flow_cache: str,
+    flow_threshold: Optional[float] = 0.4,
+    cellprob_threshold: Optional[float] = 0.0,
+    min_size: Optional[int] = 15,
+    boundary: Optional[str] = "reflect",
+    diameter: List[float] = None,
+    chunk: Optional[int] = None,
+    iou_depth: Optional[int] = 2,
+    iou_threshold: Optional[float] = 0.7,
+    object_stats: Optional[bool] = False,
+    density_cell: Optional[List[int]] = None,
+):
+    """
+    post-processing only mode: segment (and stitch) an image from the flows
+    cached by `segment(..., flow_cache=...)` with the same chunk size, so
+    mask parameters can be explored without re-running the network.
+    note that cellpose ignores `flow_threshold` for 3d masks
+    """
+    # only the block grid matters, image voxels are never read
+    blank = da.zeros(image.shape, dtype=np.uint8, chunks=image.chunks)
+
+    return segment_blocks(
+        image=blank,
+        segment_chunk=postprocess_cellpose_chunk,
+        chunk_kwargs={
+            "flow_cache": flow_cache,
+            "flow_threshold": flow_threshold,
+            "cellprob_threshold": cellprob_threshold,
+            "min_size": min_size,
+        },
+        diameter=diameter,
+        chunk=chunk,
+        boundary=boundary,
+        iou_depth=iou_depth,
+        iou_threshold=iou_threshold,
+        object_stats=object_stats,
+        density_cell=density_cell,
+        desc="lazy post-processing cached cellpose flows...",
+    )
+
+
+def cellpose_maps(flows: List[np.ndarray], shape: Tuple[int]):
+    """
+    stack cellpose's cell probability (as a probability) and 3d flows, as
+    (z, y, x, 4) maps, see `CELLPOSE_MAPS`
+    """
+    dP, cellprob = flows[1], flows[2]
+    prob = 1 / (1 + np.exp(-cellprob))
+    maps = np.concatenate([prob[None], dP], axis=0)
+    return resize_map(np.moveaxis(maps, 0, -1).astype(np.float32), shape)
+
+
 if __name__ == "__main__":
     from ome_zarr.io import parse_url
     from ome_zarr.reader import Reader
@@ -1,6 +1,4 @@
 import os
-import operator
-import functools
 import numpy as np
 from tqdm import tqdm
 from typing import Optional, Tuple, List
@@ -9,9 +7,16 @@ import dask
 import dask.array as da
 from dask.diagnostics import ProgressBar
 
+from scipy import ndimage
 from stardist.models import StarDist3D
+from stardist.nms import non_maximum_suppression_3d
+from stardist.rays3d import rays_from_json
+from stardist.geometry import polyhedron_to_label
 
-from lsm.distributed.distributed_seg import link_labels
+from lsm.distributed.model_cache import load_stardist
+from lsm.distributed.distributed_seg import segment_blocks
+from lsm.distributed.prob_maps import resize_map
+from lsm.distributed.prob_stitching import predict_blocks, stitch_prob_maps
 
 
 def segment(
@@ -29,137 +34,218 @@ def segment(
     use_anisotropy: Optional[bool] = True,
     iou_depth: Optional[int] = 2,
     iou_threshold: Optional[float] = 0.7,
+    object_stats: Optional[bool] = False,
+    density_cell: Optional[List[int]] = None,
+    return_maps: Optional[bool] = False,
+    stitching: Optional[str] = "iou",
+    halo: Optional[List[int]] = None,
 ):
 
     diameter_yx = diameter[1]
     anisotropy = diameter[0] / diameter[1] if use_anisotropy else None
 
-    image = da.asarray(image)
-
-    # for re-chunking/stitching analyses
-    if chunk is None:
-        image = image.rechunk({-1: -1})
-    else:
-        image = image.rechunk({0: chunk, 1: chunk, 2: chunk, 3: -1})
-
-    # define depth for stitching voxel blocks
-    depth = tuple(np.ceil(diameter).astype(np.int64))
-
-    # boundary condition options for chunked dask arrays
-    boundary = boundary
-
-    # no chunking along channel direction
-    image = da.overlap.overlap(image, depth + (0,), boundary)
-
-    block_iter = zip(
-        np.ndindex(*image.numblocks),
-        map(
-            functools.partial(operator.getitem, image),
-            da.core.slices_from_chunks(image.chunks),
-        ),
-    )
-
-    labeled_blocks = np.empty(image.numblocks[:-1], dtype=object)
-    # initialize empty "grid" for chunks
-    if debug:
-        unlabeled_blocks = np.empty(image.numblocks[:-1], dtype=object)
-
-    total = None
-
-    for index, input_block in tqdm(
-        block_iter, desc="lazy computing chunks using anystar..."
-    ):
-
-        labeled_block, n = dask.delayed(segment_anystar_chunk, nout=2)(
-            chunk=input_block,
-            index=index,
-            scale=scale,
-            prob_thresh=prob_thresh,
-            nms_thresh=nms_thresh,
-            model_name=model_name,
+    if stitching == "prob":
+        return segment_prob(
+            image=image,
             model_folder=model_folder,
+            model_name=model_name,
             weight_name=weight_name,
-            diameter_yx=diameter_yx,
-            anisotropy=anisotropy,
+            prob_thresh=prob_thresh,
+            nms_thresh=nms_thresh,
+            scale=scale,
+            boundary=boundary,
+            diameter=diameter,
+            chunk=chunk,
+            halo=halo,
+            object_stats=object_stats,
+            density_cell=density_cell,
+            return_maps=return_maps,
+        )
+    elif stitching != "iou":
+        raise NotImplementedError(
+            f"{stitching} stitching not implemented, choose one of [iou, prob]"
         )
 
-        shape = input_block.shape[:-1]
-        labeled_block = da.from_delayed(labeled_block, shape=shape, dtype=np.int32)
+    return segment_blocks(
+        image=image,
+        segment_chunk=segment_anystar_chunk,
+        chunk_kwargs={
+            "scale": scale,
+            "prob_thresh": prob_thresh,
+            "nms_thresh": nms_thresh,
+            "model_name": model_name,
+            "model_folder": model_folder,
+            "weight_name": weight_name,
+            "diameter_yx": diameter_yx,
+            "anisotropy": anisotropy,
+            "normalized": True,
+        },
+        diameter=diameter,
+        chunk=chunk,
+        boundary=boundary,
+        iou_depth=iou_depth,
+        iou_threshold=iou_threshold,
+        debug=debug,
+        object_stats=object_stats,
+        density_cell=density_cell,
+        map_channels=(
+            len(stardist_map_names(model_name, model_folder, weight_name))
+            if return_maps
+            else None
+        ),
+        # shared by all stardist-based models, when computed together
+        preprocess=_normalize_chunk,
+        desc="lazy computing chunks using anystar...",
+    )
 
-        n = dask.delayed(np.int32)(n)
-        n = da.from_delayed(n, shape=(), dtype=np.int32)
 
-        total = n if total is None else total + n
+def segment_prob(
+    image: dask.array,
+    model_folder: str,
+    model_name: str,
+    weight_name: str,
+    prob_thresh: float = 0.67,
+    nms_thresh: float = 0.3,
+    scale: List[float] = [1.0, 1.0, 1.0],
+    boundary: Optional[str] = "reflect",
+    diameter: List[float] = None,
+    chunk: Optional[int] = None,
+    halo: Optional[List[int]] = None,
+    object_stats: Optional[bool] = False,
+    density_cell: Optional[List[int]] = None,
+    return_maps: Optional[bool] = False,
+):
+    """
+    probability-space stitching: blend the prob/dist maps of overlapped
+    chunks into a global map, and run nms on it chunk by chunk (with small
+    halos), so instances are extracted once, without seams
+    """
+    model_kwargs = {
+        "model_name": model_name,
+        "model_folder": model_folder,
+        "weight_name": weight_name,
+    }
+    map_names = stardist_map_names(**model_kwargs)
+
+    maps = predict_blocks(
+        image=image,
+        predict_chunk=predict_anystar_chunk,
+        chunk_kwargs={"scale": scale, **model_kwargs},
+        diameter=diameter,
+        map_channels=len(map_names),
+        chunk=chunk,
+        boundary=boundary,
+        desc="lazy predicting chunks using anystar...",
+    )
 
-        block_label_offset = da.where(labeled_block > 0, total, np.int32(0))
-        labeled_block += block_label_offset
+    # instances centred in a chunk are rendered whole, if the halo covers their radius
+    if halo is None:
+        halo = tuple(int(np.ceil(d / 2)) + 1 for d in diameter)
+
+    outputs = stitch_prob_maps(
+        maps,
+        extract_instances=extract_anystar_instances,
+        extract_kwargs={
+            "prob_thresh": prob_thresh,
+            "nms_thresh": nms_thresh,
+            "ray_scale": scale,
+            **stardist_geometry(**model_kwargs),
+        },
+        halo=halo,
+        object_stats=object_stats,
+        density_cell=density_cell,
+    )
 
-        labeled_blocks[index[:-1]] = labeled_block
-        total += n
-        # print(f"labeled shape: {labeled_block.shape}")
+    if return_maps:
+        outputs = (outputs if isinstance(outputs, tuple) else (outputs,)) + (maps,)
 
-        if debug:
-            # do the same thing, but assign the same label to *every* chunk
-            # here, we change the image to be 4D, to account for a newly
-            # introduced color channel
-            unlabeled_block = labeled_block
-            colored_chunk = unlabeled_block.copy()
-            nz_mask = (unlabeled_block != 0).astype(
-                np.int32
-            )  # find non-zero pixel locations
-            colored_chunk = np.zeros(
-                unlabeled_block.shape + (3,), dtype=np.int32
-            )  # add a color channel
-            color = np.random.randint(0, 256, size=(3,))
-            colored_chunk[nz_mask] = color
-            unlabeled_blocks[index[:-1]] = colored_chunk
+    return outputs
 
-    # put all blocks together
-    block_labeled = da.block(labeled_blocks.tolist())
 
-    if debug:
-        block_unlabeled = da.block(unlabeled_blocks.tolist())
+def _normalize_chunk(chunk: np.ndarray):
+    # normalize chunk to [0, 1] before running inference
+    upper = np.percentile(chunk, 99.9)
+    chunk = np.clip(chunk, 0, upper)
+    chunk = (chunk - chunk.min()) / (chunk.max() - chunk.min())
+    return chunk[..., 0]
 
-    depth = da.overlap.coerce_depth(len(depth), depth)
 
-    if np.prod(block_labeled.numblocks) > 1:
-        iou_depth = da.overlap.coerce_depth(len(depth), iou_depth)
+def predict_anystar_chunk(
+    chunk: dask.array,
+    index: Optional[int],
+    model_folder: str,
+    model_name: str,
+    weight_name: str,
+    scale: List[float],
+):
+    """
+    (z, y, x, 1 + n_rays) object probability and ray distance maps of a chunk.
+    the network runs on the chunk zoomed by `scale`, so ray distances are in
+    zoomed voxels (see `ray_scale` of `extract_anystar_instances`)
+    """
+    model = load_stardist(model_name, model_folder, weight_name)
 
-        if any(iou_depth[ax] > depth[ax] for ax in depth.keys()):
-            raise Exception
+    chunk = _normalize_chunk(chunk)
+    shape = chunk.shape
+    if any(s != 1 for s in scale):
+        chunk = ndimage.zoom(chunk, scale, order=1)
 
-        trim_depth = {k: depth[k] - iou_depth[k] for k in depth.keys()}
-        block_labeled = da.overlap.trim_internal(
-            block_labeled, trim_depth, boundary=boundary
-        )
+    prob, dist = model.predict(chunk, n_tiles=None)
+    maps = np.concatenate([prob[..., None], dist], axis=-1).astype(np.float32)
 
-        # trim excess, due to reflections
-        if debug:
-            block_unlabeled = da.overlap.trim_internal(
-                block_unlabeled, trim_depth, boundary=boundary
-            )
+    return resize_map(maps, shape)
 
-        block_labeled = link_labels(
-            block_labeled, total, iou_depth, iou_threshold=iou_threshold
-        )
 
-        block_labeled = da.overlap.trim_internal(
-            block_labeled, iou_depth, boundary=boundary
-        )
+def stardist_geometry(model_name: str, model_folder: str, weight_name: str):
+    """rays and prediction grid of a stardist-based model, all that nms needs from it"""
+    model = load_stardist(model_name, model_folder, weight_name)
+    return {"rays_json": model.config.rays_json, "grid": tuple(model.config.grid)}
 
-    else:
-        block_labeled = da.overlap.trim_internal(
-            block_labeled, depth, boundary=boundary
-        )
-        if debug:
-            block_unlabeled = da.overlap.trim_internal(
-                block_unlabeled, depth, boundary=boundary
-            )
 
-    if debug:
-        return block_labeled, block_unlabeled
+def extract_anystar_instances(
+    maps: np.ndarray,
+    core: Tuple[slice],
+    rays_json: dict,
+    grid: Tuple[int],
+    prob_thresh: float,
+    nms_thresh: float,
+    ray_scale: Optional[List[float]] = None,
+):
+    """
+    nms on a region of blended prob/dist maps, keeping the instances centred
+    in its `core`, rendered over the whole region. only needs the model's
+    geometry (see `stardist_geometry`), not the model itself.
+    maps predicted on chunks zoomed by `ray_scale` hold distances in zoomed
+    voxels: rays are scaled back by its inverse (as stardist does for `scale`),
+    so nms and rendering happen in the maps' (unzoomed) voxels
+    """
+    rays = rays_from_json(rays_json)
+    if ray_scale is not None and any(s != 1 for s in ray_scale):
+        rays = rays.copy(scale=tuple(1 / s for s in ray_scale))
+
+    # back to the model's (subsampled) grid
+    maps = np.asarray(maps, dtype=np.float32)
+    sub = tuple(slice(None, None, g) for g in grid)
+    prob = maps[sub + (0,)]
+    dist = np.maximum(1e-3, maps[sub + (slice(1, None),)])
+
+    points, probi, disti = non_maximum_suppression_3d(
+        dist, prob, rays, grid=grid, prob_thresh=prob_thresh, nms_thresh=nms_thresh
+    )
+    keep = np.all(
+        [(p >= c.start) & (p < c.stop) for p, c in zip(points.T, core)], axis=0
+    )
 
-    return block_labeled
+    labels = polyhedron_to_label(
+        disti[keep],
+        points[keep],
+        rays=rays,
+        prob=probi[keep],
+        shape=maps.shape[:-1],
+        verbose=False,
+    )
+
+    return labels.astype(np.int32), int(keep.sum())
 
 
 def segment_anystar_chunk(
@@ -173,32 +259,43 @@ def segment_anystar_chunk(
     scale: List[float],
     diameter_yx: Optional[float] = 7.5,
     anisotropy: Optional[float] = 4,
+    return_maps: Optional[bool] = False,
+    normalized: Optional[bool] = False,
 ):
     np.random.seed(index)
 
-    model = StarDist3D(None, name=model_name, basedir=model_folder)
-    model.load_weights(name=weight_name)
-    model.trainable = False
-    model.keras_model.trainable = False
+    # cached per process, so only the first chunk pays for loading weights
+    model = load_stardist(model_name, model_folder, weight_name)
 
-    # normalize chunk to [0, 1] before running inference
-    upper = np.percentile(chunk, 99.9)
-    chunk = np.clip(chunk, 0, upper)
-    chunk = (chunk - chunk.min()) / (chunk.max() - chunk.min())
-    chunk = chunk[..., 0]
+    if not normalized:
+        chunk = _normalize_chunk(chunk)
 
     print(f"tiling with stardist-based model...")
-    seg, _ = model.predict_instances(
+    outputs = model.predict_instances(
         chunk,
         prob_thresh=prob_thresh,
         nms_thresh=nms_thresh,
         n_tiles=chunk.shape,
         scale=scale,
+        return_predict=return_maps,
     )
 
+    if return_maps:
+        (seg, _), (prob, dist) = outputs
+        # prob/dist are predicted on the model's (subsampled) grid
+        maps = np.concatenate([prob[..., None], dist], axis=-1).astype(np.float32)
+        return seg.astype(np.int32), seg.max(), resize_map(maps, chunk.shape)
+
+    seg, _ = outputs
     return seg.astype(np.int32), seg.max()
 
 
+def stardist_map_names(model_name: str, model_folder: str, weight_name: str):
+    """channels of a stardist-based model's output maps: object probability and ray distances"""
+    model = load_stardist(model_name, model_folder, weight_name)
+    return ["prob"] + [f"dist_{i}" for i in range(model.config.n_rays)]
+
+
 if __name__ == "__main__":
     from ome_zarr.io import parse_url
     from ome_zarr.reader import Reader
@@ -0,0 +1,382 @@
+"""
+long-running segmentation service that keeps configured models warm,
+and runs segmentation jobs (roi, model, parameters) submitted over http
+"""
+import io
+import json
+import time
+import uuid
+import queue
+import threading
+import numpy as np
+from collections import OrderedDict, deque
+from typing import Optional, List
+from urllib import request as urlrequest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dask
+
+from lsm.utils.console_log import log
+from lsm.utils.io_util import write_volume
+from lsm.distributed.model_cache import warm_models
+from lsm.distributed import get_model, get_segment_config
+
+
+# segment config keys set by the server itself, which job params can't override
+RESERVED_PARAMS = ["image", "chunk", "debug"]
+
+
+class SegmentationJob:
+    def __init__(
+        self,
+        model: str,
+        roi: List[List[int]],
+        params: Optional[dict] = None,
+        output: Optional[str] = None,
+    ):
+        self.job_id = uuid.uuid4().hex
+        self.model = model
+        self.roi = roi
+        self.params = params if params is not None else {}
+        self.output = output
+
+        self.status = "queued"
+        self.error = None
+        self.labels = None
+
+        # timestamps for latency reports
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "model": self.model,
+            "roi": self.roi,
+            "params": self.params,
+            "output": self.output,
+            "status": self.status,
+            "error": self.error,
+            "wait_time": None if self.started is None else self.started - self.submitted,
+            "run_time": None if self.finished is None else self.finished - self.started,
+        }
+
+
+class SegmentationServer:
+    """
+    a single worker thread runs jobs one at a time (models share the GPU),
+    while http handler threads only enqueue jobs and report on them
+    """
+
+    def __init__(
+        self,
+        args,
+        volume: dask.array,
+        models: List[str],
+        host: Optional[str] = "127.0.0.1",
+        port: Optional[int] = 8765,
+        max_jobs: Optional[int] = 256,
+        latency_window: Optional[int] = 256,
+    ):
+        self.args = args
+        self.volume = volume  # lazy (z, y, x, c) volume, rois index into this
+        self.models = list(models)
+        self.host = host
+        self.port = port
+        self.max_jobs = max_jobs
+
+        self.jobs = OrderedDict()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.running = None
+        self.n_completed = 0
+        self.n_failed = 0
+        # (wait, run) times of the most recent jobs
+        self.latencies = deque(maxlen=latency_window)
+
+        self.segment_funcs = {}
+        self.httpd = None
+        self.worker = None
+
+    def warm_up(self):
+        """import every configured segmentation function and load its weights once"""
+        tick = time.time()
+        cfg_dicts = {
+            model: get_segment_config(self.args, model=model, image=None)
+            for model in self.models
+        }
+        self.segment_funcs = {model: get_model(model=model) for model in self.models}
+        warm_models(cfg_dicts)
+        log.info(f"Warmed up {self.models} in {time.time() - tick:.1f}s")
+
+    def submit(
+        self,
+        model: str,
+        roi: List[List[int]],
+        params: Optional[dict] = None,
+        output: Optional[str] = None,
+    ):
+        """queue a segmentation job for a (z, y, x) roi of the volume"""
+        if model not in self.models:
+            raise ValueError(f"{model} is not served, choose one of {self.models}")
+        if (
+            not isinstance(roi, (list, tuple))
+            or len(roi) != 3
+            or not all(
+                isinstance(r, (list, tuple))
+                and len(r) == 2
+                and all(isinstance(i, int) and not isinstance(i, bool) for i in r)
+                and 0 <= r[0] < r[1]
+                for r in roi
+            )
+        ):
+            raise ValueError(f"roi must be [[z0, z1], [y0, y1], [x0, x1]], got {roi}")
+        if params is not None and not isinstance(params, dict):
+            raise ValueError(f"params must be a dictionary, got {params}")
+        reserved = [k for k in (params or {}) if k in RESERVED_PARAMS]
+        if reserved:
+            raise ValueError(f"params can't override {reserved}")
+
+        job = SegmentationJob(model=model, roi=roi, params=params, output=output)
+        with self.lock:
+            self.jobs[job.job_id] = job
+            self._prune_jobs()
+        self.queue.put(job)
+
+        return job
+
+    def _prune_jobs(self):
+        # forget the oldest finished jobs (and their labels)
+        finished = [k for k, j in self.jobs.items() if j.status in ["done", "failed"]]
+        for job_id in finished[: max(len(self.jobs) - self.max_jobs, 0)]:
+            del self.jobs[job_id]
+
+    def get_job(self, job_id: str):
+        """a job's status and labels, read under the lock the worker updates them with"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None, None
+            return job.to_dict(), job.labels
+
+    def run_job(self, job: SegmentationJob):
+        """
+        segment a job's roi with an already warm model; returns the labels,
+        unless they are written to the job's output
+        """
+        roi = tuple(slice(start, stop) for start, stop in job.roi)
+        cfg_dict = get_segment_config(self.args, model=job.model, image=self.volume[roi])
+        cfg_dict.update(job.params)
+        cfg_dict["debug"] = False
+
+        labels = self.segment_funcs[job.model](**cfg_dict)
+        with dask.config.set(scheduler="synchronous"):
+            labels = labels.compute()
+
+        if job.output is not None:
+            write_volume(job.output, labels)
+            return None
+        return labels
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+
+            with self.lock:
+                job.status = "running"
+                job.started = time.time()
+                self.running = job.job_id
+            status, error, labels = "failed", None, None
+            try:
+                labels = self.run_job(job)
+                status = "done"
+            except Exception as e:
+                log.error(f"Job {job.job_id} failed: {e!r}")
+                error = repr(e)
+            finally:
+                with self.lock:
+                    job.status = status
+                    job.error = error
+                    job.labels = labels
+                    job.finished = time.time()
+                    if status == "done":
+                        self.n_completed += 1
+                    else:
+                        self.n_failed += 1
+                    self.running = None
+                    self.latencies.append(
+                        (job.started - job.submitted, job.finished - job.started)
+                    )
+                self.queue.task_done()
+
+    def status(self):
+        """queue depth and latency (in seconds) over the most recent jobs"""
+        with self.lock:
+            latencies = list(self.latencies)
+            running, completed, failed = self.running, self.n_completed, self.n_failed
+
+        latency = {}
+        if len(latencies) > 0:
+            wait, run = np.asarray(latencies).T
+            total = wait + run
+            latency = {
+                "mean_wait": float(wait.mean()),
+                "mean_run": float(run.mean()),
+                "p50_total": float(np.percentile(total, 50)),
+                "p95_total": float(np.percentile(total, 95)),
+                "max_total": float(total.max()),
+            }
+
+        return {
+            "models": self.models,
+            "queue_depth": self.queue.qsize(),
+            "running": running,
+            "completed": completed,
+            "failed": failed,
+            "latency": latency,
+        }
+
+    def start(self):
+        """start the worker thread and the http server (non-blocking)"""
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+
+        self.httpd = ThreadingHTTPServer((self.host, self.port), _make_handler(self))
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        log.info(f"Serving {self.models} on http://{self.host}:{self.port}")
+
+    def serve_forever(self):
+        self.start()
+        try:
+            self.worker.join()
+        except KeyboardInterrupt:
+            self.shutdown()
+
+    def shutdown(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+        self.queue.put(None)
+
+
+def _make_handler(server: SegmentationServer):
+    class SegmentationRequestHandler(BaseHTTPRequestHandler):
+        """
+        GET  /status              -> queue depth and latency
+        POST /jobs                -> {"model", "roi", "params", "output"}, returns a job id
+        GET  /jobs/<id>           -> job status
+        GET  /jobs/<id>/labels    -> labels as a .npy buffer (jobs without an output path)
+        """
+
+        def _send(self, code, body, content_type="application/json"):
+            if content_type == "application/json":
+                body = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parts = self.path.strip("/").split("/")
+            if parts == ["status"]:
+                return self._send(200, server.status())
+
+            if len(parts) in [2, 3] and parts[0] == "jobs":
+                job, labels = server.get_job(parts[1])
+                if job is None:
+                    return self._send(404, {"error": f"unknown job {parts[1]}"})
+                if len(parts) == 2:
+                    return self._send(200, job)
+                if parts[2] == "labels":
+                    if labels is None:
+                        return self._send(409, {"error": f"no labels, job is {job['status']}"})
+                    buffer = io.BytesIO()
+                    np.save(buffer, labels)
+                    return self._send(200, buffer.getvalue(), "application/octet-stream")
+
+            self._send(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path.strip("/") != "jobs":
+                return self._send(404, {"error": f"unknown path {self.path}"})
+
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                request = json.loads(self.rfile.read(length))
+                if not isinstance(request, dict):
+                    raise ValueError(f"request must be a json object, got {request}")
+                job = server.submit(
+                    model=request["model"],
+                    roi=request["roi"],
+                    params=request.get("params"),
+                    output=request.get("output"),
+                )
+            except (KeyError, TypeError, ValueError) as e:
+                return self._send(400, {"error": repr(e)})
+
+            self._send(202, {"job_id": job.job_id})
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    return SegmentationRequestHandler
+
+
+class SegmentationClient:
+    """thin client for a running segmentation server"""
+
+    def __init__(self, host: Optional[str] = "127.0.0.1", port: Optional[int] = 8765):
+        self.url = f"http://{host}:{port}"
+
+    def _request(self, path: str, payload: Optional[dict] = None):
+        data = None if payload is None else json.dumps(payload).encode()
+        req = urlrequest.Request(
+            self.url + path, data=data, headers={"Content-Type": "application/json"}
+        )
+        with urlrequest.urlopen(req) as response:
+            return response.read()
+
+    def status(self):
+        return json.loads(self._request("/status"))
+
+    def job(self, job_id: str):
+        return json.loads(self._request(f"/jobs/{job_id}"))
+
+    def submit(
+        self,
+        model: str,
+        roi: List[List[int]],
+        params: Optional[dict] = None,
+        output: Optional[str] = None,
+    ):
+        payload = {"model": model, "roi": roi, "params": params, "output": output}
+        return json.loads(self._request("/jobs", payload))["job_id"]
+
+    def labels(self, job_id: str):
+        return np.load(io.BytesIO(self._request(f"/jobs/{job_id}/labels")))
+
+    def segment(
+        self,
+        model: str,
+        roi: List[List[int]],
+        params: Optional[dict] = None,
+        output: Optional[str] = None,
+        poll: Optional[float] = 0.5,
+        timeout: Optional[float] = None,
+    ):
+        """submit a job and block until it finishes; returns labels,
+        or the job status if labels were written to `output`"""
+        job_id = self.submit(model=model, roi=roi, params=params, output=output)
+        tick = time.time()
+        while True:
+            job = self.job(job_id)
+            if job["status"] == "failed":
+                raise RuntimeError(f"job {job_id} failed: {job['error']}")
+            if job["status"] == "done":
+                return job if output is not None else self.labels(job_id)
+            if timeout is not None and time.time() - tick > timeout:
+                raise TimeoutError(f"job {job_id} still {job['status']} after {timeout}s")
+            time.sleep(poll)
@@ -0,0 +1,335 @@
+"""
+sweep instance extraction thresholds, running the network only once:
+- stardist-based models (prob_thresh, nms_thresh): prob/dist maps are predicted,
+blended and cached as zarr, and every setting only re-runs nms on the cached maps
+- cellpose (flow_threshold, cellprob_threshold, min_size): per-block flows are
+cached, and every setting only re-runs the flow dynamics
+"""
+import os
+import json
+import time
+import shutil
+import itertools
+import numpy as np
+import pandas as pd
+from typing import List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+
+import dask
+import dask.array as da
+
+from lsm.distributed.prob_maps import write_maps
+from lsm.distributed.prob_stitching import predict_blocks, stitch_prob_maps
+from lsm.distributed.gt_proxy import _weights_stamp
+from lsm.evaluation.stitch_metrics import StitchMetrics
+from lsm.utils.io_util import open_volume, params_key, replace_store
+
+
+def cache_maps(
+    image: dask.array,
+    cache_dir: str,
+    model_folder: str,
+    model_name: str,
+    weight_name: str,
+    diameter: List[float],
+    scale: List[float] = [1.0, 1.0, 1.0],
+    chunk: Optional[int] = None,
+    boundary: Optional[str] = "reflect",
+    zarr_chunks: Tuple[int] = (64, 64, 64),
+    source: Optional[dict] = None,
+):
+    """
+    predict (blended) prob/dist maps of a volume once, and store them as
+    `<cache_dir>/<key>.zarr`, with the model's nms geometry in its attributes.
+    the key hashes everything the maps depend on (the image's `source`, eg:
+    url, scale and roi, its shape, the model and its weights, and the block
+    grid), so only caches of the same inputs are reused. returns the maps' path
+    """
+    import zarr
+
+    from lsm.distributed.segment_steerable import (
+        predict_anystar_chunk,
+        stardist_geometry,
+        stardist_map_names,
+    )
+
+    image = da.asarray(image)
+    params = {
+        "source": source,
+        "shape": list(image.shape),
+        "model_name": model_name,
+        "weights": _weights_stamp(os.path.join(model_folder, model_name, weight_name)),
+        "diameter": list(diameter),
+        "scale": list(scale),
+        "chunk": chunk,
+        "boundary": boundary,
+        "zarr_chunks": list(zarr_chunks),
+    }
+    key = params_key(params)
+    path = os.path.join(cache_dir, f"{key}.zarr")
+
+    if os.path.exists(path):
+        print(f"Reusing cached maps: {path}")
+        return path
+
+    model_kwargs = {
+        "model_name": model_name,
+        "model_folder": model_folder,
+        "weight_name": weight_name,
+    }
+    map_names = stardist_map_names(**model_kwargs)
+
+    maps = predict_blocks(
+        image=image,
+        predict_chunk=predict_anystar_chunk,
+        chunk_kwargs={"scale": scale, **model_kwargs},
+        diameter=diameter,
+        map_channels=len(map_names),
+        chunk=chunk,
+        boundary=boundary,
+    )
+    # written under a temporary name, so interrupted runs don't leave a valid key
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = os.path.join(cache_dir, f"{key}.tmp.zarr")
+    dask.compute(write_maps(maps, tmp_path, chunks=zarr_chunks, channel_names=map_names))
+
+    geometry = stardist_geometry(**model_kwargs)
+    zarr.open(tmp_path).attrs.update(
+        {
+            "rays_json": geometry["rays_json"],
+            "grid": list(geometry["grid"]),
+            "ray_scale": list(scale),
+        }
+    )
+    with open(os.path.join(cache_dir, f"{key}.json"), "w") as f:
+        json.dump(params, f, indent=2, sort_keys=True, default=str)
+    replace_store(tmp_path, path)
+
+    return path
+
+
+def _sweep_point(
+    maps_path: str,
+    prob_thresh: float,
+    nms_thresh: float,
+    halo: List[int],
+    gt_path: Optional[str] = None,
+):
+    """nms on cached maps for a single threshold pair, and its metrics"""
+    import zarr
+
+    from lsm.distributed.segment_steerable import extract_anystar_instances
+
+    store = zarr.open(maps_path, mode="r")
+    maps = da.from_zarr(store)
+
+    tic = time.time()
+    with dask.config.set(scheduler="synchronous"):
+        labels, table = stitch_prob_maps(
+            maps,
+            extract_instances=extract_anystar_instances,
+            extract_kwargs={
+                "rays_json": store.attrs["rays_json"],
+                "grid": tuple(store.attrs["grid"]),
+                "ray_scale": tuple(store.attrs.get("ray_scale", [1.0, 1.0, 1.0])),
+                "prob_thresh": prob_thresh,
+                "nms_thresh": nms_thresh,
+            },
+            halo=halo,
+            object_stats=True,
+        )
+        labels, table = dask.compute(labels, table)
+
+    result = {"prob_thresh": prob_thresh, "nms_thresh": nms_thresh}
+    result.update(_setting_metrics(labels, table, time.time() - tic, gt_path))
+
+    return result
+
+
+def _setting_metrics(labels, table, toc: float, gt_path: Optional[str] = None):
+    """metrics of a single sweep setting, against the ground truth proxy if given"""
+    result = {
+        "time": toc,
+        "count": len(table),
+        "mean_volume": table["voxel_count"].mean() if len(table) else 0.0,
+    }
+
+    if gt_path is not None:
+        gt_proxy = np.asarray(open_volume(gt_path))
+        metrics = StitchMetrics(
+            gt_proxy=gt_proxy, stitched_vols=[labels], metric="iou", chunk_sizes=[0]
+        )
+        result["iou"] = metrics.compute_mean_iou(vol=labels)
+        result["count_error"] = result["count"] - (metrics.nuclei_count(vol=gt_proxy) - 1)
+
+    return result
+
+
+def sweep_thresholds(
+    maps_path: str,
+    prob_threshs: List[float],
+    nms_threshs: List[float],
+    halo: List[int],
+    gt_path: Optional[str] = None,
+    workers: int = 4,
+):
+    """
+    extract instances from cached maps for every (prob_thresh, nms_thresh)
+    pair, in a process pool, and report metrics per setting (against the ground
+    truth proxy at `gt_path`, if given)
+    """
+    settings = list(itertools.product(prob_threshs, nms_threshs))
+    print(f"Sweeping {len(settings)} threshold settings with {workers} workers...")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_sweep_point, maps_path, p, n, halo, gt_path)
+            for p, n in settings
+        ]
+        results = [f.result() for f in futures]
+
+    return pd.DataFrame(results)
+
+
+def _flow_params(cfg_dict: dict, source: Optional[dict] = None):
+    # everything cached flows depend on, including the block grid postprocess needs
+    image = da.asarray(cfg_dict["image"])
+    return {
+        "source": source,
+        "shape": list(image.shape),
+        "chunk": cfg_dict.get("chunk", None),
+        "boundary": cfg_dict.get("boundary", "reflect"),
+        "diameter": list(cfg_dict["diameter"]),
+        "channels": [list(c) for c in cfg_dict.get("channels", [[0, 0]])],
+        "model_type": cfg_dict.get("model_type", "nuclei"),
+        "use_anisotropy": cfg_dict.get("use_anisotropy", True),
+    }
+
+
+def read_flow_manifest(flow_cache: str):
+    """parameters of a completely written flow cache, or None"""
+    path = os.path.join(flow_cache, "manifest.json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_flow_cache(flow_cache: str, cfg_dict: dict):
+    """make sure cached flows match the image shape and block grid of a postprocess run"""
+    manifest = read_flow_manifest(flow_cache)
+    if manifest is None:
+        raise ValueError(f"{flow_cache} is not a complete flow cache (no manifest.json)")
+
+    params = _flow_params(cfg_dict)
+    for name in ["shape", "chunk", "boundary", "diameter"]:
+        if manifest[name] != params[name]:
+            raise ValueError(
+                f"flows in {flow_cache} were cached with {name}={manifest[name]}, not {params[name]}"
+            )
+
+
+def cache_flows(cfg_dict: dict, cache_dir: str, source: Optional[dict] = None):
+    """
+    segment once with cellpose, persisting every block's flows into
+    `<cache_dir>/<key>/`. `cfg_dict` holds the keyword arguments of cellpose's
+    `segment`, and the key hashes those the flows depend on (with the image's
+    `source`, eg: url, scale and roi), so only flows of the same image and
+    block grid are reused. the cache's parameters are written last, in its
+    `manifest.json`. returns the flow cache directory
+    """
+    from lsm.distributed.segment_cellpose import segment
+
+    params = _flow_params(cfg_dict, source=source)
+    key = params_key(params)
+    flow_cache = os.path.join(cache_dir, key)
+
+    if read_flow_manifest(flow_cache) == json.loads(json.dumps(params, default=str)):
+        print(f"Reusing cached flows: {flow_cache}")
+        return flow_cache
+
+    # written under a temporary name, so interrupted runs don't leave a valid cache
+    tmp_cache = os.path.join(cache_dir, f"{key}.tmp")
+    if os.path.isdir(tmp_cache):
+        shutil.rmtree(tmp_cache)
+    os.makedirs(tmp_cache)
+
+    labels = segment(**cfg_dict, flow_cache=tmp_cache)
+    with dask.config.set(scheduler="synchronous"):
+        labels.compute()
+
+    with open(os.path.join(tmp_cache, "manifest.json"), "w") as f:
+        json.dump(params, f, indent=2, sort_keys=True, default=str)
+    replace_store(tmp_cache, flow_cache)
+
+    return flow_cache
+
+
+def _postprocess_point(
+    cfg_dict: dict,
+    flow_cache: str,
+    flow_threshold: float,
+    cellprob_threshold: float,
+    min_size: int,
+    gt_path: Optional[str] = None,
+):
+    """masks from cached flows for a single parameter setting, and its metrics"""
+    from lsm.distributed.segment_cellpose import postprocess
+
+    tic = time.time()
+    with dask.config.set(scheduler="synchronous"):
+        labels, table = postprocess(
+            **cfg_dict,
+            flow_cache=flow_cache,
+            flow_threshold=flow_threshold,
+            cellprob_threshold=cellprob_threshold,
+            min_size=min_size,
+            object_stats=True,
+        )
+        labels, table = dask.compute(labels, table)
+
+    result = {
+        "flow_threshold": flow_threshold,
+        "cellprob_threshold": cellprob_threshold,
+        "min_size": min_size,
+    }
+    result.update(_setting_metrics(labels, table, time.time() - tic, gt_path))
+
+    return result
+
+
+def sweep_cellpose(
+    cfg_dict: dict,
+    flow_cache: str,
+    flow_thresholds: List[float],
+    cellprob_thresholds: List[float],
+    min_sizes: List[int],
+    gt_path: Optional[str] = None,
+    workers: int = 4,
+):
+    """
+    recompute (and stitch) cellpose masks from cached flows for every
+    parameter setting, in a process pool, and report metrics per setting.
+    `cfg_dict` holds the image, diameter, chunk and stitching arguments of
+    `postprocess`, which must match the run that cached the flows
+    """
+    check_flow_cache(flow_cache, cfg_dict)
+
+    # workers only need the block grid, not the (remote) image graph
+    image = da.asarray(cfg_dict["image"])
+    cfg_dict = {
+        **cfg_dict,
+        "image": da.zeros(image.shape, dtype=np.uint8, chunks=image.chunks),
+    }
+
+    settings = list(itertools.product(flow_thresholds, cellprob_thresholds, min_sizes))
+    print(f"Sweeping {len(settings)} post-processing settings with {workers} workers...")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_postprocess_point, cfg_dict, flow_cache, f, c, m, gt_path)
+            for f, c, m in settings
+        ]
+        results = [f.result() for f in futures]
+
+    return pd.DataFrame(results)
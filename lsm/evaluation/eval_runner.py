@@ -0,0 +1,199 @@
+"""
+parallel stitching evaluation: (model, chunk size, metric) tasks run in a
+process pool over memory-mapped (tiff) / chunked (zarr) inputs, one stitched
+volume per worker (so it is reduced once, in a single pass, for all its
+metrics, while the gt proxy's own count is a task of its own), and results
+are cached in a parquet table keyed by their inputs, so re-runs only compute
+what is missing (or whose inputs changed)
+"""
+import os
+import json
+import hashlib
+import pandas as pd
+from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor
+
+from lsm.evaluation.stitch_metrics import StitchMetrics
+from lsm.utils.io_util import open_volume
+
+
+RESULT_COLUMNS = ["key", "model", "chunk", "metric", "value"]
+# metric names are matched by substring, in `StitchMetrics.compute_metric`'s order
+METRICS = ["split", "merge", "iou", "count"]
+
+
+def _metric_name(metric: str):
+    return next((name for name in METRICS if name in metric), None)
+
+
+def _input_stamp(path: str):
+    # inputs are identified by path, size and modification time. zarr stores
+    # (directories) by every file below their root: metadata and (nested) chunks
+    # can be rewritten without touching the root's own modification time
+    stamp = {"path": os.path.abspath(path)}
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        stamp.update({"size": stat.st_size, "mtime": stat.st_mtime})
+        return stamp
+
+    files = sorted(
+        os.path.join(root, name) for root, _, names in os.walk(path) for name in names
+    )
+    stats = [os.stat(f) for f in files]
+    stamp.update(
+        {
+            "files": hashlib.sha256(
+                "\n".join(os.path.relpath(f, path) for f in files).encode("utf-8")
+            ).hexdigest()[:24],
+            "size": sum(s.st_size for s in stats),
+            "mtime": max([s.st_mtime for s in stats], default=0.0),
+        }
+    )
+    return stamp
+
+
+def eval_tasks(
+    volumes: dict, gt_paths: dict, metrics: List[str], seam_width: Optional[int] = 2
+):
+    """
+    (model, chunk, metric) tasks, where `volumes[model][chunk]` is a stitched
+    volume path and `gt_paths[model]` its gt proxy. count metrics also get a
+    "GT" task (the gt proxy's own count), as `StitchMetrics.compute_metric`
+    """
+    # every input is stamped once, however many tasks read it
+    paths = [gt_paths[model] for model in volumes]
+    paths += [path for chunk_paths in volumes.values() for path in chunk_paths.values()]
+    stamps = {path: _input_stamp(path) for path in set(paths)}
+
+    tasks = []
+    for model, chunk_paths in volumes.items():
+        gt_path = gt_paths[model]
+        for metric in metrics:
+            chunks = list(chunk_paths)
+            if "count" in metric:
+                chunks = ["GT"] + chunks
+            for chunk in chunks:
+                vol_path = gt_path if chunk == "GT" else chunk_paths[chunk]
+                params = {
+                    "metric": metric,
+                    "chunk": str(chunk),
+                    "gt": stamps[gt_path],
+                    "vol": stamps[vol_path],
+                    "seam_width": seam_width,
+                }
+                key = hashlib.sha256(
+                    json.dumps(params, sort_keys=True).encode("utf-8")
+                ).hexdigest()[:24]
+                tasks.append(
+                    {
+                        "key": key,
+                        "model": model,
+                        "chunk": str(chunk),
+                        "metric": metric,
+                        "gt_path": gt_path,
+                        "vol_path": vol_path,
+                        "seam_width": seam_width,
+                    }
+                )
+    return tasks
+
+
+def _evaluate(tasks: List[dict]):
+    """
+    evaluate every metric of a single stitched volume (or the gt proxy's own
+    count, for "GT" tasks), from one `compute_stats` / `compute_seam_errors` pass
+    """
+    # inputs are opened lazily in every worker, so they are shared through the page cache
+    task = tasks[0]
+    gt = open_volume(task["gt_path"])
+    if task["chunk"] == "GT":
+        metrics = StitchMetrics(gt_proxy=gt, stitched_vols=[], metric="count", chunk_sizes=[])
+        values = {"count": metrics.nuclei_count(gt)}
+    else:
+        metrics = StitchMetrics(
+            gt_proxy=gt,
+            stitched_vols=[open_volume(task["vol_path"])],
+            metric=task["metric"],
+            chunk_sizes=[int(task["chunk"])],
+            seam_width=task["seam_width"],
+        )
+        values = {}
+        names = [_metric_name(t["metric"]) for t in tasks]
+        if "iou" in names or "count" in names:
+            # the gt proxy's count is its own task
+            stats = metrics.compute_stats(gt_count=False)
+            intersection, union = stats["iou_terms"][0]
+            values["iou"] = intersection / (union + metrics.eps)
+            values["count"] = stats["counts"][0]
+        if "split" in names or "merge" in names:
+            errors = metrics.compute_seam_errors()[0]
+            values["split"], values["merge"] = errors["split"], errors["merged"]
+
+    results = []
+    for task in tasks:
+        name = _metric_name(task["metric"])
+        if name not in values:
+            raise NotImplementedError(
+                f"{task['metric']} not implemented, choose one of {METRICS}"
+            )
+        result = {col: task[col] for col in RESULT_COLUMNS if col != "value"}
+        result["value"] = float(values[name])
+        results.append(result)
+
+    return results
+
+
+class ResultCache:
+    """parquet table of evaluation results, keyed by task inputs"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return pd.DataFrame({col: [] for col in RESULT_COLUMNS})
+        return pd.read_parquet(self.path)
+
+    def update(self, rows: List[dict]):
+        results = pd.concat([self.load(), pd.DataFrame(rows, columns=RESULT_COLUMNS)])
+        results = results.drop_duplicates(subset="key", keep="last")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        results.to_parquet(self.path, index=False)
+        return results
+
+
+def run_evaluation(tasks: List[dict], cache_path: str, workers: Optional[int] = 4):
+    """
+    evaluate the tasks missing from the results cache (in a process pool),
+    and return the results of every task
+    """
+    cache = ResultCache(cache_path)
+    cached = set(cache.load()["key"])
+    missing = [task for task in tasks if task["key"] not in cached]
+    print(f"Evaluating {len(missing)} of {len(tasks)} tasks ({len(tasks) - len(missing)} cached)...")
+
+    if missing:
+        # one group of tasks (all its metrics) per stitched volume, evaluated together
+        groups = {}
+        for task in missing:
+            group = (task["model"], task["chunk"], task["gt_path"], task["seam_width"])
+            groups.setdefault(group, []).append(task)
+
+        if workers is not None and workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                rows = list(pool.map(_evaluate, groups.values()))
+        else:
+            rows = [_evaluate(group) for group in groups.values()]
+        cache.update([row for group in rows for row in group])
+
+    results = cache.load()
+    keys = [task["key"] for task in tasks]
+    return results.set_index("key").loc[keys].reset_index()
+
+
+def metric_dicts(results: pd.DataFrame):
+    """{(model, metric): {chunk: value}} dictionaries, as `StitchMetrics.compute_metric` returns"""
+    return {
+        (model, metric): dict(zip(group["chunk"], group["value"]))
+        for (model, metric), group in results.groupby(["model", "metric"], sort=False)
+    }
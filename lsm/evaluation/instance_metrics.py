@@ -0,0 +1,163 @@
+"""
+instance segmentation metrics (average precision over iou thresholds, f1 and
+panoptic quality) from a sparse label-pair contingency table, accumulated
+block by block over dask/zarr volumes, so neither volume is ever loaded whole
+"""
+import numpy as np
+import pandas as pd
+from typing import List, Optional, Tuple
+
+import dask
+import dask.array as da
+
+from lsm.evaluation.matching import ContingencyTable, assign_overlaps
+
+
+IOU_THRESHOLDS = [0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95]
+
+
+def as_dask(vol, chunks: Optional[Tuple[int]] = (64, 64, 64)):
+    """dask view of a numpy, zarr or dask volume (zarr volumes keep their storage chunks)"""
+    if isinstance(vol, da.Array):
+        return vol
+    if hasattr(vol, "chunks") and not isinstance(vol, np.ndarray):
+        return da.from_array(vol, chunks=vol.chunks)
+    return da.from_array(vol, chunks=chunks)
+
+
+def _label_sizes(block: np.ndarray):
+    # voxel counts of every (non-background) label in a block
+    labels, counts = np.unique(block[block != 0], return_counts=True)
+    return labels.astype(np.int64), counts.astype(np.int64)
+
+
+def _merge_sizes(*sizes):
+    labels = np.concatenate([l for l, _ in sizes])
+    counts = np.concatenate([c for _, c in sizes])
+    merged, inverse = np.unique(labels, return_inverse=True)
+    return merged, np.bincount(inverse.ravel(), weights=counts, minlength=len(merged)).astype(np.int64)
+
+
+def _block_tables(block1: np.ndarray, block2: np.ndarray):
+    return (
+        ContingencyTable.from_blocks(block1, block2),
+        _label_sizes(block1),
+        _label_sizes(block2),
+    )
+
+
+def _merge_tables(*tables):
+    return (
+        ContingencyTable.merge([t[0] for t in tables]),
+        _merge_sizes(*[t[1] for t in tables]),
+        _merge_sizes(*[t[2] for t in tables]),
+    )
+
+
+def blockwise_contingency(vol1, vol2, chunks: Optional[Tuple[int]] = (64, 64, 64), fan_in: int = 8):
+    """
+    (delayed) contingency table of two label volumes, and the voxel counts of
+    every label of each, as (contingency, (labels1, sizes1), (labels2, sizes2)).
+    per-block tables are merged in a tree, so memory scales with the number
+    of objects (and overlapping pairs), not voxels
+    """
+    vol1 = as_dask(vol1, chunks=chunks)
+    vol2 = as_dask(vol2, chunks=chunks).rechunk(vol1.chunks)
+    if vol1.shape != vol2.shape:
+        raise ValueError("volumes must have identical shapes")
+
+    blocks1 = vol1.to_delayed(optimize_graph=False).ravel()
+    blocks2 = vol2.to_delayed(optimize_graph=False).ravel()
+    tables = [dask.delayed(_block_tables)(b1, b2) for b1, b2 in zip(blocks1, blocks2)]
+
+    while len(tables) > 1:
+        tables = [
+            dask.delayed(_merge_tables)(*tables[k : k + fan_in])
+            for k in range(0, len(tables), fan_in)
+        ]
+
+    return tables[0]
+
+
+def metrics_from_contingency(
+    contingency: ContingencyTable,
+    sizes1: Tuple[np.ndarray],
+    sizes2: Tuple[np.ndarray],
+    thresholds: Optional[List[float]] = IOU_THRESHOLDS,
+):
+    """
+    true/false positives, precision, recall, f1, average precision
+    (tp / (tp + fp + fn)) and panoptic quality per iou threshold, with
+    volume 1 as the reference. instances are matched one-to-one (maximizing
+    total iou) among pairs at or above each threshold
+    """
+    labels1, counts1 = sizes1
+    labels2, counts2 = sizes2
+    n1, n2 = len(labels1), len(labels2)
+
+    i = np.searchsorted(labels1, contingency.labels1)
+    j = np.searchsorted(labels2, contingency.labels2)
+    iou = contingency.iou(counts1[i], counts2[j])
+
+    results = []
+    for threshold in thresholds:
+        keep = iou >= threshold
+        _, _, scores = assign_overlaps(i[keep], j[keep], iou[keep], n1, n2)
+
+        tp = len(scores)
+        fp, fn = n2 - tp, n1 - tp
+        sq = scores.mean() if tp else 0.0
+        rq = tp / (tp + 0.5 * fp + 0.5 * fn) if n1 + n2 else 0.0
+        results.append(
+            {
+                "threshold": threshold,
+                "tp": tp,
+                "fp": fp,
+                "fn": fn,
+                "precision": tp / n2 if n2 else 0.0,
+                "recall": tp / n1 if n1 else 0.0,
+                "f1": 2 * tp / (2 * tp + fp + fn) if n1 + n2 else 0.0,
+                "ap": tp / (tp + fp + fn) if n1 + n2 else 0.0,
+                "sq": sq,
+                "rq": rq,
+                "pq": sq * rq,
+            }
+        )
+
+    return pd.DataFrame(results)
+
+
+def instance_metrics(
+    vol1,
+    vol2,
+    thresholds: Optional[List[float]] = IOU_THRESHOLDS,
+    chunks: Optional[Tuple[int]] = (64, 64, 64),
+):
+    """
+    per-threshold instance metrics (see `metrics_from_contingency`) of a
+    label volume (vol2) against a reference (vol1). volumes can be numpy,
+    zarr or dask arrays, and are only read block by block
+    """
+    contingency, sizes1, sizes2 = dask.compute(blockwise_contingency(vol1, vol2, chunks=chunks))[0]
+    return metrics_from_contingency(contingency, sizes1, sizes2, thresholds=thresholds)
+
+
+def mean_average_precision(metrics: pd.DataFrame):
+    """average precision, averaged over iou thresholds"""
+    return metrics["ap"].mean()
+
+
+if __name__ == "__main__":
+    import zarr
+
+    from scipy import ndimage
+    from skimage.measure import label
+
+    rng = np.random.default_rng(0)
+    blobs = ndimage.gaussian_filter(rng.random((128, 128, 128)), 2) > 0.52
+    gt = zarr.array(label(blobs).astype(np.int32), chunks=(32, 32, 32))
+    pred = zarr.array(label(np.roll(blobs, 1, axis=0)).astype(np.int32), chunks=(32, 32, 32))
+
+    metrics = instance_metrics(gt, pred)
+    print(metrics)
+    print(f"mAP: {mean_average_precision(metrics):.3f}")
@@ -0,0 +1,132 @@
+"""
+vectorized morphology (volume, centroid, inertia tensor, axis lengths,
+elongation) of every label at once, from first and second order coordinate
+moments accumulated with bincount, block by block for large volumes
+"""
+import numpy as np
+import pandas as pd
+from typing import Optional, Tuple
+
+import dask
+
+from lsm.evaluation.instance_metrics import as_dask
+
+
+AXES = ["z", "y", "x"]
+PAIRS = [(0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)]
+MOMENT_COLUMNS = (
+    ["label", "count"]
+    + [f"sum_{ax}" for ax in AXES]
+    + [f"sum_{AXES[i]}{AXES[j]}" for i, j in PAIRS]
+)
+
+
+def block_moments(block: np.ndarray, origin: Optional[Tuple[int]] = (0, 0, 0)):
+    """
+    voxel count, coordinate sums and coordinate product sums of every label
+    in a block, in global coordinates given the block's `origin`
+    """
+    block = np.asarray(block)
+    ids, inverse = np.unique(block, return_inverse=True)
+    inverse = inverse.ravel()
+
+    # coordinates along each axis, broadcast over the block
+    grids = [
+        np.broadcast_to(
+            (np.arange(n, dtype=np.float64) + o).reshape(
+                [-1 if a == axis else 1 for a in range(block.ndim)]
+            ),
+            block.shape,
+        ).ravel()
+        for axis, (n, o) in enumerate(zip(block.shape, origin))
+    ]
+
+    columns = [ids, np.bincount(inverse, minlength=len(ids))]
+    columns += [np.bincount(inverse, weights=g, minlength=len(ids)) for g in grids]
+    columns += [
+        np.bincount(inverse, weights=grids[i] * grids[j], minlength=len(ids))
+        for i, j in PAIRS
+    ]
+
+    moments = pd.DataFrame(dict(zip(MOMENT_COLUMNS, columns)))
+    return moments[moments["label"] != 0]
+
+
+def merge_moments(*moments):
+    """sum the moments of labels spanning several blocks"""
+    moments = pd.concat(moments, ignore_index=True)
+    return moments.groupby("label", sort=True).sum().reset_index()
+
+
+def blockwise_moments(vol, chunks: Optional[Tuple[int]] = (64, 64, 64)):
+    """(delayed) moments of a numpy, zarr or dask label volume, block by block"""
+    vol = as_dask(vol, chunks=chunks)
+    starts = [np.cumsum((0,) + c) for c in vol.chunks]
+
+    moments = [
+        dask.delayed(block_moments)(block, tuple(s[i] for s, i in zip(starts, index)))
+        for index, block in zip(
+            np.ndindex(*vol.numblocks), vol.to_delayed(optimize_graph=False).ravel()
+        )
+    ]
+    return dask.delayed(merge_moments)(*moments)
+
+
+def morphology_table(moments: pd.DataFrame, spacing: Optional[Tuple[float]] = None):
+    """
+    per-label volume (`area`, in voxels), centroid, inertia tensor (as
+    `regionprops`), major/minor axis lengths and elongation, from moments.
+    `spacing` scales coordinates (eg: to microns) before the second order terms
+    """
+    spacing = np.ones(3) if spacing is None else np.asarray(spacing, dtype=np.float64)
+    count = moments["count"].values.astype(np.float64)
+    mean = np.stack([moments[f"sum_{ax}"].values for ax in AXES], axis=1) / count[:, None]
+
+    # central second moments (covariance), per label
+    cov = np.empty((len(moments), 3, 3))
+    for i, j in PAIRS:
+        c = moments[f"sum_{AXES[i]}{AXES[j]}"].values / count - mean[:, i] * mean[:, j]
+        cov[:, i, j] = cov[:, j, i] = c * spacing[i] * spacing[j]
+
+    # inertia tensor: trace(cov) * I - cov, with eigenvalues in decreasing order
+    inertia = np.trace(cov, axis1=1, axis2=2)[:, None, None] * np.eye(3) - cov
+    eigvals = np.linalg.eigvalsh(inertia)[:, ::-1]
+
+    major = np.sqrt(np.clip(10 * (eigvals[:, 0] + eigvals[:, 1] - eigvals[:, 2]), 0, None))
+    minor = np.sqrt(np.clip(10 * (-eigvals[:, 0] + eigvals[:, 1] + eigvals[:, 2]), 0, None))
+
+    table = pd.DataFrame(
+        {
+            "label": moments["label"].values,
+            "area": count,
+            "axis_major_length": major,
+            "axis_minor_length": minor,
+        }
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        table["elongation"] = major / minor
+    for k, ax in enumerate(AXES):
+        table[f"centroid_{ax}"] = mean[:, k]
+    for k in range(3):
+        table[f"inertia_eigval_{k}"] = eigvals[:, k]
+    for i, j in PAIRS:
+        table[f"inertia_{AXES[i]}{AXES[j]}"] = inertia[:, i, j]
+
+    return table
+
+
+def morphology(
+    vol,
+    chunks: Optional[Tuple[int]] = None,
+    spacing: Optional[Tuple[float]] = None,
+):
+    """
+    morphology table of every label of a volume. in-memory volumes are
+    processed at once unless `chunks` is given; zarr/dask volumes block by block
+    """
+    if isinstance(vol, np.ndarray) and chunks is None:
+        moments = block_moments(vol)
+    else:
+        moments = blockwise_moments(vol, chunks=chunks or (64, 64, 64)).compute()
+
+    return morphology_table(moments, spacing=spacing)
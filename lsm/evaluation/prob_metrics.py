@@ -0,0 +1,114 @@
+"""
+kl-divergence and entropy of probability maps, as chunked float32 reductions
+over numpy, zarr or dask volumes (memory is bounded by the chunk size), with
+optional per-object aggregates over a label volume
+"""
+import numpy as np
+import pandas as pd
+from typing import Optional, Tuple
+
+import dask
+import dask.array as da
+from scipy.special import kl_div, xlogy
+
+from lsm.evaluation.instance_metrics import as_dask
+
+
+def _as_float32(vol, chunks: Tuple[int]):
+    return as_dask(vol, chunks=chunks).astype(np.float32)
+
+
+def _binary_entropy(p: np.ndarray):
+    # per-voxel entropy (in bits) of a foreground probability
+    return -(xlogy(p, p) + xlogy(1 - p, 1 - p)) / np.float32(np.log(2))
+
+
+def _label_sums(labels: np.ndarray, values: np.ndarray):
+    # per-label sums and voxel counts of a block (background excluded)
+    ids, inverse = np.unique(labels, return_inverse=True)
+    inverse = inverse.ravel()
+    sums = np.bincount(inverse, weights=values.ravel(), minlength=len(ids))
+    counts = np.bincount(inverse, minlength=len(ids))
+    fg = ids != 0
+    return ids[fg], sums[fg], counts[fg]
+
+
+def _merge_label_sums(*parts):
+    ids = np.concatenate([p[0] for p in parts])
+    merged, inverse = np.unique(ids, return_inverse=True)
+    inverse = inverse.ravel()
+    sums = np.bincount(inverse, weights=np.concatenate([p[1] for p in parts]), minlength=len(merged))
+    counts = np.bincount(inverse, weights=np.concatenate([p[2] for p in parts]), minlength=len(merged))
+    return merged, sums, counts
+
+
+def _to_table(part):
+    ids, sums, counts = part
+    return pd.DataFrame(
+        {"label": ids, "voxel_count": counts.astype(np.int64), "mean": sums / counts}
+    )
+
+
+def object_means(labels, values: da.Array, fan_in: int = 8):
+    """
+    (delayed) per-object mean of a voxelwise map, as a dataframe with
+    (label, voxel_count, mean) columns, accumulated block by block
+    """
+    labels = as_dask(labels, chunks=values.chunksize).rechunk(values.chunks)
+    parts = [
+        dask.delayed(_label_sums)(l, v)
+        for l, v in zip(
+            labels.to_delayed(optimize_graph=False).ravel(),
+            values.to_delayed(optimize_graph=False).ravel(),
+        )
+    ]
+    while len(parts) > 1:
+        parts = [
+            dask.delayed(_merge_label_sums)(*parts[k : k + fan_in])
+            for k in range(0, len(parts), fan_in)
+        ]
+
+    return dask.delayed(_to_table)(parts[0])
+
+
+def kl_divergence(
+    prob1,
+    prob2,
+    labels=None,
+    chunks: Optional[Tuple[int]] = (64, 64, 64),
+):
+    """
+    voxel-mean (elementwise) kl-divergence between two probability maps,
+    followed by its per-object means (over `labels`) if given
+    """
+    prob1 = _as_float32(prob1, chunks)
+    prob2 = _as_float32(prob2, chunks).rechunk(prob1.chunks)
+    kld = da.map_blocks(kl_div, prob1, prob2, dtype=np.float32)
+
+    outputs = (kld.mean(dtype=np.float32),)
+    if labels is not None:
+        outputs += (object_means(labels, kld),)
+
+    outputs = dask.compute(*outputs)
+    return outputs[0] if len(outputs) == 1 else outputs
+
+
+def entropy(prob, labels=None, chunks: Optional[Tuple[int]] = (64, 64, 64)):
+    """
+    mean entropy (in bits) of a probability map, normalized along its first
+    axis (as `scipy.stats.entropy(prob, base=2)`), followed by per-object means
+    of the per-voxel (foreground/background) entropy over `labels`, if given
+    """
+    prob = _as_float32(prob, chunks)
+
+    # entropy of p / s along axis 0 is log(s) - sum(p log p) / s
+    s = prob.sum(axis=0, dtype=np.float32)
+    t = da.map_blocks(xlogy, prob, prob, dtype=np.float32).sum(axis=0, dtype=np.float32)
+    column_entropy = (da.log(s) - t / s) / np.float32(np.log(2))
+
+    outputs = (column_entropy.mean(dtype=np.float32),)
+    if labels is not None:
+        outputs += (object_means(labels, prob.map_blocks(_binary_entropy, dtype=np.float32)),)
+
+    outputs = dask.compute(*outputs)
+    return outputs[0] if len(outputs) == 1 else outputs
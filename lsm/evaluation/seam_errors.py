@@ -0,0 +1,105 @@
+"""
+split/merge errors at block seams: gt proxy objects and stitched labels are
+only compared within bands around the chunk boundaries of a chunk size, using
+sparse contingency counting, which is what the chunk-size study is about and
+far cheaper than comparing whole volumes
+"""
+import numpy as np
+from typing import Iterator, Optional, Tuple
+
+from lsm.evaluation.instance_metrics import _label_sizes, _merge_sizes
+from lsm.evaluation.matching import ContingencyTable
+
+
+def _near_seams(n: int, chunk: int, width: int):
+    # voxels along an axis within `width` of a chunk boundary
+    near = np.zeros(n, dtype=bool)
+    for seam in range(chunk, n, chunk):
+        near[max(seam - width, 0) : min(seam + width, n)] = True
+    return near
+
+
+def seam_bands(
+    shape: Tuple[int], chunk: int, width: Optional[int] = 2
+) -> Iterator[Tuple[Tuple[slice], np.ndarray]]:
+    """
+    slices of the bands (`width` voxels on each side) around every chunk
+    boundary, with a mask of the band's voxels not covered by an earlier band
+    (along earlier axes, or a previous seam), so every voxel counts once
+    """
+    if chunk <= 0:
+        return
+    near = [_near_seams(n, chunk, width) for n in shape]
+    for axis, n in enumerate(shape):
+        stop = 0
+        for seam in range(chunk, n, chunk):
+            band = [slice(None)] * len(shape)
+            # bands of close seams (chunk < 2 * width) would overlap along the axis
+            band[axis] = slice(max(seam - width, stop), min(seam + width, n))
+            stop = band[axis].stop
+
+            # seam intersections belong to the band of the earliest axis
+            band_shape = list(shape)
+            band_shape[axis] = band[axis].stop - band[axis].start
+            keep = np.ones(band_shape, dtype=bool)
+            for other in range(axis):
+                keep &= ~near[other].reshape([-1 if a == other else 1 for a in range(len(shape))])
+            yield tuple(band), keep
+
+
+def _counted(labels: np.ndarray):
+    # labels that occur at least twice (ie: overlap several objects)
+    ids, counts = np.unique(labels, return_counts=True)
+    return ids[counts > 1]
+
+
+def seam_errors(
+    gt_proxy,
+    vol,
+    chunk: int,
+    width: Optional[int] = 2,
+    min_fraction: Optional[float] = 0.1,
+):
+    """
+    number of gt proxy objects split, and of stitched labels merging several
+    gt proxy objects, within the seam bands of a chunk size. overlaps only
+    count if they cover at least `min_fraction` of the gt proxy object's
+    voxels in the bands. volumes can be numpy, memory-mapped
+    or zarr arrays (only bands are read)
+    """
+    tables, sizes_gt, sizes_vol = [], [], []
+    band_voxels = 0
+    for band, keep in seam_bands(gt_proxy.shape, chunk, width=width):
+        block_gt, block_vol = np.asarray(gt_proxy[band])[keep], np.asarray(vol[band])[keep]
+        tables.append(ContingencyTable.from_blocks(block_gt, block_vol))
+        sizes_gt.append(_label_sizes(block_gt))
+        sizes_vol.append(_label_sizes(block_vol))
+        band_voxels += block_gt.size
+
+    result = {"chunk": chunk, "band_voxels": band_voxels}
+    if not tables:
+        # a single chunk has no seams
+        result.update({"gt_objects": 0, "split": 0, "merged": 0, "split_rate": 0.0, "merge_rate": 0.0})
+        return result
+
+    table = ContingencyTable.merge(tables)
+    labels_gt, counts_gt = _merge_sizes(*sizes_gt)
+    labels_vol, counts_vol = _merge_sizes(*sizes_vol)
+
+    # only overlaps that cover enough of the gt object count, for both splits
+    # (several labels per object) and merges (several objects per label)
+    frac = table.overlaps / counts_gt[np.searchsorted(labels_gt, table.labels1)]
+    keep = frac >= min_fraction
+    split = _counted(table.labels1[keep])
+    merged = _counted(table.labels2[keep])
+
+    result.update(
+        {
+            "gt_objects": len(labels_gt),
+            "split": len(split),
+            "merged": len(merged),
+            "split_rate": len(split) / max(len(labels_gt), 1),
+            "merge_rate": len(merged) / max(len(labels_vol), 1),
+        }
+    )
+    return result
@@ -1,13 +1,62 @@
 import os
 import numpy as np
 import pandas as pd
-from typing import Optional
+from typing import List, Optional, Tuple
 
-from scipy.stats import entropy
-from scipy.special import kl_div
-from scipy.spatial import distance
 from skimage.metrics import hausdorff_distance
-from skimage.measure import regionprops, regionprops_table, label
+from skimage.measure import label
+
+from lsm.evaluation import prob_metrics
+from lsm.evaluation.instance_metrics import instance_metrics
+from lsm.evaluation.matching import InstanceMatching, InstanceTable
+from lsm.evaluation.morphology import morphology
+from lsm.evaluation.surface_distance import surface_distances
+
+
+class MetricsContext:
+    """
+    instance decompositions (consistent relabeling, centroids, bounding boxes,
+    coordinates) and matchings, computed once and shared by every metric.
+    cached by volume identity, for as long as the context lives
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._matchings = {}
+
+    def table(self, vol: np.ndarray):
+        """instance table of a (consistently relabeled) volume"""
+        key = id(vol)
+        if key not in self._tables:
+            # keep a reference to the volume, so its id can't be reused
+            self._tables[key] = (vol, InstanceTable(label(vol != 0)))
+        return self._tables[key][1]
+
+    def matching(
+        self,
+        vol1: np.ndarray,
+        vol2: np.ndarray,
+        match_mode: Optional[str] = "centroid",
+        max_distance: Optional[float] = None,
+    ):
+        """instance correspondences between two volumes"""
+        key = (id(vol1), id(vol2), match_mode, max_distance)
+        if key not in self._matchings:
+            table1, table2 = self.table(vol1), self.table(vol2)
+            if match_mode == "centroid":
+                # nearest centroids, within `max_distance` voxels (if given)
+                matching = InstanceMatching.nearest_centroids(
+                    table1, table2, max_distance=max_distance
+                )
+            elif match_mode == "overlap":
+                # optimal one-to-one matching by iou
+                matching = InstanceMatching.optimal_overlap(table1, table2)
+            else:
+                raise NotImplementedError(
+                    f"{match_mode} not implemented, choose one of [centroid, overlap]"
+                )
+            self._matchings[key] = matching
+        return self._matchings[key]
 
 
 class SegmentationMetrics:
@@ -15,16 +64,30 @@ class SegmentationMetrics:
     # for a range of metrics (geometric, spatial and probabilistic)
     def __init__(
         self,
-        metric: str,
+        metric: Optional[str],
         vol1: np.ndarray,
         vol2: np.ndarray,
         prob1: Optional[np.ndarray] = None,
         prob2: Optional[np.ndarray] = None,
+        match_mode: Optional[str] = "centroid",
+        max_distance: Optional[float] = None,
+        context: Optional[MetricsContext] = None,
+        spacing: Optional[Tuple[float]] = None,
+        workers: Optional[int] = 1,
+        per_object: Optional[bool] = False,
     ):
         self.vol1 = vol1
         self.vol2 = vol2
         self.eps = 1e-9  # constant for numerical stability
         self.metric = metric
+        # decompositions can be shared with other metric objects over the same volumes
+        self.context = context if context is not None else MetricsContext()
+        # (z, y, x) voxel size and number of processes for surface distances
+        self.spacing = spacing
+        self.workers = workers
+        self._surface_table = None
+        # also aggregate probabilistic metrics per object (of vol1 / vol2)
+        self.per_object = per_object
 
         if prob1 is not None and prob2 is not None:
             self.prob1 = prob1
@@ -34,19 +97,13 @@ class SegmentationMetrics:
             self.vol1.shape == self.vol2.shape
         ), "Volumes must have same shape for metric comparison"
 
-        # relabel volume, find instance mappings
-        (
-            nearest_neighbors,
-            self.label1,
-            self.label2,
-            self.coords1,
-            self.coords2,
-        ) = self._nearest_neighbors(vol1=self.vol1, vol2=self.vol2)
-        self.instance_mapping = self._corresponding_instance_map(
-            pairwise_dist=nearest_neighbors,
-            label_vol1=self.label1,
-            label_vol2=self.label2,
+        # relabel volumes, find instance correspondences (once, from per-instance tables)
+        self.matching = self.context.matching(
+            self.vol1, self.vol2, match_mode=match_mode, max_distance=max_distance
         )
+        self.label1 = self.matching.table1.label_vol
+        self.label2 = self.matching.table2.label_vol
+        self.instance_mapping = self.matching.mapping
 
     def _binarize_vol(self, vol: np.ndarray):
         # binarize volume to be in [0, 255]
@@ -54,108 +111,38 @@ class SegmentationMetrics:
         binary_vol[vol != 0] = 255
         return binary_vol
 
-    def _compute_centroids_and_coords(self, vol: np.ndarray):
-        # compute centroids of instance labels
-        binary_vol = self._binarize_vol(vol=vol)
-        label_vol = label(binary_vol)  # consistent instance relabeling
-        segmentation_props = regionprops(label_vol)
-        # return a vector of centroids and label coordinates
-        centroids = [prop.centroid for prop in segmentation_props]
-        coords = [prop.coords for prop in segmentation_props]
-        return centroids, label_vol, coords
-
-    def _nearest_neighbors(self, vol1: np.ndarray, vol2: np.ndarray):
-        # compute the 1st nearest neighbor between 2 volumes
-        # we use this as a heuristic to determine corresponding nuclei
-        centroids1, label_vol1, coords1 = self._compute_centroids_and_coords(vol=vol1)
-        centroids2, label_vol2, coords2 = self._compute_centroids_and_coords(vol=vol2)
-
-        # check for empty masks
-        if not centroids1 or not centroids2:
-            raise ValueError("One of the masks has no nuclei instances")
-
-        # compute pairwise distances
-        distances = distance.cdist(centroids1, centroids2, metric="euclidean")
-
-        # compute nearest neighbors
-        nearest_neighbors = np.argmin(distances, axis=1)
-
-        return nearest_neighbors, label_vol1, label_vol2, coords1, coords2
-
-    def _corresponding_instance_map(
-        self, pairwise_dist: np.ndarray, label_vol1: np.ndarray, label_vol2: np.ndarray
-    ):
-        # compute corresponding instance labels
-        instance_mapping = {}
-
-        for idx, nearest_neighbor in enumerate(pairwise_dist):
-            instance_label1 = label_vol1[label_vol1 == idx + 1][0]
-            instance_label2 = label_vol2[label_vol2 == nearest_neighbor + 1][0]
-            # assign instance mapping
-            instance_mapping[instance_label1] = instance_label2
-
-        return instance_mapping
-
-    def haussdorf_distance(self):
-        # compute (directed) hausdorff distance between corresponding
-        # instance masks
-        hausdorff_distances = {}
-        # binarize volumes first
-        binary_vol1, binary_vol2 = self._binarize_vol(
-            vol=self.vol1
-        ), self._binarize_vol(vol=self.vol2)
-
-        for instance_label1, instance_label2 in self.instance_mapping.items():
-            # coordinates of points in each instance
-            c1 = self.coords1[instance_label1 - 1]
-            c2 = self.coords2[instance_label2 - 1]
-
-            # compute hausdorff distance
-            hausdorff = max(
-                distance.directed_hausdorff(c1, c2)[0],
-                distance.directed_hausdorff(c2, c1)[0],
+    def surface_distances(self):
+        # per-pair surface distances (hausdorff, hd95, asd) of corresponding
+        # instance masks, bbox-local and computed once for all surface metrics
+        if self._surface_table is None:
+            self._surface_table = surface_distances(
+                self.matching, spacing=self.spacing, workers=self.workers
             )
-            hausdorff_distances[instance_label1] = hausdorff
+        return self._surface_table
 
-        return hausdorff_distances
+    def haussdorf_distance(self, column: Optional[str] = "hausdorff"):
+        # compute (symmetric) hausdorff distance between corresponding
+        # instance surfaces; "hd95" gives the 95th percentile instead of the max
+        table = self.surface_distances()
+        return dict(zip(table["label1"].tolist(), table[column].tolist()))
 
     def mean_volume_and_axis(self, vol: np.ndarray):
-        # compute nuclei volumes
-        segmentation_props = regionprops(vol)
-        props = regionprops_table(
-            vol,
-            properties=(
-                "area",
-                "axis_major_length",
-                # "axis_minor_length",
-            ),
-        )
-        props_table = pd.DataFrame(props)
-
-        return props_table
+        # compute nuclei volumes and major axis lengths, from (bincount) moments
+        return morphology(vol)[["area", "axis_major_length"]]
 
-    def kl_divergence(self):
-        # compute KL divergence between probability maps
-        return kl_div(self.prob1, self.prob2)
+    def kl_divergence(self, labels=None):
+        # voxel-mean KL divergence between probability maps (chunked, float32),
+        # and its per-object means if labels are given
+        return prob_metrics.kl_divergence(self.prob1, self.prob2, labels=labels)
 
-    def entropy(self, prob_map: np.ndarray):
-        # compute entropy for a probability map
+    def entropy(self, prob_map, labels=None):
+        # compute mean entropy for a probability map (chunked, float32)
         # note: using base 2 here does computations in the unit of bits
-        return entropy(prob_map, base=2)
+        return prob_metrics.entropy(prob_map, labels=labels)
 
     def nuclei_mse(self):
-        # compute MSE between geometric centers of nuclei
-        centroids1, _, _ = self._compute_centroids_and_coords(vol=self.vol1)
-        centroids2, _, _ = self._compute_centroids_and_coords(vol=self.vol2)
-
-        distances = []
-        for instance_label1, instance_label2 in self.instance_mapping.items():
-            c1 = np.array(centroids1[instance_label1 - 1])
-            c2 = np.array(centroids2[instance_label2 - 1])
-            dist = np.linalg.norm(c1 - c2)
-            distances.append(dist)
-
-        return distances
+        # compute distances between geometric centers of corresponding nuclei
+        return self.matching.centroid_distances().tolist()
 
     def jaccard_index(self):
         # compute jaccard metric
@@ -165,41 +152,65 @@ class SegmentationMetrics:
         return intersection.sum() / (float(union.sum()) + self.eps)
 
     def compute_metric(self):
+        return self._compute(metric=self.metric)
+
+    def compute_metrics(self, metrics: List[str]):
+        """compute several metrics over the same (shared) instance decomposition"""
+        return {metric: self._compute(metric=metric) for metric in metrics}
+
+    def _compute(self, metric: str):
         metric_list = []
 
-        if self.metric == "hausdorff":
+        if metric == "hausdorff":
             hausdorff = self.haussdorf_distance()
             metric_list.append(hausdorff)
 
-        elif self.metric == "mean_geometry":
+        elif metric == "hausdorff95":
+            print(f"computing 95th percentile hausdorff distance...")
+            metric_list.append(self.haussdorf_distance(column="hd95"))
+
+        elif metric == "surface_distance":
+            print(f"computing average symmetric surface distance...")
+            metric_list.append(self.haussdorf_distance(column="asd"))
+
+        elif metric == "mean_geometry":
             print(f"computing mean geometry metrics...")
             tab1 = self.mean_volume_and_axis(vol=self.vol1)
             tab2 = self.mean_volume_and_axis(vol=self.vol2)
             metric_list.append(tab1)
             metric_list.append(tab2)
 
-        elif self.metric == "nuclei_distance":
+        elif metric == "nuclei_distance":
             print(f"computing corresponding nuclei distance...")
             distances = self.nuclei_mse()
             metric_list.append(distances)
 
-        elif self.metric == "kl_divergence":
+        elif metric == "instance_metrics":
+            print(f"computing AP@IoU, F1 and PQ...")
+            # vol1 is the reference, pairs are counted block by block
+            metric_list.append(instance_metrics(self.vol1, self.vol2))
+
+        elif metric == "kl_divergence":
             print(f"computing KL-divergence...")
-            kld = self.kl_divergence()
-            mean_kld = np.mean(kld)
-            metric_list.append(mean_kld)
+            if self.per_object:
+                mean_kld, object_kld = self.kl_divergence(labels=self.vol1)
+                metric_list.extend([mean_kld, object_kld])
+            else:
+                metric_list.append(self.kl_divergence())
 
-        elif self.metric == "entropy":
+        elif metric == "entropy":
             print(f"computing entropy...")
-            e1 = self.entropy(prob_map=self.prob1)
-            e2 = self.entropy(prob_map=self.prob2)
-            me1, me2 = np.mean(e1), np.mean(e2)
-            metric_list.append(me1)
-            metric_list.append(me2)
+            if self.per_object:
+                me1, oe1 = self.entropy(prob_map=self.prob1, labels=self.vol1)
+                me2, oe2 = self.entropy(prob_map=self.prob2, labels=self.vol2)
+                metric_list.extend([me1, me2, oe1, oe2])
+            else:
+                metric_list.append(self.entropy(prob_map=self.prob1))
+                metric_list.append(self.entropy(prob_map=self.prob2))
 
         else:
             raise NotImplementedError(
-                f"{self.metric} not implemented, choose one of [hausdorff, mean_geometry, nuclei_distance, kl_divergence, entropy]"
+                f"{metric} not implemented, choose one of [hausdorff, hausdorff95, surface_distance, mean_geometry, nuclei_distance, instance_metrics, kl_divergence, entropy]"
             )
 
         return metric_list
@@ -218,14 +229,15 @@ if __name__ == "__main__":
     p2 = imread("/om2/user/ckapoor/lsm-segmentation/probmap_gaussian.tiff")
     metrics = [
         "hausdorff",
+        "hausdorff95",
+        "surface_distance",
         "mean_geometry",
         "kl_divergence",
         "entropy",
         "nuclei_distance",
+        "instance_metrics",
     ]
-    for metric in metrics:
-        seg_metrics = SegmentationMetrics(
-            metric=metric, vol1=m1, vol2=m2, prob1=p1, prob2=p2
-        )
-        m = seg_metrics.compute_metric()
-        print(m)
+    # one instance decomposition for all metrics
+    seg_metrics = SegmentationMetrics(metric=None, vol1=m1, vol2=m2, prob1=p1, prob2=p2)
+    for metric, m in seg_metrics.compute_metrics(metrics).items():
+        print(metric, m)
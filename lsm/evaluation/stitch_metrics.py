@@ -1,65 +1,116 @@
 import numpy as np
-from typing import List
+from typing import List, Optional, Tuple
+
+import dask
+import dask.array as da
+
+from lsm.evaluation.instance_metrics import as_dask
+from lsm.evaluation.seam_errors import seam_errors
 
 
 class StitchMetrics:
+    # foreground iou and nuclei counts of stitched volumes against a gt proxy,
+    # as chunked reductions over numpy, zarr or dask volumes
     def __init__(
         self,
-        gt_proxy: np.ndarray,
-        stitched_vols: List[np.ndarray],
+        gt_proxy,
+        stitched_vols: List,
         metric: str,
         chunk_sizes: List[int],
+        chunks: Optional[Tuple[int]] = (64, 64, 64),
+        seam_width: Optional[int] = 2,
     ):
         self.gt = gt_proxy  # we don't really have the gt, just a proxy for it
         self.stitched_vols = stitched_vols
         self.metric = metric
         self.chunk_sizes = chunk_sizes
+        self.chunks = chunks  # blocks of in-memory volumes (zarr/dask keep theirs)
+        self.seam_width = seam_width  # half-width of the bands around chunk boundaries
 
         # define a constant for numerical stability
         self.eps = 1e-7
 
-    def _binarize_vol(self, vol: np.ndarray):
-        # binarize an image to [0, 255]
-        binary_vol = np.zeros_like(vol, dtype=vol.dtype)
-        binary_vol[vol != 0] = 255
+        # lazy gt proxy, shared by every reduction
+        self._gt = as_dask(self.gt, chunks=self.chunks)
+        # every statistic, once computed (in a single pass over the gt proxy)
+        self._stats = None
+        self._seam_stats = None
 
-        return binary_vol
-
-    def compute_mean_iou(self, vol: np.ndarray):
-        # we modify the volumes to be binarized
-        # binarize volumes
-        if self.gt.shape != vol.shape:
+    def _as_dask(self, vol):
+        # stitched volumes are read in the gt proxy's blocks
+        vol = as_dask(vol, chunks=self.chunks)
+        if self._gt.shape != vol.shape:
             raise ValueError(f"volumes must have identical shapes")
-
-        # binarize volumes
-        binary_gt = self._binarize_vol(vol=self.gt)
-        binary_seg = self._binarize_vol(vol=vol)
-
-        # compute iou
-        intersection = np.logical_and(binary_gt, binary_seg).sum()
-        union = np.logical_or(binary_gt, binary_seg).sum()
-        iou = intersection / (union + self.eps)
-
-        return iou
-
-    def nuclei_count(self, vol: np.ndarray):
-        return len(np.unique(vol))
-
-    def compute_metric(self):
+        return self._gt, vol.rechunk(self._gt.chunks)
+
+    def _iou_terms(self, vol):
+        # lazy foreground intersection and union, without binarized copies
+        gt, vol = self._as_dask(vol)
+        fg_gt, fg_vol = gt != 0, vol != 0
+        return (fg_gt & fg_vol).sum(), (fg_gt | fg_vol).sum()
+
+    def _labels(self, vol):
+        # lazy distinct labels (including background), merged from per-block uniques
+        return da.unique(as_dask(vol, chunks=self.chunks))
+
+    def compute_stats(self, gt_count: Optional[bool] = True):
+        """
+        intersections, unions and label counts of every stitched volume (and
+        the gt proxy's label count, unless `gt_count` is False), in a single
+        pass over the gt proxy
+        """
+        if self._stats is None or (gt_count and "gt_count" not in self._stats):
+            terms = [self._iou_terms(vol) for vol in self.stitched_vols]
+            labels = [self._labels(vol) for vol in self.stitched_vols]
+            gt_labels = [self._labels(self._gt)] if gt_count else []
+            terms, labels, gt_labels = dask.compute(terms, labels, gt_labels)
+            self._stats = {"iou_terms": terms, "counts": [len(l) for l in labels]}
+            if gt_count:
+                self._stats["gt_count"] = len(gt_labels[0])
+        return self._stats
+
+    def compute_seam_errors(self):
+        """split/merge errors within the seam bands of every stitched volume's chunk size"""
+        if self._seam_stats is None:
+            self._seam_stats = [
+                seam_errors(self.gt, vol, chunk, width=self.seam_width)
+                for vol, chunk in zip(self.stitched_vols, self.chunk_sizes)
+            ]
+        return self._seam_stats
+
+    def compute_mean_iou(self, vol):
+        intersection, union = dask.compute(*self._iou_terms(vol))
+        return intersection / (union + self.eps)
+
+    def nuclei_count(self, vol):
+        return len(dask.compute(self._labels(vol))[0])
+
+    def compute_metric(self, metric: Optional[str] = None):
+        # metrics share the same statistics, so several can be computed from one object
+        metric = metric or self.metric
         metric_dict = {}
 
-        if "iou" in self.metric:
-            metric_func = self.compute_mean_iou
-        elif "count" in self.metric:
-            metric_func = self.nuclei_count
-            metric_dict["GT"] = metric_func(vol=self.gt)
+        if "split" in metric:
+            values = [errors["split"] for errors in self.compute_seam_errors()]
+        elif "merge" in metric:
+            values = [errors["merged"] for errors in self.compute_seam_errors()]
+        elif "iou" in metric:
+            stats = self.compute_stats()
+            values = [
+                intersection / (union + self.eps)
+                for intersection, union in stats["iou_terms"]
+            ]
+        elif "count" in metric:
+            stats = self.compute_stats()
+            metric_dict["GT"] = stats["gt_count"]
+            values = stats["counts"]
         else:
             raise NotImplementedError(
-                f"{self.metric} not implemented, choose one of [iou, count]"
+                f"{metric} not implemented, choose one of [iou, count, split, merge]"
             )
 
         for idx, chunk in enumerate(self.chunk_sizes):
-            metric_dict[str(chunk)] = metric_func(vol=self.stitched_vols[idx])
+            metric_dict[str(chunk)] = values[idx]
 
         return metric_dict
 
@@ -1,5 +1,26 @@
 import os
 import glob
+import json
+import shutil
+import hashlib
+import numpy as np
+from typing import Optional, Tuple
+
+
+def params_key(params: dict):
+    """stable (short) hash of everything a cached output depends on"""
+    blob = json.dumps(params, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest()[:24]
+
+
+def replace_store(tmp_path: str, path: str):
+    """
+    move a completely written store (or file) into place, so interrupted
+    writes never leave behind a store that looks valid
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
 
 
 def glob_imgs(path: str):
@@ -7,3 +28,106 @@ def glob_imgs(path: str):
     for ext in ["*.png"]:
         imgs.extend(glob.glob(os.path.join(path, ext)))
     return imgs
+
+
+def write_volume(path: str, vol: np.ndarray, chunks: Optional[Tuple[int]] = None):
+    """
+    write a (label) volume to a tiff or zarr file, based on its extension.
+    dask volumes are computed and written block by block
+    """
+    import dask.array as da
+
+    if path.endswith(".zarr"):
+        import zarr
+
+        if isinstance(vol, da.Array):
+            if chunks is not None:
+                vol = vol.rechunk(chunks)
+            da.to_zarr(vol, path, overwrite=True)
+        else:
+            zarr.save_array(path, vol, chunks=chunks if chunks is not None else True)
+    elif path.endswith((".tif", ".tiff")):
+        from tifffile import imwrite, memmap
+
+        if isinstance(vol, da.Array):
+            # an uncompressed tiff, mapped to memory and filled block by block
+            out = memmap(path, shape=vol.shape, dtype=vol.dtype)
+            da.store(vol, out, lock=False)
+            out.flush()
+            del out
+        else:
+            imwrite(path, vol)
+    else:
+        raise NotImplementedError(
+            f"unsupported file type: {path}, choose one of [.tiff, .tif, .zarr]"
+        )
+
+
+def open_volume(path: str):
+    """lazily open a tiff (memory-mapped) or (ome-)zarr volume"""
+    import zarr
+
+    if path.endswith(".zarr") or os.path.isdir(path):
+        vol = zarr.open(path, mode="r")
+        # ome-zarr groups store the full resolution image at "0"
+        if isinstance(vol, zarr.Group):
+            vol = vol["0"]
+    elif path.endswith((".tif", ".tiff")):
+        import tifffile
+
+        try:
+            # uncompressed tiffs (as written by distributed_segment.py) map directly
+            vol = tifffile.memmap(path, mode="r")
+        except ValueError:
+            vol = zarr.open(tifffile.imread(path, aszarr=True), mode="r")
+    else:
+        raise NotImplementedError(
+            f"unsupported file type: {path}, choose one of [.tiff, .tif, .zarr]"
+        )
+
+    return vol
+
+
+def cache_volume(
+    vol,
+    cache_dir: str,
+    chunks: Optional[Tuple[int]] = None,
+    source: Optional[dict] = None,
+):
+    """
+    fetch a (remote, lazy) volume once into a local `<cache_dir>/<key>.zarr`
+    store, and read it back as a dask array. the key hashes the volume's
+    `source` (eg: url, scale and roi), shape, dtype and chunks, so a store is
+    only reused for the same inputs; stores are written under a temporary
+    name and moved into place once complete
+    """
+    import zarr
+    import dask.array as da
+
+    vol = da.asarray(vol)
+    if chunks is not None:
+        vol = vol.rechunk(tuple(chunks) + vol.chunksize[len(chunks) :])
+
+    params = {
+        "source": source,
+        "shape": list(vol.shape),
+        "dtype": str(vol.dtype),
+        "chunks": list(vol.chunksize),
+    }
+    path = os.path.join(cache_dir, f"{params_key(params)}.zarr")
+
+    if os.path.exists(path):
+        cached = zarr.open(path, mode="r")
+        if cached.shape != vol.shape or cached.dtype != vol.dtype:
+            raise ValueError(
+                f"cached volume {path} is {cached.shape} {cached.dtype}, expected {vol.shape} {vol.dtype}"
+            )
+        print(f"Reusing cached volume: {path}")
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path.replace(".zarr", ".tmp.zarr")
+        da.to_zarr(vol, tmp_path, overwrite=True)
+        zarr.open(tmp_path).attrs["source"] = json.loads(json.dumps(params, default=str))
+        replace_store(tmp_path, path)
+
+    return da.from_zarr(path)
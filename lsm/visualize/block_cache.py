@@ -0,0 +1,316 @@
+"""
+lazily segment a volume block by block, caching the results so that
+neuroglancer only ever pays for blocks it hasn't seen before
+"""
+import json
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Optional, Tuple, List, Callable
+
+import dask
+
+
+class BlockCache:
+    """bounded (in bytes) LRU cache of numpy blocks"""
+
+    def __init__(self, max_bytes: Optional[int] = 1024**3):
+        self.max_bytes = max_bytes
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def get(self, key):
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.blocks.move_to_end(key)
+            return block
+
+    def put(self, key, block: np.ndarray):
+        with self.lock:
+            if key in self.blocks:
+                self.nbytes -= self.blocks.pop(key).nbytes
+            self.blocks[key] = block
+            self.nbytes += block.nbytes
+
+            # evict least recently used blocks, but always keep the newest one
+            while self.nbytes > self.max_bytes and len(self.blocks) > 1:
+                _, evicted = self.blocks.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {
+            "blocks": len(self.blocks),
+            "nbytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _normalize_index(key, shape: Tuple[int]):
+    """convert an indexing key into (start, stop) pairs for every axis"""
+    if not isinstance(key, tuple):
+        key = (key,)
+    key = key + (slice(None),) * (len(shape) - len(key))
+
+    box = []
+    for k, size in zip(key, shape):
+        if not isinstance(k, slice) or k.step not in [None, 1]:
+            raise IndexError(f"only contiguous slices are supported, got {k}")
+        start, stop, _ = k.indices(size)
+        box.append((start, max(start, stop)))
+
+    return box
+
+
+class LazySegmentation:
+    """
+    array-like (z, y, x) label volume, whose blocks are segmented (with halos)
+    on first access, and served from a `BlockCache` afterwards.
+    since blocks are segmented independently, labels are made unique across
+    blocks by packing the block id into the upper 32 bits of a uint64.
+    """
+
+    def __init__(
+        self,
+        image: dask.array,
+        segment_func: Callable,
+        segment_config: dict,
+        block_shape: Optional[Tuple[int]] = (128, 128, 128),
+        halo: Optional[Tuple[int]] = None,
+        cache: Optional[BlockCache] = None,
+        segment_missing: Optional[bool] = True,
+    ):
+        self.image = image  # (z, y, x, c)
+        self.segment_func = segment_func
+        self.segment_config = dict(segment_config)
+        self.block_shape = tuple(block_shape)
+        self.cache = cache if cache is not None else BlockCache()
+        self.segment_missing = segment_missing
+
+        # by default, a nucleus diameter of context around each block
+        if halo is None:
+            diameter = self.segment_config.get("diameter")
+            halo = (
+                (0, 0, 0)
+                if diameter is None
+                else tuple(np.ceil(diameter).astype(np.int64))
+            )
+        self.halo = tuple(int(h) for h in halo)
+
+        self.shape = tuple(image.shape[:3])
+        self.ndim = 3
+        self.dtype = np.dtype(np.uint64)
+        self.grid_shape = tuple(
+            int(np.ceil(s / b)) for s, b in zip(self.shape, self.block_shape)
+        )
+
+        # blocks are only reused for identical segmentation parameters
+        self.params_key = json.dumps(
+            {k: v for k, v in self.segment_config.items() if k != "image"},
+            sort_keys=True,
+            default=str,
+        )
+        self.segment_lock = threading.Lock()
+
+    def block_box(self, index: Tuple[int]):
+        """(start, stop) pairs of a block's core, in volume coordinates"""
+        return [
+            (i * b, min((i + 1) * b, s))
+            for i, b, s in zip(index, self.block_shape, self.shape)
+        ]
+
+    def blocks_in_box(self, box: List[Tuple[int]]):
+        """indices of all blocks intersecting a (start, stop) box"""
+        ranges = []
+        for (start, stop), b, n in zip(box, self.block_shape, self.grid_shape):
+            start, stop = max(start, 0), max(stop, 0)
+            ranges.append(range(min(start // b, n), min(int(np.ceil(stop / b)), n)))
+        return [
+            tuple(r[i] for r, i in zip(ranges, index))
+            for index in np.ndindex(*map(len, ranges))
+        ]
+
+    def blocks_in_view(self, center: Tuple[float], extent: Tuple[int]):
+        """indices of all blocks within `extent` voxels (per axis) of `center`"""
+        box = [
+            (int(np.floor(c - e)), int(np.ceil(c + e)) + 1)
+            for c, e in zip(center, extent)
+        ]
+        return self.blocks_in_box(box)
+
+    def _key(self, index: Tuple[int]):
+        return (tuple(index), self.params_key)
+
+    def is_segmented(self, index: Tuple[int]):
+        return self._key(index) in self.cache
+
+    def segment_block(self, index: Tuple[int]):
+        """segment a block (plus halo) or fetch it from the cache"""
+        key = self._key(index)
+        block = self.cache.get(key)
+        if block is not None:
+            return block
+
+        # the model owns the GPU, so blocks are segmented one at a time
+        with self.segment_lock:
+            block = self.cache.get(key)
+            if block is not None:
+                return block
+
+            core = self.block_box(index)
+            region = [
+                (max(start - h, 0), min(stop + h, s))
+                for (start, stop), h, s in zip(core, self.halo, self.shape)
+            ]
+            image = self.image[tuple(slice(start, stop) for start, stop in region)]
+
+            cfg_dict = dict(self.segment_config)
+            cfg_dict.update({"image": image, "chunk": None, "debug": False})
+            labels = self.segment_func(**cfg_dict)
+            with dask.config.set(scheduler="synchronous"):
+                labels = np.asarray(labels.compute())
+
+            # drop the halo
+            labels = labels[
+                tuple(
+                    slice(start - rstart, stop - rstart)
+                    for (start, stop), (rstart, _) in zip(core, region)
+                )
+            ]
+
+            block_id = int(np.ravel_multi_index(index, self.grid_shape)) + 1
+            block = np.where(
+                labels > 0,
+                labels.astype(np.uint64) | np.uint64(block_id << 32),
+                np.uint64(0),
+            )
+            self.cache.put(key, block)
+
+        return block
+
+    def prefetch(self, indices: List[Tuple[int]]):
+        """segment all (missing) blocks, returns the number of new blocks"""
+        missing = [index for index in indices if not self.is_segmented(index)]
+        for index in missing:
+            self.segment_block(index)
+        return len(missing)
+
+    def __getitem__(self, key):
+        box = _normalize_index(key, self.shape)
+        out = np.zeros(tuple(stop - start for start, stop in box), dtype=self.dtype)
+
+        for index in self.blocks_in_box(box):
+            if self.segment_missing:
+                block = self.segment_block(index)
+            else:
+                block = self.cache.get(self._key(index))
+                if block is None:
+                    continue
+
+            core = self.block_box(index)
+            lo = [max(start, cstart) for (start, _), (cstart, _) in zip(box, core)]
+            hi = [min(stop, cstop) for (_, stop), (_, cstop) in zip(box, core)]
+            out[tuple(slice(l - s, h - s) for l, h, (s, _) in zip(lo, hi, box))] = block[
+                tuple(slice(l - c, h - c) for l, h, (c, _) in zip(lo, hi, core))
+            ]
+
+        return out
+
+
+class ChunkedVolume:
+    """
+    array-like view of a chunked (zarr or dask) label volume: a request only
+    reads the storage chunks it intersects, and keeps them in a `BlockCache`
+    """
+
+    def __init__(
+        self,
+        source,
+        cache: Optional[BlockCache] = None,
+        chunk_shape: Optional[Tuple[int]] = (64, 64, 64),
+    ):
+        if isinstance(source, str):
+            from lsm.utils.io_util import open_volume
+
+            source = open_volume(source)
+
+        self.source = source
+        self.cache = cache if cache is not None else BlockCache()
+        self.shape = tuple(source.shape)
+        self.ndim = len(self.shape)
+
+        # neuroglancer only serves unsigned segmentations
+        dtype = np.dtype(source.dtype)
+        self.dtype = (
+            np.dtype(f"u{max(dtype.itemsize, 4)}") if dtype.kind in "iub" else dtype
+        )
+
+        # chunk boundaries along each axis, for both zarr (regular) and dask chunks;
+        # unchunked sources (eg: memory-mapped tiffs) are read in `chunk_shape` pieces
+        chunks = getattr(source, "chunks", None)
+        if chunks is None:
+            chunks = tuple(min(c, s) for c, s in zip(chunk_shape, self.shape))
+        if isinstance(chunks[0], tuple):
+            self.bounds = [np.cumsum((0,) + c) for c in chunks]
+        else:
+            self.bounds = [
+                np.append(np.arange(0, s, c), s) for s, c in zip(self.shape, chunks)
+            ]
+
+    def _read_chunk(self, index: Tuple[int]):
+        key = tuple(index)
+        chunk = self.cache.get(key)
+        if chunk is None:
+            slices = tuple(
+                slice(b[i], b[i + 1]) for b, i in zip(self.bounds, index)
+            )
+            chunk = self.source[slices]
+            if hasattr(chunk, "compute"):
+                chunk = chunk.compute()
+            chunk = np.asarray(chunk).astype(self.dtype, copy=False)
+            self.cache.put(key, chunk)
+        return chunk
+
+    def __getitem__(self, key):
+        box = _normalize_index(key, self.shape)
+        out = np.zeros(tuple(stop - start for start, stop in box), dtype=self.dtype)
+
+        # storage chunks intersecting the requested box
+        ranges = [
+            range(
+                np.searchsorted(b, start, side="right") - 1,
+                np.searchsorted(b, stop, side="left"),
+            )
+            for (start, stop), b in zip(box, self.bounds)
+        ]
+        for index in np.ndindex(*map(len, ranges)):
+            index = tuple(r[i] for r, i in zip(ranges, index))
+            chunk = self._read_chunk(index)
+
+            core = [(b[i], b[i + 1]) for b, i in zip(self.bounds, index)]
+            lo = [max(start, cstart) for (start, _), (cstart, _) in zip(box, core)]
+            hi = [min(stop, cstop) for (_, stop), (_, cstop) in zip(box, core)]
+            out[tuple(slice(l - s, h - s) for l, h, (s, _) in zip(lo, hi, box))] = chunk[
+                tuple(slice(l - c, h - c) for l, h, (c, _) in zip(lo, hi, core))
+            ]
+
+        return out
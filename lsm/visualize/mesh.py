@@ -0,0 +1,234 @@
+"""
+blockwise, parallel surface meshes of segmented nuclei, written as
+neuroglancer (legacy) precomputed mesh fragments
+"""
+import os
+import json
+import time
+import struct
+import numpy as np
+from tqdm import tqdm
+from collections import defaultdict
+from typing import Optional, Tuple, List
+from concurrent.futures import ProcessPoolExecutor
+
+from scipy import ndimage
+from skimage.measure import marching_cubes
+
+from lsm.utils.io_util import open_volume
+
+
+def simplify_mesh(vertices: np.ndarray, faces: np.ndarray, cell_size: float):
+    """vertex clustering simplification: snap vertices to a grid of `cell_size`,
+    merge vertices sharing a cell, and drop the faces that collapse"""
+    if cell_size <= 0 or len(faces) == 0:
+        return vertices, faces
+
+    cells = np.floor(vertices / cell_size).astype(np.int64)
+    _, inverse, counts = np.unique(
+        cells, axis=0, return_inverse=True, return_counts=True
+    )
+    inverse = inverse.reshape(-1)
+
+    # merged vertices sit at the mean of their cluster
+    merged = np.zeros((len(counts), 3), dtype=np.float64)
+    np.add.at(merged, inverse, vertices)
+    merged /= counts[:, None]
+
+    faces = inverse[faces]
+    valid = (
+        (faces[:, 0] != faces[:, 1])
+        & (faces[:, 1] != faces[:, 2])
+        & (faces[:, 0] != faces[:, 2])
+    )
+    return merged.astype(np.float32), faces[valid]
+
+
+def merge_fragments(fragments: List[Tuple[np.ndarray]], weld: Optional[float] = 1e-3):
+    """concatenate an object's per-block fragments into a single mesh, welding
+    the (identical) vertices that neighbouring blocks share along their seam"""
+    offsets = np.cumsum([0] + [len(v) for v, _ in fragments[:-1]])
+    vertices = np.concatenate([v for v, _ in fragments])
+    faces = np.concatenate([f + o for (_, f), o in zip(fragments, offsets)])
+
+    if len(fragments) > 1 and weld > 0:
+        _, index, inverse = np.unique(
+            np.round(vertices / weld).astype(np.int64),
+            axis=0,
+            return_index=True,
+            return_inverse=True,
+        )
+        vertices, faces = vertices[index], inverse.reshape(-1)[faces]
+
+    return vertices, faces
+
+
+def _mesh_block(source, origin: Tuple[int], block_shape: Tuple[int]):
+    """mesh every label in a block (in voxel coordinates); blocks overlap their
+    upper neighbours by a voxel, so fragments meet along block seams"""
+    if isinstance(source, str):
+        source = open_volume(source)
+
+    shape = source.shape
+    stop = [min(o + b + 1, s) for o, b, s in zip(origin, block_shape, shape)]
+    vol = np.asarray(source[tuple(slice(o, s) for o, s in zip(origin, stop))])
+
+    # close surfaces at the volume boundary, but leave them open at block seams
+    pads = [
+        (int(o == 0), int(s == n)) for o, s, n in zip(origin, stop, shape)
+    ]
+    vol = np.pad(vol, pads)
+    vol_origin = np.subtract(origin, [lo for lo, _ in pads])
+
+    # compact labels, so find_objects doesn't scale with the largest label id
+    labels, local = np.unique(vol, return_inverse=True)
+    # shifted by one, since find_objects ignores 0 (which is only background
+    # if the block has any)
+    local = local.reshape(vol.shape) + 1
+
+    fragments = {}
+    for idx, bbox in enumerate(ndimage.find_objects(local)):
+        if bbox is None or labels[idx] == 0:
+            continue
+
+        # one voxel of context around the object, where the block has it
+        bbox = tuple(
+            slice(max(sl.start - 1, 0), min(sl.stop + 1, n))
+            for sl, n in zip(bbox, vol.shape)
+        )
+        crop = local[bbox] == idx + 1
+        if min(crop.shape) < 2 or crop.all():
+            continue
+
+        vertices, faces, _, _ = marching_cubes(crop.astype(np.uint8), level=0.5)
+        vertices += vol_origin + [sl.start for sl in bbox]
+        fragments[int(labels[idx])] = (vertices, faces)
+
+    return fragments
+
+
+def _write_meshes(
+    out_dir: str,
+    meshes: List[Tuple[int, List[Tuple[np.ndarray]]]],
+    resolution: Tuple[float],
+    simplify: float,
+):
+    """merge, simplify and write the meshes of a batch of objects"""
+    for label, fragments in meshes:
+        vertices, faces = merge_fragments(fragments)
+
+        # voxel (z, y, x) coordinates -> (x, y, z) nm, where voxel i spans [i, i + 1)
+        vertices = (vertices + 0.5) * resolution
+        vertices, faces = vertices[:, ::-1], faces[:, ::-1]
+
+        vertices, faces = simplify_mesh(vertices, faces, cell_size=simplify)
+        write_legacy_mesh(out_dir, label, vertices, faces)
+
+    return len(meshes)
+
+
+def write_legacy_mesh(out_dir: str, label: int, vertices: np.ndarray, faces: np.ndarray):
+    """write a single fragment and its manifest, in neuroglancer's legacy mesh format"""
+    fname = f"{label}:0:mesh"
+    with open(os.path.join(out_dir, fname), "wb") as f:
+        f.write(struct.pack("<I", len(vertices)))
+        f.write(vertices.astype("<f4").tobytes())
+        f.write(faces.astype("<u4").tobytes())
+
+    with open(os.path.join(out_dir, f"{label}:0"), "w") as f:
+        json.dump({"fragments": [fname]}, f)
+
+
+def mesh_labels(
+    source,
+    out_dir: str,
+    resolution: List[float],
+    block_shape: Optional[Tuple[int]] = (128, 128, 128),
+    simplify: Optional[float] = 0.0,
+    workers: Optional[int] = 8,
+):
+    """
+    mesh every object of a (z, y, x) label volume (a zarr/tiff path or an array).
+    resolution (in nm) and block shape are in (z, y, x) order, `simplify` is the
+    vertex clustering cell size in nm (0 disables simplification).
+    blocks are meshed in a process pool, and fragments of objects crossing
+    block boundaries are merged before writing
+    """
+    vol = open_volume(source) if isinstance(source, str) else source
+    resolution = np.asarray(resolution, dtype=np.float64)
+
+    origins = [
+        tuple(int(o) for o in np.multiply(index, block_shape))
+        for index in np.ndindex(
+            *[int(np.ceil(n / b)) for n, b in zip(vol.shape, block_shape)]
+        )
+    ]
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "info"), "w") as f:
+        json.dump({"@type": "neuroglancer_legacy_mesh"}, f)
+
+    tick = time.time()
+    fragments = defaultdict(list)
+    # workers re-open paths themselves, in-memory arrays are meshed in process
+    if workers > 0 and isinstance(source, str):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(_mesh_block, source, origin, block_shape)
+                for origin in origins
+            ]
+            for future in tqdm(futures, desc="meshing blocks..."):
+                for label, fragment in future.result().items():
+                    fragments[label].append(fragment)
+
+            # fragments of objects crossing blocks are merged before simplifying
+            meshes = list(fragments.items())
+            batches = [meshes[i :: workers] for i in range(workers)]
+            futures = [
+                pool.submit(_write_meshes, out_dir, batch, resolution, simplify)
+                for batch in batches
+            ]
+            for future in tqdm(futures, desc="writing meshes..."):
+                future.result()
+    else:
+        for origin in tqdm(origins, desc="meshing blocks..."):
+            for label, fragment in _mesh_block(vol, origin, block_shape).items():
+                fragments[label].append(fragment)
+        _write_meshes(out_dir, list(fragments.items()), resolution, simplify)
+
+    elapsed = time.time() - tick
+    return {
+        "meshes": len(fragments),
+        "fragments": sum(len(f) for f in fragments.values()),
+        "seconds": elapsed,
+        "meshes_per_second": len(fragments) / max(elapsed, 1e-9),
+    }
+
+
+if __name__ == "__main__":
+    # throughput benchmark on synthetic nuclei
+    from skimage.draw import ellipsoid
+    from tifffile import imwrite
+
+    rng = np.random.default_rng(0)
+    vol = np.zeros((128, 512, 512), dtype=np.uint32)
+    nucleus = ellipsoid(6, 4, 4)
+    for idx in range(1, 2001):
+        z, y, x = [rng.integers(0, s - n) for s, n in zip(vol.shape, nucleus.shape)]
+        region = vol[z : z + nucleus.shape[0], y : y + nucleus.shape[1], x : x + nucleus.shape[2]]
+        region[nucleus] = idx
+    imwrite("./mesh_benchmark.tiff", vol)
+
+    for workers in [0, 4, 8]:
+        stats = mesh_labels(
+            "./mesh_benchmark.tiff",
+            "./mesh_benchmark",
+            resolution=[4000, 1000, 1000],
+            block_shape=(64, 128, 128),
+            simplify=1000.0,
+            workers=workers,
+        )
+        print(
+            f"workers: {workers}, {stats['meshes']} meshes from {stats['fragments']} fragments, "
+            f"{stats['meshes_per_second']:.1f} meshes/s"
+        )
@@ -1,14 +1,50 @@
+import time
 import numpy as np
 import neuroglancer as ng
-from typing import Optional, List
+from typing import Optional, List, Tuple
+
+from ome_zarr.io import parse_url
+from ome_zarr.reader import Reader
+
+from lsm.distributed import get_model
+from lsm.visualize.block_cache import BlockCache, ChunkedVolume, LazySegmentation
 
 
 class Viewer:
-    def __init__(self, image_url: str, model: str):
+    def __init__(
+        self,
+        image_url: str,
+        model: str,
+        segment_config: Optional[dict] = None,
+        scale: Optional[int] = 0,
+        voxel_size: Optional[List[float]] = [1.0, 1.0, 1.0],
+        block_shape: Optional[Tuple[int]] = (128, 128, 128),
+        view_extent: Optional[Tuple[int]] = (32, 256, 256),
+        cache_bytes: Optional[int] = 1024**3,
+        auto_segment: Optional[bool] = False,
+    ):
         self.num_actions = 0
         self.model = model
+        self.image_url = image_url
+        self.scale = scale
+        self.voxel_size = voxel_size
+        # half-size (in voxels, (z, y, x)) of the region segmented around the view
+        self.view_extent = view_extent
         self.viewer = ng.Viewer()
 
+        # segmentation is computed lazily, block by block, and cached
+        self.segmentation = None
+        self.seg_source = None
+        if segment_config is not None:
+            self.segmentation = LazySegmentation(
+                image=self._read_volume(),
+                segment_func=get_model(model=model),
+                segment_config=segment_config,
+                block_shape=block_shape,
+                cache=BlockCache(max_bytes=cache_bytes),
+                segment_missing=auto_segment,
+            )
+
         # basic, universal viewer functions
         with self.viewer.txn() as s:
             s.layers["image"] = ng.ImageLayer(source=image_url)
@@ -18,23 +54,81 @@ class Viewer:
             s.gpu_memory_limit = 2 * 1024 * 1024 * 1024
             s.layout = "3d"
 
-    def segment_volume(self, action):
-        """segment a volume using the specified model"""
-        if self.model == "cellpose":
-            print(f"hello")
-            segmentation = None
-        else:
-            raise NotImplementedError
-
-        # add segmentation layer to viewer
+    def _read_volume(self):
+        """lazily read the image volume at the viewer's scale as (z, y, x, c)"""
+        reader = Reader(parse_url(self.image_url))
+        dask_vol = list(reader())[0].data[self.scale][0]
+        return np.transpose(dask_vol, (1, 2, 3, 0))
+
+    def _view_center(self, action=None):
+        """(z, y, x) voxel position of the mouse, or of the view otherwise"""
+        state = self.viewer.state
+        names = list(state.dimensions.names)
+        coords = state.position
+        if action is not None and action.mouse_voxel_coordinates is not None:
+            coords = action.mouse_voxel_coordinates
+        return [float(coords[names.index(axis)]) for axis in ["z", "y", "x"]]
+
+    def _local_segmentation(self, data):
+        """neuroglancer source, which only encodes the chunks the client asks for"""
+        return ng.LocalVolume(
+            data=data,
+            dimensions=ng.CoordinateSpace(
+                names=["z", "y", "x"], units="um", scales=self.voxel_size
+            ),
+            volume_type="segmentation",
+        )
+
+    def _add_segmentation_layer(self):
+        """serve cached blocks through a lazily evaluated segmentation layer"""
+        self.seg_source = self._local_segmentation(data=self.segmentation)
+        with self.viewer.txn() as s:
+            s.layers["segmentation"] = ng.SegmentationLayer(source=self.seg_source)
+
+    def add_segmentation_layer(
+        self,
+        source,
+        name: Optional[str] = "labels",
+        cache_bytes: Optional[int] = 512 * 1024**2,
+    ):
+        """serve an existing label volume (a zarr/tiff path, or a zarr/dask array),
+        reading its storage chunks on demand through a bounded chunk cache"""
+        volume = ChunkedVolume(source, cache=BlockCache(max_bytes=cache_bytes))
         with self.viewer.txn() as s:
-            s.layers["segmentation"] = ng.SegmentationLayer(
-                source=ng.LocalVolume(data=segmentation),
+            s.layers[name] = ng.SegmentationLayer(
+                source=self._local_segmentation(data=volume)
+            )
+        return volume
+
+    def segment_volume(self, action):
+        """segment the blocks intersecting the current view, using the specified model"""
+        if self.segmentation is None:
+            raise NotImplementedError(
+                f"no segmentation config given for {self.model}, pass `segment_config` to the viewer"
+            )
+
+        blocks = self.segmentation.blocks_in_view(
+            center=self._view_center(action), extent=self.view_extent
+        )
+        tick = time.time()
+        n_new = self.segmentation.prefetch(blocks)
+
+        # add segmentation layer to viewer, or make it re-fetch the new blocks
+        if self.seg_source is None:
+            self._add_segmentation_layer()
+        elif n_new > 0:
+            self.seg_source.invalidate()
+
+        with self.viewer.config_state.txn() as st:
+            st.status_messages["segmentation"] = (
+                f"{self.model}: {n_new}/{len(blocks)} new blocks in {time.time() - tick:.1f}s "
+                f"({len(self.segmentation.cache)} cached)"
             )
 
     def _register_callback(self):
         """register a segmentation callback function
         with neuroglancer's API"""
+        self.viewer.actions.add("segment_volume", self.segment_volume)
         with self.viewer.config_state.txn() as s:
             s.input_event_bindings.viewer["keyt"] = "segment_volume"
 
@@ -0,0 +1,264 @@
+"""
+export label volumes as neuroglancer precomputed segmentations, with a
+compressed_segmentation encoded, mode-downsampled multiscale pyramid
+format: https://github.com/google/neuroglancer/tree/master/src/datasource/precomputed
+"""
+import os
+import json
+import numpy as np
+from tqdm import tqdm
+from typing import Optional, Tuple, List
+from concurrent.futures import ProcessPoolExecutor
+
+from lsm.utils.io_util import open_volume
+
+
+def _encoded_bits(n_values: int):
+    # number of bits per voxel used for a block's lookup table indices
+    if n_values <= 1:
+        return 0
+    for bits in [1, 2, 4, 8, 16, 32]:
+        if n_values <= 2**bits:
+            return bits
+
+
+def compressed_segmentation_encode(
+    chunk: np.ndarray, block_size: Optional[Tuple[int]] = (8, 8, 8)
+):
+    """encode a single channel (z, y, x) uint32/uint64 chunk as compressed_segmentation.
+    block size is given in (z, y, x) order"""
+    if chunk.dtype not in [np.uint32, np.uint64]:
+        raise ValueError(f"compressed_segmentation needs uint32/uint64, got {chunk.dtype}")
+
+    grid = [int(np.ceil(s / b)) for s, b in zip(chunk.shape, block_size)]
+    n_blocks = int(np.prod(grid))
+
+    # channel header: a single channel, starting right after it
+    header = np.zeros(2 * n_blocks, dtype="<u4")
+    data = []
+    offset = header.size
+    tables = {}  # identical lookup tables are stored once
+
+    # blocks (and voxels within blocks) are stored with x varying fastest
+    for block_idx, (gz, gy, gx) in enumerate(np.ndindex(*grid)):
+        block = chunk[
+            gz * block_size[0] : (gz + 1) * block_size[0],
+            gy * block_size[1] : (gy + 1) * block_size[1],
+            gx * block_size[2] : (gx + 1) * block_size[2],
+        ]
+        # pad partial blocks at the chunk border, the padding is never decoded
+        pads = [(0, b - s) for s, b in zip(block.shape, block_size)]
+        block = np.pad(block, pads, mode="edge")
+
+        values, indices = np.unique(block, return_inverse=True)
+        bits = _encoded_bits(len(values))
+
+        table = values.astype("<u8").view("<u4") if chunk.dtype == np.uint64 else values.astype("<u4")
+        table_key = table.tobytes()
+        if table_key not in tables:
+            tables[table_key] = offset
+            data.append(table)
+            offset += table.size
+        table_offset = tables[table_key]
+
+        values_offset = offset
+        if bits > 0:
+            per_word = 32 // bits
+            indices = indices.astype(np.uint64).reshape(-1)
+            indices = np.pad(indices, (0, (-indices.size) % per_word))
+            shifts = np.arange(per_word, dtype=np.uint64) * np.uint64(bits)
+            words = (indices.reshape(-1, per_word) << shifts).sum(axis=1, dtype=np.uint64)
+            words = words.astype("<u4")
+            data.append(words)
+            offset += words.size
+
+        header[2 * block_idx] = table_offset | (bits << 24)
+        header[2 * block_idx + 1] = values_offset
+
+    channel_offsets = np.array([1], dtype="<u4")
+    return np.concatenate([channel_offsets, header] + data).tobytes()
+
+
+def downsample_mode(vol: np.ndarray, factor: Optional[Tuple[int]] = (2, 2, 2)):
+    """downsample a label volume by taking the most frequent label in every window;
+    background loses ties, so that small objects survive downsampling"""
+    pads = [(0, (-s) % f) for s, f in zip(vol.shape, factor)]
+    vol = np.pad(vol, pads, mode="edge")
+
+    (z, y, x), (fz, fy, fx) = vol.shape, factor
+    windows = (
+        vol.reshape(z // fz, fz, y // fy, fy, x // fx, fx)
+        .transpose(0, 2, 4, 1, 3, 5)
+        .reshape(z // fz, y // fy, x // fx, -1)
+    )
+    counts = (windows[..., :, None] == windows[..., None, :]).sum(axis=-1)
+    counts = 2 * counts - (windows == 0)
+    mode = np.take_along_axis(windows, counts.argmax(axis=-1)[..., None], axis=-1)
+
+    return mode[..., 0]
+
+
+def _scale_key(resolution: List[float]):
+    return "_".join(f"{r:g}" for r in resolution[::-1])
+
+
+def _scales(
+    shape: Tuple[int],
+    resolution: List[float],
+    chunk_size: Tuple[int],
+    num_scales: int,
+    factor: Tuple[int],
+    block_size: Tuple[int],
+):
+    """shape and resolution of every pyramid level, in (z, y, x) order"""
+    scales = []
+    for s in range(num_scales):
+        f = np.power(factor, s)
+        scales.append(
+            {
+                "shape": [int(np.ceil(n / fi)) for n, fi in zip(shape, f)],
+                "resolution": [float(r * fi) for r, fi in zip(resolution, f)],
+            }
+        )
+
+    # neuroglancer expects (x, y, z) order
+    info_scales = [
+        {
+            "key": _scale_key(scale["resolution"]),
+            "size": scale["shape"][::-1],
+            "resolution": scale["resolution"][::-1],
+            "voxel_offset": [0, 0, 0],
+            "chunk_sizes": [list(chunk_size[::-1])],
+            "encoding": "compressed_segmentation",
+            "compressed_segmentation_block_size": list(block_size[::-1]),
+        }
+        for scale in scales
+    ]
+
+    return scales, info_scales
+
+
+def _export_block(
+    source,
+    out_dir: str,
+    origin: Tuple[int],
+    scales: List[dict],
+    chunk_size: Tuple[int],
+    factor: Tuple[int],
+    block_size: Tuple[int],
+    dtype: str,
+):
+    """read one base resolution block, and write its chunks at every scale"""
+    if isinstance(source, str):
+        source = open_volume(source)
+
+    extent = np.multiply(chunk_size, np.power(factor, len(scales) - 1))
+    stop = np.minimum(np.add(origin, extent), scales[0]["shape"])
+    vol = np.asarray(
+        source[tuple(slice(o, s) for o, s in zip(origin, stop))]
+    ).astype(dtype)
+
+    n_chunks = 0
+    for s, scale in enumerate(scales):
+        if s > 0:
+            vol = downsample_mode(vol, factor=factor)
+
+        scale_origin = np.floor_divide(origin, np.power(factor, s))
+        scale_dir = os.path.join(out_dir, _scale_key(scale["resolution"]))
+        for index in np.ndindex(
+            *[int(np.ceil(n / c)) for n, c in zip(vol.shape, chunk_size)]
+        ):
+            start = np.multiply(index, chunk_size)
+            chunk = vol[
+                tuple(slice(st, st + c) for st, c in zip(start, chunk_size))
+            ]
+            lo = scale_origin + start
+            hi = lo + chunk.shape
+            (z0, y0, x0), (z1, y1, x1) = lo, hi
+            fname = os.path.join(scale_dir, f"{x0}-{x1}_{y0}-{y1}_{z0}-{z1}")
+            with open(fname, "wb") as f:
+                f.write(compressed_segmentation_encode(chunk, block_size=block_size))
+            n_chunks += 1
+
+    return n_chunks
+
+
+def export_precomputed(
+    source,
+    out_dir: str,
+    resolution: List[float],
+    chunk_size: Optional[Tuple[int]] = (64, 64, 64),
+    num_scales: Optional[int] = 3,
+    factor: Optional[Tuple[int]] = (2, 2, 2),
+    block_size: Optional[Tuple[int]] = (8, 8, 8),
+    workers: Optional[int] = 8,
+):
+    """
+    write a (z, y, x) label volume (a zarr/tiff path or an array) as a
+    precomputed segmentation. resolution (in nm), chunk, downsampling factor
+    and block sizes are all given in (z, y, x) order.
+    the base volume is split into blocks spanning one chunk at the coarsest
+    scale, so every block is read once and downsampled in memory, in parallel
+    """
+    vol = open_volume(source) if isinstance(source, str) else source
+    dtype = "uint64" if np.dtype(vol.dtype).itemsize > 4 else "uint32"
+
+    scales, info_scales = _scales(
+        vol.shape, resolution, chunk_size, num_scales, factor, block_size
+    )
+    os.makedirs(out_dir, exist_ok=True)
+    for scale in info_scales:
+        os.makedirs(os.path.join(out_dir, scale["key"]), exist_ok=True)
+
+    info = {
+        "@type": "neuroglancer_multiscale_volume",
+        "type": "segmentation",
+        "data_type": dtype,
+        "num_channels": 1,
+        "scales": info_scales,
+    }
+    with open(os.path.join(out_dir, "info"), "w") as f:
+        json.dump(info, f, indent=2)
+
+    extent = np.multiply(chunk_size, np.power(factor, num_scales - 1))
+    origins = [
+        tuple(int(o) for o in np.multiply(index, extent))
+        for index in np.ndindex(
+            *[int(np.ceil(n / e)) for n, e in zip(vol.shape, extent)]
+        )
+    ]
+    task_args = (scales, chunk_size, factor, block_size, dtype)
+
+    n_chunks = 0
+    # workers re-open paths themselves, in-memory arrays are exported in process
+    if workers > 0 and isinstance(source, str):
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(_export_block, source, out_dir, origin, *task_args)
+                for origin in origins
+            ]
+            for future in tqdm(futures, desc="exporting precomputed blocks..."):
+                n_chunks += future.result()
+    else:
+        for origin in tqdm(origins, desc="exporting precomputed blocks..."):
+            n_chunks += _export_block(vol, out_dir, origin, *task_args)
+
+    return info, n_chunks
+
+
+if __name__ == "__main__":
+    from skimage.draw import ellipsoid
+
+    # synthetic label volume of randomly placed nuclei
+    rng = np.random.default_rng(0)
+    vol = np.zeros((128, 256, 256), dtype=np.uint32)
+    nucleus = ellipsoid(6, 4, 4)
+    for idx in range(1, 200):
+        z, y, x = [rng.integers(0, s - n) for s, n in zip(vol.shape, nucleus.shape)]
+        region = vol[z : z + nucleus.shape[0], y : y + nucleus.shape[1], x : x + nucleus.shape[2]]
+        region[nucleus] = idx
+
+    info, n_chunks = export_precomputed(
+        vol, "./precomputed_test", resolution=[4000, 1000, 1000], workers=0
+    )
+    print(f"wrote {n_chunks} chunks: {json.dumps(info, indent=2)}")
@@ -0,0 +1,37 @@
+import os
+import sys
+
+from lsm.dataio import get_data
+from lsm.utils.console_log import log
+from lsm.distributed.server import SegmentationServer
+from lsm.utils.load_config import create_args_parser, load_config
+from lsm.utils.distributed_util import init_env
+
+
+def main_function(args):
+    init_env(args)
+
+    # lazy load the full volume once, jobs index rois into it
+    dataset = get_data(args)
+    volume = dataset.read_vol()
+    log.info(f"Serving volume of shape {volume.shape} from {args.data.url}")
+
+    server = SegmentationServer(
+        args,
+        volume=volume,
+        models=args.segmentation.models,
+        host=args.server.host,
+        port=args.server.port,
+        max_jobs=args.server.max_jobs,
+    )
+    # pay for imports + model weights once, before accepting jobs
+    server.warm_up()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = create_args_parser()
+    parser.add_argument("--ddp", action="store_true", help="Distributed processing")
+    args, unknown = parser.parse_known_args()
+    config = load_config(args, unknown)
+    main_function(config)
@@ -0,0 +1,103 @@
+import os
+import sys
+
+from lsm.dataio import get_data
+from lsm.utils.console_log import log
+from lsm.utils.load_config import create_args_parser, load_config
+from lsm.distributed.gt_proxy import find_gt_proxy, roi_params
+from lsm.distributed.threshold_sweep import (
+    cache_flows,
+    cache_maps,
+    sweep_cellpose,
+    sweep_thresholds,
+)
+
+
+def main_function(args):
+    exp_dir = args.training.exp_dir
+
+    # lazy load data as a dask array
+    dataset = get_data(args)
+    img_vol = next(iter(dataset))[-1]["orig_vol"]
+
+    for model in args.segmentation.models:
+        save_dir = os.path.join(exp_dir, f"{model}_seg")
+        os.makedirs(save_dir, exist_ok=True)
+
+        gt_path = find_gt_proxy(save_dir, cache_dir=args.model.get("gt_cache_dir", None))
+
+        if model == "cellpose":
+            cfg_dict = {
+                "image": img_vol,
+                "boundary": args.model.boundary,
+                "diameter": args.model.diameter,
+                "chunk": args.segmentation.chunk,
+                "iou_depth": args.model.stitching.iou_depth,
+                "iou_threshold": args.model.stitching.iou_threshold,
+            }
+
+            # the network runs once, every setting re-runs the flow dynamics only
+            print(f"Caching flows (model: {model})...")
+            flow_cache = cache_flows(
+                cfg_dict={
+                    **cfg_dict,
+                    "channels": args.model.channels,
+                    "use_anisotropy": args.model.use_anisotropy,
+                },
+                cache_dir=os.path.join(save_dir, "sweep_flows"),
+                source=roi_params(args),
+            )
+
+            results = sweep_cellpose(
+                cfg_dict=cfg_dict,
+                flow_cache=flow_cache,
+                flow_thresholds=args.sweep.cellpose.flow_thresholds,
+                cellprob_thresholds=args.sweep.cellpose.cellprob_thresholds,
+                min_sizes=args.sweep.cellpose.min_sizes,
+                gt_path=gt_path,
+                workers=args.sweep.workers,
+            )
+
+        elif model in ["anystar", "anystar-gaussian", "anystar-spherical"]:
+            model_args = args.model[model.replace("-", "_")]
+
+            # the network runs once, every threshold setting re-uses its outputs
+            print(f"Caching prob/dist maps (model: {model})...")
+            maps_path = cache_maps(
+                image=img_vol,
+                cache_dir=os.path.join(save_dir, "sweep_maps"),
+                model_folder=model_args.model_folder,
+                model_name=model_args.model_name,
+                weight_name=model_args.weight_name,
+                diameter=args.model.diameter,
+                scale=args.model.scale,
+                chunk=args.segmentation.chunk,
+                boundary=args.model.boundary,
+                source=roi_params(args),
+            )
+
+            results = sweep_thresholds(
+                maps_path=maps_path,
+                prob_threshs=args.sweep.prob_threshs,
+                nms_threshs=args.sweep.nms_threshs,
+                halo=args.sweep.halo,
+                gt_path=gt_path,
+                workers=args.sweep.workers,
+            )
+
+        else:
+            raise NotImplementedError(
+                f"{model} not implemented, choose one of [cellpose, anystar, anystar-gaussian, anystar-spherical]"
+            )
+
+        fpath = os.path.join(save_dir, "threshold_sweep.csv")
+        results.to_csv(fpath, index=False)
+        log.info(f"Threshold sweep results ({model}):\n{results}")
+
+
+if __name__ == "__main__":
+    parser = create_args_parser()
+    parser.add_argument("--ddp", action="store_true", help="Distributed processing")
+    args, unknown = parser.parse_known_args()
+    config = load_config(args, unknown)
+    main_function(config)